@@ -0,0 +1,123 @@
+"""Peak memory and time of one forward/backward with the standard and the chunked loss.
+
+The model is a tiny randomly initialized Qwen2 with a real-size vocabulary, so the
+logits dominate memory the way they do for Qwen1.5 at long context. Peak memory is
+the allocator peak on CUDA and the peak RSS on CPU.
+
+    python -m benchmarks.chunked_loss_bench --vocab-size 151936 --seq-len 2048 --output chunked_loss.json
+"""
+
+import argparse
+import gc
+import json
+import time
+
+import torch
+from transformers import Qwen2Config, Qwen2ForCausalLM
+
+from utils.chunked_loss import chunked_lm_loss
+from utils.run_ledger import peak_rss_mb, reset_peak_rss
+
+
+def standard_loss(model, input_ids, attention_mask, labels, chunk_size):
+    return model(input_ids=input_ids, attention_mask=attention_mask, labels=labels).loss
+
+
+def chunked_loss(model, input_ids, attention_mask, labels, chunk_size):
+    hidden = model.get_decoder()(input_ids=input_ids, attention_mask=attention_mask)[0]
+    return chunked_lm_loss(
+        hidden, labels, model.get_output_embeddings(), chunk_size=chunk_size
+    )
+
+
+def run(loss_fn, model, batch, chunk_size, device):
+    model.zero_grad(set_to_none=True)
+    gc.collect()
+    if device == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    else:
+        reset_peak_rss()
+        base = peak_rss_mb() * 2**20
+    start = time.perf_counter()
+    loss = loss_fn(model, *batch, chunk_size)
+    loss.backward()
+    if device == "cuda":
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated()
+    else:
+        peak = peak_rss_mb() * 2**20
+    return {
+        "loss": loss.item(),
+        "seconds": round(time.perf_counter() - start, 4),
+        "peak_mb_above_start": round((peak - base) / 2**20, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vocab-size", type=int, default=151936)
+    parser.add_argument("--hidden-size", type=int, default=256)
+    parser.add_argument("--num-layers", type=int, default=2)
+    parser.add_argument("--batch-size", type=int, default=2)
+    parser.add_argument("--seq-len", type=int, default=1024)
+    parser.add_argument(
+        "--labeled-fraction",
+        type=float,
+        default=0.5,
+        help="share of positions that are assistant tokens",
+    )
+    parser.add_argument("--chunk-size", type=int, default=1024)
+    parser.add_argument("--output", default="chunked_loss_bench.json")
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    torch.manual_seed(0)
+    config = Qwen2Config(
+        vocab_size=args.vocab_size,
+        hidden_size=args.hidden_size,
+        intermediate_size=args.hidden_size * 2,
+        num_hidden_layers=args.num_layers,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=max(4096, args.seq_len),
+    )
+    model = Qwen2ForCausalLM(config).to(device)
+    input_ids = torch.randint(
+        0, args.vocab_size, (args.batch_size, args.seq_len), device=device
+    )
+    attention_mask = torch.ones_like(input_ids)
+    labels = input_ids.clone()
+    # the prompt comes first, only the answer at the end is supervised
+    labels[:, : int(args.seq_len * (1 - args.labeled_fraction))] = -100
+    batch = (input_ids, attention_mask, labels)
+
+    results = {
+        "standard": run(standard_loss, model, batch, args.chunk_size, device),
+        "chunked": run(chunked_loss, model, batch, args.chunk_size, device),
+    }
+    results["loss_abs_diff"] = abs(
+        results["standard"]["loss"] - results["chunked"]["loss"]
+    )
+    results["peak_mb_saved"] = round(
+        results["standard"]["peak_mb_above_start"]
+        - results["chunked"]["peak_mb_above_start"],
+        1,
+    )
+    print(json.dumps(results, indent=2))
+    with open(args.output, "w") as f:
+        json.dump(
+            {
+                "benchmark": "chunked_loss",
+                "device": device,
+                "args": vars(args),
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+
+
+if __name__ == "__main__":
+    main()
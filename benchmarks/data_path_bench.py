@@ -0,0 +1,205 @@
+"""Throughput of every step on the data path, from raw rows to padded batches.
+
+Runs offline on synthetic conversations (with function_call/observation turns) and a
+small local tokenizer, and writes one JSON file per run so commits can be compared.
+
+    python -m benchmarks.data_path_bench --num-samples 5000 --tool-turns 1 --output data_path.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+
+import torch
+
+from dataset import CompiledSFTDataset, SFTDataCollator, SFTDataset
+from process_dataset import convert_items, get_blockchain_functions
+from utils.constants import qwen_template
+from utils.run_ledger import peak_rss_mb, reset_peak_rss
+from utils.synthetic import build_tokenizer, random_sentence, write_conversations
+from validate_dataset import validate_dataset
+
+
+@contextlib.contextmanager
+def measure(results, name, items):
+    """Time the block into results[name] with items/sec and the peak RSS reached inside it."""
+    reset_peak_rss()
+    record = {"items": items}
+    start = time.perf_counter()
+    yield record
+    elapsed = time.perf_counter() - start
+    record.update(
+        seconds=round(elapsed, 4),
+        items_per_sec=round(record["items"] / elapsed, 1) if elapsed else None,
+        peak_rss_mb=round(peak_rss_mb(), 1),
+    )
+    results[name] = record
+    print(name, json.dumps(record))
+
+
+def bench_collator(dataset, collator, batch_size, num_batches, seed=0):
+    """Latency per batch on random batches, and the share of the padded batch that is padding."""
+    rng = random.Random(seed)
+    samples = [dataset[i] for i in range(len(dataset))]
+    latencies, real, padded = [], 0, 0
+    for _ in range(num_batches):
+        batch = rng.sample(samples, min(batch_size, len(samples)))
+        start = time.perf_counter()
+        out = collator(batch)
+        latencies.append(time.perf_counter() - start)
+        real += int(out["attention_mask"].sum())
+        padded += out["attention_mask"].numel()
+    latencies.sort()
+    return {
+        "batch_size": batch_size,
+        "batches": num_batches,
+        "p50_ms": round(statistics.median(latencies) * 1000, 4),
+        "p95_ms": round(latencies[int(0.95 * (len(latencies) - 1))] * 1000, 4),
+        "padding_ratio": round(1 - real / padded, 4) if padded else 0.0,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-samples", type=int, default=2000)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--tool-turns", type=int, default=1)
+    parser.add_argument("--max-seq-length", type=int, default=1024)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--num-batches", type=int, default=200)
+    parser.add_argument("--output", default="data_path_bench.json")
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        tokenizer = build_tokenizer(os.path.join(tmp, "tokenizer"))
+        data_file = os.path.join(tmp, "data.jsonl")
+
+        with measure(results, "generate", args.num_samples):
+            write_conversations(
+                data_file,
+                args.num_samples,
+                turns=args.turns,
+                tool_turns=args.tool_turns,
+            )
+        results["generate"]["bytes"] = os.path.getsize(data_file)
+
+        # validate_dataset prints per line, keep that out of the timing output
+        with measure(
+            results, "validate_dataset", args.num_samples
+        ) as record, contextlib.redirect_stdout(io.StringIO()):
+            total, errors = validate_dataset(data_file)
+        record.update(errors=errors)
+
+        rng = random.Random(0)
+        rows = [
+            {"instruction": random_sentence(rng), "output": random_sentence(rng)}
+            for _ in range(args.num_samples)
+        ]
+        with measure(results, "process_dataset", args.num_samples) as record:
+            processed, _ = convert_items(
+                rows, get_blockchain_functions(), io.StringIO()
+            )
+        record["items"] = processed
+
+        with measure(results, "dataset_index", args.num_samples):
+            dataset = SFTDataset(
+                data_file, tokenizer, args.max_seq_length, qwen_template
+            )
+        with measure(results, "getitem", len(dataset)) as record:
+            record["tokens"] = sum(
+                len(dataset[i]["input_ids"]) for i in range(len(dataset))
+            )
+
+        # the same pass served from the shared-memory sample cache
+        cached = SFTDataset(
+            data_file, tokenizer, args.max_seq_length, qwen_template, cache_size_mb=64
+        )
+        for i in range(len(cached)):
+            cached[i]
+        with measure(results, "getitem_cached", len(cached)):
+            for i in range(len(cached)):
+                cached[i]
+        results["getitem_cached"]["hit_rate"] = round(
+            cached.cache.stats()["hit_rate"], 4
+        )
+        cached.cache.close()
+
+        # compiled into a token store, then recompiled after regenerating 1% of the rows
+        store_root = os.path.join(tmp, "workspaces")
+        with measure(results, "compile_cold", args.num_samples):
+            compiled = CompiledSFTDataset(
+                data_file,
+                tokenizer,
+                args.max_seq_length,
+                qwen_template,
+                root=store_root,
+            )
+        compiled.close()
+        with open(data_file) as f:
+            lines = f.readlines()
+        changed = os.path.join(tmp, "changed.jsonl")
+        write_conversations(
+            changed, max(1, args.num_samples // 100), turns=args.turns, seed=1
+        )
+        with open(changed) as f:
+            for i, line in enumerate(f):
+                lines[i * 100 % len(lines)] = line
+        with open(data_file, "w") as f:
+            f.writelines(lines)
+        with measure(results, "compile_1pct_changed", args.num_samples):
+            compiled = CompiledSFTDataset(
+                data_file,
+                tokenizer,
+                args.max_seq_length,
+                qwen_template,
+                root=store_root,
+            )
+        with measure(results, "getitem_compiled", len(compiled)):
+            for i in range(len(compiled)):
+                compiled[i]
+        compiled.close()
+
+        collator = SFTDataCollator(tokenizer, args.max_seq_length)
+        results["collator"] = [
+            bench_collator(dataset, collator, batch_size, args.num_batches)
+            for batch_size in args.batch_sizes
+        ]
+        for row in results["collator"]:
+            print("collator", json.dumps(row))
+
+    with open(args.output, "w") as f:
+        json.dump(
+            {
+                "benchmark": "data_path",
+                "commit": git_commit(),
+                "python": platform.python_version(),
+                "torch": torch.__version__,
+                "args": vars(args),
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Measure how much of each training step is spent waiting on the dataloader.
+
+The device step is simulated with a sleep, as on a GPU node the forward/backward
+pass does not occupy the host CPU that tokenizes the next batch.
+
+    python -m benchmarks.dataloader_bench --num-samples 2000 --step-ms 50
+"""
+
+import argparse
+import itertools
+import json
+import os
+import tempfile
+import time
+
+from torch.utils.data import DataLoader
+
+from dataset import SFTDataCollator, SFTDataset
+from utils.constants import qwen_template
+from utils.synthetic import build_tokenizer, write_conversations
+
+
+def run_setting(dataset, collator, batch_size, step_s, epochs, **loader_kwargs):
+    loader = DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=True,
+        collate_fn=collator,
+        **loader_kwargs,
+    )
+    wait, total, steps = 0.0, 0.0, 0
+    start = time.perf_counter()
+    for _ in range(epochs):
+        it = iter(loader)
+        while True:
+            t0 = time.perf_counter()
+            try:
+                next(it)
+            except StopIteration:
+                break
+            t1 = time.perf_counter()
+            time.sleep(step_s)
+            wait += t1 - t0
+            total += time.perf_counter() - t0
+            steps += 1
+    return {
+        **loader_kwargs,
+        "steps": steps,
+        "wall_s": round(time.perf_counter() - start, 3),
+        "data_wait_s": round(wait, 3),
+        "data_wait_fraction": round(wait / total, 4) if total else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-samples", type=int, default=1000)
+    parser.add_argument("--turns", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--max-seq-length", type=int, default=1024)
+    parser.add_argument("--step-ms", type=float, default=50)
+    parser.add_argument("--epochs", type=int, default=2)
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 2, 4])
+    parser.add_argument("--prefetch", type=int, nargs="+", default=[2, 4])
+    parser.add_argument("--output", default="bench_output.json")
+    args = parser.parse_args()
+
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    with tempfile.TemporaryDirectory() as tmp:
+        tokenizer = build_tokenizer(os.path.join(tmp, "tokenizer"))
+        data_file = os.path.join(tmp, "data.jsonl")
+        write_conversations(data_file, args.num_samples, turns=args.turns)
+        dataset = SFTDataset(data_file, tokenizer, args.max_seq_length, qwen_template)
+        collator = SFTDataCollator(tokenizer, args.max_seq_length)
+
+        results = []
+        for workers, prefetch, persistent, pin in itertools.product(
+            args.workers, args.prefetch, [False, True], [False, True]
+        ):
+            if workers == 0 and (persistent or prefetch != args.prefetch[0]):
+                continue
+            kwargs = {"num_workers": workers, "pin_memory": pin}
+            if workers > 0:
+                kwargs.update(prefetch_factor=prefetch, persistent_workers=persistent)
+            result = run_setting(
+                dataset,
+                collator,
+                args.batch_size,
+                args.step_ms / 1000,
+                args.epochs,
+                **kwargs,
+            )
+            print(json.dumps(result))
+            results.append(result)
+
+    with open(args.output, "w") as f:
+        json.dump(
+            {"benchmark": "dataloader", "args": vars(args), "results": results},
+            f,
+            indent=2,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+"""Wall time of every full_automation stage, offline and on CPU.
+
+The whole flow (get_task -> download -> merge -> train -> upload -> submit) runs
+against a fake ledger and a local file server over HTTP, a stub HfApi that commits
+into a local folder, and a randomly initialized tiny Qwen2 model. Stage times come
+from the run ledger, so they are the same spans a real node records.
+
+    python -m benchmarks.e2e_bench --num-samples 200 --repeats 3 --output e2e.json
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+from functools import partial
+from http.server import (
+    BaseHTTPRequestHandler,
+    SimpleHTTPRequestHandler,
+    ThreadingHTTPServer,
+)
+from types import SimpleNamespace
+
+TASK_ID = 1
+
+
+class LocalHfApi:
+    """HfApi stand-in keeping every repo as a folder of committed files."""
+
+    def __init__(self, root):
+        self.root = root
+        self.heads = {}
+
+    def create_repo(self, repo_id, exist_ok=False, repo_type=None):
+        if repo_id in self.heads:
+            raise Exception("409 Conflict: repo already exists")
+        os.makedirs(os.path.join(self.root, repo_id), exist_ok=True)
+        self.heads[repo_id] = "initial"
+
+    def repo_info(self, repo_id, repo_type=None):
+        return SimpleNamespace(sha=self.heads[repo_id])
+
+    def list_repo_tree(self, repo_id, recursive=False, revision=None, repo_type=None):
+        folder = os.path.join(self.root, repo_id)
+        for name in sorted(os.listdir(folder)):
+            with open(os.path.join(folder, name), "rb") as f:
+                content = f.read()
+            # every file as a regular git blob, matched by its blob id
+            blob_id = hashlib.sha1(b"blob %d\0" % len(content) + content).hexdigest()
+            yield SimpleNamespace(path=name, blob_id=blob_id, lfs=None)
+
+    def create_commit(
+        self,
+        repo_id,
+        operations,
+        commit_message,
+        repo_type=None,
+        parent_commit=None,
+        num_threads=5,
+    ):
+        for op in operations:
+            shutil.copy(
+                op.path_or_fileobj, os.path.join(self.root, repo_id, op.path_in_repo)
+            )
+        self.heads[repo_id] = hashlib.sha1(
+            f"{repo_id}{time.time()}".encode()
+        ).hexdigest()
+        return SimpleNamespace(oid=self.heads[repo_id])
+
+
+def serve(handler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def fake_ledger(task, submissions):
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self.reply(task)
+
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            submissions.append(payload)
+            self.reply({"ok": True})
+
+        def log_message(self, format, *args):
+            pass
+
+    return serve(Handler)
+
+
+def file_server(directory):
+    class Handler(SimpleHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    return serve(partial(Handler, directory=directory))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-samples", type=int, default=200)
+    parser.add_argument("--extra-samples", type=int, default=100)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--tool-turns", type=int, default=1)
+    parser.add_argument("--context-length", type=int, default=256)
+    parser.add_argument("--hidden-size", type=int, default=64)
+    parser.add_argument("--num-layers", type=int, default=2)
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument(
+        "--warm-start",
+        action="store_true",
+        help="grow the task data 10%% per repeat and warm-start from the last adapter",
+    )
+    parser.add_argument("--output", default="e2e_bench.json")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+
+    workdir = tempfile.mkdtemp(prefix="e2e-bench-")
+    served = os.path.join(workdir, "served")
+    os.makedirs(os.path.join(workdir, "data"))
+    os.makedirs(served)
+    submissions = []
+    files = file_server(served)
+    task = {
+        "id": TASK_ID,
+        "data": {
+            "training_set_url": f"http://127.0.0.1:{files.server_port}/training_set.jsonl",
+            "context_length": args.context_length,
+            "max_params": 10**9,
+        },
+    }
+    ledger = fake_ledger(task, submissions)
+
+    # the pipeline reads these at import time
+    os.environ.update(
+        FLOCK_API_KEY="bench",
+        HF_TOKEN="bench",
+        HF_USERNAME="bench",
+        FED_LEDGER_BASE_URL=f"http://127.0.0.1:{ledger.server_port}",
+        TRAIN_DEVICE="cpu",
+    )
+    for key in (
+        "CPUS_PER_WORKER",
+        "EVAL_FRACTION",
+        "SWEEP_CONFIG",
+        "MODEL_ID",
+        "WORKSPACE_ROOT",
+        "KEEP_WORKSPACE",
+        "TIME_BUDGET_S",
+    ):
+        os.environ.pop(key, None)
+    import full_automation
+    from utils.constants import (
+        model2base_model,
+        model2size,
+        model2template,
+        qwen_template,
+    )
+    from utils.run_ledger import load_spans
+    from utils.synthetic import build_tiny_model, build_tokenizer, write_conversations
+
+    os.chdir(workdir)
+    # a relative model id keeps the stub repo names short
+    model_dir = "tiny-qwen"
+    build_tiny_model(
+        model_dir, build_tokenizer(model_dir), args.hidden_size, args.num_layers
+    )
+    model2template[model_dir] = qwen_template
+    model2size[model_dir] = 1
+    model2base_model[model_dir] = "qwen1.5"
+    api = LocalHfApi(os.path.join(workdir, "hub"))
+    full_automation.HfApi = lambda token: api
+
+    training_args = {
+        model_dir: {
+            "per_device_train_batch_size": 4,
+            "gradient_accumulation_steps": 1,
+            "num_train_epochs": args.epochs,
+            "lora_rank": 8,
+            "lora_alpha": 16,
+            "lora_dropout": 0.0,
+            "warmup_steps": 0,
+            "device": "cpu",
+            "warm_start": args.warm_start,
+        }
+    }
+
+    runs = []
+    try:
+        for repeat in range(args.repeats):
+            training_set = os.path.join(served, "training_set.jsonl")
+            if not args.warm_start:
+                write_conversations(
+                    training_set,
+                    args.num_samples,
+                    turns=args.turns,
+                    seed=repeat,
+                    tool_turns=args.tool_turns,
+                )
+            elif repeat == 0:
+                write_conversations(
+                    training_set,
+                    args.num_samples,
+                    turns=args.turns,
+                    tool_turns=args.tool_turns,
+                )
+            else:
+                # the same task data plus 10% new rows, trained on top of the last adapter
+                grown = os.path.join(workdir, "grown.jsonl")
+                write_conversations(
+                    grown,
+                    max(1, args.num_samples // 10),
+                    turns=args.turns,
+                    seed=repeat,
+                    tool_turns=args.tool_turns,
+                )
+                with open(training_set, "a") as dst, open(grown) as src:
+                    dst.write(src.read())
+            write_conversations(
+                "data/agent_training_data.jsonl",
+                args.extra_samples,
+                turns=args.turns,
+                seed=10**6,
+            )
+
+            start = time.perf_counter()
+            full_automation.run_task(TASK_ID, training_args)
+            total = time.perf_counter() - start
+            if len(submissions) != repeat + 1:
+                raise RuntimeError(f"run {repeat} did not submit, see the log above")
+
+            spans = load_spans([f"runs/task-{TASK_ID}.jsonl"])
+            run_id = spans[-1]["run_id"]
+            stages = {}
+            for record in spans:
+                if record["run_id"] == run_id:
+                    stages[record["stage"]] = (
+                        stages.get(record["stage"], 0.0) + record["duration_s"]
+                    )
+            train = next(
+                r for r in spans if r["run_id"] == run_id and r["stage"] == "train"
+            )
+            run = {
+                "total_s": round(total, 3),
+                "stages_s": {
+                    stage: round(seconds, 3) for stage, seconds in stages.items()
+                },
+                "other_s": round(total - sum(stages.values()), 3),
+                "train_tokens_per_sec": round(train["tokens"] / train["duration_s"], 1),
+            }
+            print(json.dumps(run))
+            runs.append(run)
+    finally:
+        ledger.shutdown()
+        files.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    summary = {
+        stage: round(statistics.median(run["stages_s"][stage] for run in runs), 3)
+        for stage in runs[0]["stages_s"]
+    }
+    summary["total"] = round(statistics.median(run["total_s"] for run in runs), 3)
+    with open(output, "w") as f:
+        json.dump(
+            {
+                "benchmark": "e2e",
+                "python": platform.python_version(),
+                "args": vars(args),
+                "median_s": summary,
+                "runs": runs,
+            },
+            f,
+            indent=2,
+        )
+
+
+if __name__ == "__main__":
+    main()
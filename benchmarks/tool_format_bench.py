@@ -0,0 +1,94 @@
+"""Microbenchmark of function-call and tool-list formatting as done per sample by SFTDataset.
+
+Compares the decode/re-encode round trip with the canonical fast path, and both with
+the content-hash cache warm (every epoch after the first).
+
+    python -m benchmarks.tool_format_bench --output tool_format_bench.json
+"""
+
+import argparse
+import json
+import random
+import timeit
+
+from utils.synthetic import TOOLS, make_tool_turns
+from utils.tool_utils import (
+    _function_cache,
+    _tools_cache,
+    format_function_call,
+    format_tools,
+    function_formatter,
+    render_function_call,
+    tool_formater,
+)
+
+
+def per_call_us(fn, items, repeat):
+    def run():
+        for item in items:
+            fn(item)
+
+    # best of `repeat`, the usual timeit convention for noise-free numbers
+    return min(timeit.repeat(run, number=1, repeat=repeat)) / len(items) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-calls", type=int, default=10000)
+    parser.add_argument(
+        "--distinct", type=int, default=500, help="distinct calls among them"
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default="tool_format_bench.json")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    distinct = [make_tool_turns(rng)[0]["content"] for _ in range(args.distinct)]
+    # the same calls reformatted, as other generators write them
+    compact = [json.dumps(json.loads(raw), separators=(",", ":")) for raw in distinct]
+    calls = [rng.choice(distinct) for _ in range(args.num_calls)]
+    raw_tools = json.dumps(TOOLS)
+
+    def cold(fn):
+        def run(raw):
+            _function_cache.clear()
+            _tools_cache.clear()
+            return fn(raw)
+
+        return run
+
+    results = {
+        "function_call_round_trip_us": per_call_us(
+            lambda raw: function_formatter(json.loads(raw)), calls, args.repeat
+        ),
+        "function_call_fast_path_us": per_call_us(
+            render_function_call, calls, args.repeat
+        ),
+        "function_call_non_canonical_us": per_call_us(
+            render_function_call, compact, args.repeat
+        ),
+        "function_call_cached_us": per_call_us(
+            format_function_call, calls, args.repeat
+        ),
+        "function_call_cold_cache_us": per_call_us(
+            cold(format_function_call), calls[:1000], args.repeat
+        ),
+        "tools_round_trip_us": per_call_us(
+            lambda raw: tool_formater(json.loads(raw)), [raw_tools] * 1000, args.repeat
+        ),
+        "tools_cached_us": per_call_us(format_tools, [raw_tools] * 1000, args.repeat),
+    }
+    results = {key: round(value, 3) for key, value in results.items()}
+    for key, value in results.items():
+        print(f"{key:<34}{value:>10.3f}")
+
+    with open(args.output, "w") as f:
+        json.dump(
+            {"benchmark": "tool_format", "args": vars(args), "results": results},
+            f,
+            indent=2,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+import argparse
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional
+
+from loguru import logger
+
+STATUS_FILE = "daemon_status.json"
+
+
+class TaskDaemon:
+    """Poll the ledger for `task_ids` and run the pipeline of every task that is due, in-process.
+
+    A task is due until one run of it succeeds, or again `rerun_interval` seconds after
+    that. A poll that finds nothing to do or fails doubles the wait, up to `max_interval`,
+    and a poll that ran a task resets it. The state is written to `status_file` on every
+    change; completed runs recorded there survive a restart.
+    """
+
+    def __init__(
+        self,
+        task_ids: List[int],
+        run_task: Callable[[int], None],
+        fetch_task: Callable[[int], Dict],
+        status_file: str = STATUS_FILE,
+        poll_interval: float = 60.0,
+        max_interval: float = 900.0,
+        rerun_interval: Optional[float] = None,
+        max_attempts: int = 3,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.task_ids = task_ids
+        self.run_task = run_task
+        self.fetch_task = fetch_task
+        self.status_file = status_file
+        self.poll_interval = poll_interval
+        self.max_interval = max_interval
+        self.rerun_interval = rerun_interval
+        self.max_attempts = max_attempts
+        self.sleep = sleep
+        self.interval = poll_interval
+        self.lock = threading.Lock()
+        self.status = {
+            "pid": os.getpid(),
+            "state": "starting",
+            "current_task": None,
+            "started_at": time.time(),
+            "last_poll_at": None,
+            "next_poll_at": None,
+            "interval": self.interval,
+            "consecutive_idle_polls": 0,
+            "last_error": None,
+            "tasks": self.load_tasks(),
+        }
+
+    def load_tasks(self) -> Dict[str, Dict]:
+        if not os.path.exists(self.status_file):
+            return {}
+        with open(self.status_file) as f:
+            tasks = json.load(f).get("tasks", {})
+        # attempts of a previous process do not count against this one
+        for record in tasks.values():
+            record["attempts"] = 0
+        return tasks
+
+    def update(self, **fields):
+        with self.lock:
+            self.status.update(fields, updated_at=time.time())
+            # written aside and renamed, readers never see a partial file
+            tmp = f"{self.status_file}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.status, f, indent=2)
+            os.replace(tmp, self.status_file)
+
+    def snapshot(self) -> Dict:
+        with self.lock:
+            return json.loads(json.dumps(self.status))
+
+    def task_record(self, task_id) -> Dict:
+        return self.status["tasks"].setdefault(
+            str(task_id),
+            {
+                "runs": 0,
+                "failures": 0,
+                "attempts": 0,
+                "last_success_at": None,
+                "last_error": None,
+            },
+        )
+
+    def is_due(self, task_id, task: Dict) -> bool:
+        if "data" not in task:
+            return False
+        record = self.task_record(task_id)
+        if record["attempts"] >= self.max_attempts:
+            return False
+        if record["last_success_at"] is None:
+            return True
+        return (
+            self.rerun_interval is not None
+            and time.time() - record["last_success_at"] >= self.rerun_interval
+        )
+
+    def run_one(self, task_id):
+        record = self.task_record(task_id)
+        record["attempts"] += 1
+        self.update(state="running", current_task=task_id)
+        logger.info(f"Running task {task_id} (attempt {record['attempts']})")
+        start = time.time()
+        try:
+            self.run_task(task_id)
+        except Exception as e:
+            logger.error(f"Task {task_id} failed: {e}")
+            record["failures"] += 1
+            record["last_error"] = str(e)
+            return False
+        else:
+            record["runs"] += 1
+            record["attempts"] = 0
+            record["last_success_at"] = time.time()
+            record["last_error"] = None
+            return True
+        finally:
+            record["last_duration_s"] = time.time() - start
+            self.update(state="polling", current_task=None)
+
+    def poll(self) -> bool:
+        """Fetch every task once and run the due ones, return whether a run succeeded."""
+        self.update(state="polling", last_poll_at=time.time())
+        succeeded = False
+        for task_id in self.task_ids:
+            try:
+                task = self.fetch_task(task_id)
+            except Exception as e:
+                logger.warning(f"Failed to fetch task {task_id}: {e}")
+                self.update(last_error=f"fetch task {task_id}: {e}")
+                continue
+            if self.is_due(task_id, task):
+                succeeded = self.run_one(task_id) or succeeded
+        return succeeded
+
+    def run(self, max_polls: Optional[int] = None):
+        polls = 0
+        try:
+            while max_polls is None or polls < max_polls:
+                if self.poll():
+                    self.interval, idle = self.poll_interval, 0
+                else:
+                    self.interval = min(self.interval * 2, self.max_interval)
+                    idle = self.status["consecutive_idle_polls"] + 1
+                polls += 1
+                if max_polls is not None and polls >= max_polls:
+                    self.update(consecutive_idle_polls=idle, interval=self.interval)
+                    break
+                self.update(
+                    state="sleeping",
+                    consecutive_idle_polls=idle,
+                    interval=self.interval,
+                    next_poll_at=time.time() + self.interval,
+                )
+                self.sleep(self.interval)
+        finally:
+            self.update(state="stopped", next_poll_at=None)
+
+
+def serve_status(
+    daemon: TaskDaemon, port: int, host: str = "127.0.0.1"
+) -> ThreadingHTTPServer:
+    """Serve the daemon status as JSON on GET /status from a background thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip("/") not in ("", "/status"):
+                self.send_error(404)
+                return
+            body = json.dumps(daemon.snapshot()).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Serving daemon status on http://{host}:{server.server_port}/status")
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--task-ids", default=os.environ.get("TASK_IDS", os.environ.get("TASK_ID", ""))
+    )
+    parser.add_argument(
+        "--status-file", default=os.environ.get("STATUS_FILE", STATUS_FILE)
+    )
+    parser.add_argument(
+        "--status-port", type=int, default=int(os.environ.get("STATUS_PORT", 0))
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=float(os.environ.get("POLL_INTERVAL", 60)),
+    )
+    parser.add_argument(
+        "--max-interval",
+        type=float,
+        default=float(os.environ.get("MAX_POLL_INTERVAL", 900)),
+    )
+    parser.add_argument("--rerun-interval", type=float, default=None)
+    parser.add_argument(
+        "--warm-models", type=int, default=int(os.environ.get("WARM_MODELS", 1))
+    )
+    args = parser.parse_args()
+
+    task_ids = [int(task_id) for task_id in args.task_ids.split(",") if task_id.strip()]
+    if not task_ids:
+        parser.error("no task ids, set --task-ids or TASK_IDS")
+
+    # imported once here, every task reuses the loaded torch/transformers stack
+    import full_automation
+    from demo import keep_models_warm
+    from utils.flock_api import get_task
+    from utils.metrics import start_exporter
+
+    keep_models_warm(args.warm_models)
+    # METRICS_PORT / METRICS_TEXTFILE
+    start_exporter()
+    daemon = TaskDaemon(
+        task_ids,
+        run_task=full_automation.run_task,
+        fetch_task=get_task,
+        status_file=args.status_file,
+        poll_interval=args.poll_interval,
+        max_interval=args.max_interval,
+        rerun_interval=args.rerun_interval,
+    )
+    if args.status_port:
+        serve_status(daemon, args.status_port)
+    daemon.run()
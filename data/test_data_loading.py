@@ -1,10 +1,15 @@
+import os
+
 import pytest
 import json
 
 
 @pytest.fixture
 def load_data():
-    with open("function_calling_demo.jsonl", "r", encoding="utf8") as f:
+    path = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "function_calling_demo.jsonl"
+    )
+    with open(path, "r", encoding="utf8") as f:
         data_list = f.readlines()
     return data_list
 
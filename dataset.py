@@ -1,34 +1,41 @@
+import gzip
 import json
-from typing import Any, Dict, List
+import multiprocessing as mp
+import os
+import random
+from array import array
+from collections import deque
+from typing import Any, Dict, List, Optional, Sequence, Union
 
+import numpy as np
 import torch
+import torch.distributed as dist
 from loguru import logger
-from torch.utils.data import Dataset
-from utils.tool_utils import function_formatter
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+from transformers import TrainerCallback
+from utils.cache_manager import CacheManager
+from utils.sample_cache import SampleCache
+from utils.token_store import TokenStore
+from utils.tool_utils import format_function_call
 
 
-class SFTDataset(Dataset):
-    def __init__(self, file, tokenizer, max_seq_length, template):
+class ConversationTokenizer(object):
+    """Turns one JSONL conversation into `input_ids` and an assistant-only `target_mask`."""
+
+    def __init__(self, tokenizer, max_seq_length, template):
         self.tokenizer = tokenizer
         self.template = template
         self.max_seq_length = max_seq_length
-        logger.info("Loading data: {}".format(file))
-        with open(file, "r", encoding="utf8") as f:
-            data_list = f.readlines()
-        logger.info("There are {} data in dataset".format(len(data_list)))
-        self.data_list = data_list
 
-    def __len__(self):
-        return len(self.data_list)
-
-    def __getitem__(self, index):
-        data = self.data_list[index]
+    def tokenize(self, data):
         data = json.loads(data)
         input_ids, target_mask = [], []
 
         # setting system information
         if self.template["system_format"] is not None:
-            system = data["system"].strip() if "system" in data else self.template["system"]
+            system = (
+                data["system"].strip() if "system" in data else self.template["system"]
+            )
 
             if system is not None:
                 system_text = self.template["system_format"].format(content=system)
@@ -50,12 +57,16 @@ class SFTDataset(Dataset):
                     input_buffer += human
 
                 elif role == "function_call":
-                    tool_calls = function_formatter(json.loads(content))
-                    function = self.template["function_format"].format(content=tool_calls)
+                    tool_calls = format_function_call(content)
+                    function = self.template["function_format"].format(
+                        content=tool_calls
+                    )
                     input_buffer += function
 
                 elif role == "observation":
-                    observation = self.template["observation_format"].format(content=content)
+                    observation = self.template["observation_format"].format(
+                        content=content
+                    )
                     input_buffer += observation
             else:
                 assistant = self.template["assistant_format"].format(
@@ -77,55 +88,447 @@ class SFTDataset(Dataset):
 
         input_ids = input_ids[: self.max_seq_length]
         target_mask = target_mask[: self.max_seq_length]
-        attention_mask = [1] * len(input_ids)
-        assert len(input_ids) == len(target_mask) == len(attention_mask)
+        # attention_mask is all ones before padding, the collator derives it from the length
         inputs = {
             "input_ids": input_ids,
-            "attention_mask": attention_mask,
             "target_mask": target_mask,
         }
         return inputs
 
 
+class SFTDataset(ConversationTokenizer, Dataset):
+    def __init__(
+        self, file, tokenizer, max_seq_length, template, cache_size_mb=0, cache=None
+    ):
+        super().__init__(tokenizer, max_seq_length, template)
+        self.file = file
+        logger.info("Loading data: {}".format(file))
+        # keep only line offsets, each DataLoader worker reads lines through its own handle
+        self.offsets = array("q")
+        with open(file, "rb") as f:
+            offset = 0
+            for line in f:
+                self.offsets.append(offset)
+                offset += len(line)
+        logger.info("There are {} data in dataset".format(len(self.offsets)))
+        self._handle = None
+        self._handle_pid = None
+        # samples are identical every epoch, so optionally keep them tokenized
+        # or take over one filled ahead of training (utils/prepare.py)
+        self.cache = cache
+        if cache is None and cache_size_mb > 0:
+            self.cache = SampleCache(
+                len(self.offsets), int(cache_size_mb * 1024 * 1024)
+            )
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_handle"] = None
+        state["_handle_pid"] = None
+        return state
+
+    def read_line(self, index):
+        # open lazily and per process, a handle inherited through fork shares its offset
+        if self._handle is None or self._handle_pid != os.getpid():
+            self._handle = open(self.file, "rb")
+            self._handle_pid = os.getpid()
+        self._handle.seek(self.offsets[index])
+        return self._handle.readline().decode("utf8")
+
+    def __getitem__(self, index):
+        if self.cache is not None:
+            cached = self.cache.get(index)
+            if cached is not None:
+                input_ids, target_mask = cached
+                return {"input_ids": input_ids, "target_mask": target_mask}
+
+        inputs = self.tokenize(self.read_line(index))
+        if self.cache is not None:
+            self.cache.put(index, inputs["input_ids"], inputs["target_mask"])
+        return inputs
+
+
+class CompiledSFTDataset(ConversationTokenizer, Dataset):
+    """Samples of `file` compiled ahead into a TokenStore kept across runs (utils/token_store.py).
+
+    Only rows the store has never seen are tokenized, the rest are sliced out of its
+    memory-mapped arrays. The store is held (see utils/cache_manager.py) until `close`.
+    """
+
+    # rows are read already tokenized, there is nothing to cache
+    cache = None
+
+    def __init__(self, file, tokenizer, max_seq_length, template, root=None):
+        super().__init__(tokenizer, max_seq_length, template)
+        self.file = file
+        self.store = TokenStore.for_tokenization(
+            tokenizer, template, max_seq_length, root
+        )
+        self._holds = CacheManager(root)
+        self._holds.acquire(f"shared/{os.path.basename(self.store.path)}")
+        self.starts, self.lengths = self.store.compile(file, self.tokenize)
+        self.num_tokens = self.store.meta()["tokens"]
+        self._arrays = None
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_holds"] = None
+        state["_arrays"] = None
+        return state
+
+    def __getitem__(self, index):
+        # mapped lazily, so DataLoader workers map the files themselves
+        if self._arrays is None:
+            self._arrays = self.store.arrays(self.num_tokens)
+        ids, mask = self._arrays
+        start, length = int(self.starts[index]), int(self.lengths[index])
+        # copied out of the read-only maps, like SampleCache hands out its samples
+        return {
+            "input_ids": np.array(ids[start : start + length]),
+            "target_mask": np.array(mask[start : start + length]),
+        }
+
+    def close(self):
+        self._arrays = None
+        if self._holds is not None:
+            self._holds.release()
+
+
+def open_jsonl(path):
+    # binary, so line offsets are byte offsets (of the decompressed stream for .gz)
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+class _ShardState(object):
+    """Read cursor, shuffle buffer and RNG of one shard, as of the last sample yielded."""
+
+    def __init__(self, epoch, rng):
+        self.epoch = epoch
+        self.rng = rng
+        self.file = 0
+        self.offset = 0
+        self.line = 0
+        self.emitted = 0
+        # (file index, byte offset, raw line)
+        self.buffer = []
+
+    def state_dict(self):
+        version, internal, gauss = self.rng.getstate()
+        return {
+            "epoch": self.epoch,
+            "file": self.file,
+            "offset": self.offset,
+            "line": self.line,
+            "emitted": self.emitted,
+            "rng": [version, list(internal), gauss],
+            "buffer": [[file, offset] for file, offset, _ in self.buffer],
+        }
+
+
+class StreamingSFTDataset(ConversationTokenizer, IterableDataset):
+    """Conversations streamed from JSONL (or .jsonl.gz) files and tokenized on the fly.
+
+    Memory stays at `shuffle_buffer` raw lines whatever the corpus size. Non-empty
+    lines are dealt round-robin to the `world_size * num_workers` shards of a run, so
+    every DataLoader worker of every rank sees a disjoint part of each epoch, and each
+    shard shuffles through its own buffer.
+
+    `state_dict()` records every shard iterated in this process by file, byte offset,
+    RNG state and buffer line offsets, `load_state_dict()` restarts them exactly there
+    without reading the lines before the offset again (gzip files are still decompressed
+    up to it). With DataLoader workers the shards live in the workers, so take the state
+    with `num_workers=0`.
+
+    `keep_states` keeps that many past states, one every `state_interval` samples and
+    at the start and end of an epoch. A state between two kept ones resumes from the
+    earlier one and replays the samples in between without tokenizing them.
+    """
+
+    def __init__(
+        self,
+        files: Union[str, Sequence[str]],
+        tokenizer,
+        max_seq_length,
+        template,
+        shuffle_buffer: int = 1024,
+        seed: int = 0,
+        rank: Optional[int] = None,
+        world_size: Optional[int] = None,
+        keep_states: int = 0,
+        state_interval: int = 1,
+    ):
+        super().__init__(tokenizer, max_seq_length, template)
+        self.files = [files] if isinstance(files, str) else list(files)
+        self.shuffle_buffer = max(1, shuffle_buffer)
+        self.seed = seed
+        if rank is None or world_size is None:
+            if dist.is_available() and dist.is_initialized():
+                rank, world_size = dist.get_rank(), dist.get_world_size()
+            else:
+                rank = int(os.environ.get("RANK", 0))
+                world_size = int(os.environ.get("WORLD_SIZE", 1))
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+        # set_epoch counts from the epoch a loaded state was saved in
+        self._first_epoch = 0
+        self._shards: Dict[int, _ShardState] = {}
+        self._resume: Dict[int, Dict] = {}
+        self._skip = 0
+        self._num_shards = None
+        # the trainer fetches ahead of the step it checkpoints, so keep the last states by sample count
+        self._samples = 0
+        self._history = deque(maxlen=keep_states) if keep_states > 0 else None
+        self.state_interval = max(1, state_interval)
+
+    def set_epoch(self, epoch: int):
+        self.epoch = self._first_epoch + epoch
+
+    def count_lines(self) -> int:
+        """Non-empty lines over all files (all shards), one streaming pass."""
+        count = 0
+        for path in self.files:
+            with open_jsonl(path) as f:
+                count += sum(1 for line in f if line.strip())
+        return count
+
+    def state_dict(self, samples: Optional[int] = None) -> Optional[Dict]:
+        """The state after the last sample yielded, or after the `samples`-th one if a state before it is kept."""
+        if samples is not None and samples != self._samples:
+            if self._history is not None and samples < self._samples:
+                for count, state in reversed(self._history):
+                    if count <= samples:
+                        return dict(state, skip=samples - count)
+            return None
+        return {
+            "seed": self.seed,
+            "num_shards": self._num_shards,
+            "samples": self._samples,
+            "shards": {
+                str(shard): state.state_dict() for shard, state in self._shards.items()
+            },
+        }
+
+    def load_state_dict(self, state: Dict):
+        if state["seed"] != self.seed:
+            raise ValueError(
+                f"State was saved with seed {state['seed']}, this dataset uses {self.seed}"
+            )
+        self._num_shards = state["num_shards"]
+        self._samples = state["samples"]
+        self._skip = state.get("skip", 0)
+        self._resume = {
+            int(shard): shard_state for shard, shard_state in state["shards"].items()
+        }
+        if self._resume:
+            self.epoch = max(
+                shard_state["epoch"] for shard_state in self._resume.values()
+            )
+            if all(
+                self._finished(shard_state) for shard_state in self._resume.values()
+            ):
+                # saved at the end of an epoch, resume at the start of the next one
+                self._resume = {}
+                self.epoch += 1
+        self._first_epoch = self.epoch
+
+    def _finished(self, shard_state: Dict) -> bool:
+        return shard_state["file"] >= len(self.files) and not shard_state["buffer"]
+
+    def _restore(self, resume: Dict) -> _ShardState:
+        version, internal, gauss = resume["rng"]
+        rng = random.Random()
+        rng.setstate((version, tuple(internal), gauss))
+        shard = _ShardState(resume["epoch"], rng)
+        for key in ("file", "offset", "line", "emitted"):
+            setattr(shard, key, resume[key])
+        # read the buffered lines back in file order, gzip can only seek forward cheaply
+        pointers = [tuple(pointer) for pointer in resume["buffer"]]
+        lines = {}
+        for file in sorted({file for file, _ in pointers}):
+            with open_jsonl(self.files[file]) as f:
+                for offset in sorted(
+                    offset for pointer_file, offset in pointers if pointer_file == file
+                ):
+                    f.seek(offset)
+                    lines[file, offset] = f.readline()
+        shard.buffer = [
+            (file, offset, lines[file, offset]) for file, offset in pointers
+        ]
+        return shard
+
+    def __iter__(self):
+        worker = get_worker_info()
+        num_workers, worker_id = (
+            (worker.num_workers, worker.id) if worker is not None else (1, 0)
+        )
+        num_shards = self.world_size * num_workers
+        shard_id = self.rank * num_workers + worker_id
+        if self._num_shards not in (None, num_shards):
+            if self._resume:
+                raise ValueError(
+                    f"State was saved with {self._num_shards} shards, this run has {num_shards}"
+                )
+        self._num_shards = num_shards
+
+        resume = self._resume.pop(shard_id, None)
+        if resume is not None and resume["epoch"] == self.epoch:
+            shard = self._restore(resume)
+        else:
+            shard = _ShardState(
+                self.epoch, random.Random(f"{self.seed}:{self.epoch}:{shard_id}")
+            )
+        self._shards = {shard_id: shard}
+        skip, self._skip = self._skip, 0
+        return self._samples_of(
+            shard, self._iter_shard(shard, shard_id, num_shards), skip
+        )
+
+    def _keep_state(self):
+        if self._history is not None:
+            self._history.append((self._samples, self.state_dict()))
+
+    def _samples_of(self, shard: _ShardState, items, skip: int):
+        self._keep_state()
+        for item in items:
+            shard.emitted += 1
+            self._samples += 1
+            if self._samples % self.state_interval == 0 or (
+                shard.file >= len(self.files) and not shard.buffer
+            ):
+                self._keep_state()
+            if skip:
+                # trained on before the state was saved, only the shuffle needs replaying
+                skip -= 1
+                continue
+            yield self.tokenize(item[2].decode("utf8"))
+
+    def _iter_shard(self, shard: _ShardState, shard_id: int, num_shards: int):
+        buffer, rng = shard.buffer, shard.rng
+        while shard.file < len(self.files):
+            with open_jsonl(self.files[shard.file]) as f:
+                if shard.offset:
+                    f.seek(shard.offset)
+                for line in f:
+                    start = shard.offset
+                    shard.offset += len(line)
+                    if not line.strip():
+                        continue
+                    shard.line += 1
+                    if (shard.line - 1) % num_shards != shard_id:
+                        continue
+                    entry = (shard.file, start, line)
+                    if len(buffer) < self.shuffle_buffer:
+                        buffer.append(entry)
+                        continue
+                    index = rng.randrange(len(buffer))
+                    item, buffer[index] = buffer[index], entry
+                    yield item
+            shard.file += 1
+            shard.offset = 0
+        # drain what is left in random order
+        while buffer:
+            index = rng.randrange(len(buffer))
+            buffer[index], buffer[-1] = buffer[-1], buffer[index]
+            yield buffer.pop()
+
+
+STREAM_STATE_FILE = "stream_state.json"
+
+
+class StreamStateCallback(TrainerCallback):
+    """Saves the StreamingSFTDataset state of every checkpoint as `stream_state.json` in it.
+
+    Batches are dispatched from the main process, which reads `per_device_train_batch_size
+    * world_size` samples per micro-batch, so the dataset needs `keep_states` covering the
+    batches fetched ahead of the step being saved. With `samples_per_epoch` an epoch may
+    end on a partial micro-batch.
+    """
+
+    def __init__(
+        self, dataset: StreamingSFTDataset, samples_per_epoch: Optional[int] = None
+    ):
+        self.dataset = dataset
+        self.samples_per_epoch = samples_per_epoch
+
+    def on_save(self, args, state, control, **kwargs):
+        if not state.is_world_process_zero:
+            return
+        micro_batch = args.per_device_train_batch_size * args.world_size
+        batches = state.global_step * args.gradient_accumulation_steps
+        samples = batches * micro_batch
+        if self.samples_per_epoch:
+            # the trainer accumulates gradients across the end of an iterable epoch
+            epochs, batches = divmod(batches, -(-self.samples_per_epoch // micro_batch))
+            samples = epochs * self.samples_per_epoch + batches * micro_batch
+        stream_state = self.dataset.state_dict(samples=samples)
+        if stream_state is None:
+            logger.warning(
+                f"No stream state kept for sample {samples}, checkpoint saved without one"
+            )
+            return
+        checkpoint_dir = os.path.join(
+            args.output_dir, f"checkpoint-{state.global_step}"
+        )
+        with open(os.path.join(checkpoint_dir, STREAM_STATE_FILE), "w") as f:
+            json.dump(stream_state, f)
+
+
+def load_stream_state(dataset: StreamingSFTDataset, checkpoint_dir: str) -> bool:
+    """Restore the position `StreamStateCallback` saved in `checkpoint_dir`, False if it has none."""
+    path = os.path.join(checkpoint_dir, STREAM_STATE_FILE)
+    if not os.path.exists(path):
+        return False
+    with open(path) as f:
+        dataset.load_state_dict(json.load(f))
+    return True
+
+
 class SFTDataCollator(object):
-    def __init__(self, tokenizer, max_seq_length):
+    def __init__(self, tokenizer, max_seq_length, count_tokens=False):
         self.tokenizer = tokenizer
         self.max_seq_length = max_seq_length
         self.pad_token_id = tokenizer.pad_token_id
+        # shared counters, batches are collated in the dataloader workers
+        self.samples_seen = mp.Value("q", 0) if count_tokens else None
+        self.tokens_seen = mp.Value("q", 0) if count_tokens else None
 
     def __call__(self, batch: List[Dict[str, Any]]) -> Dict[str, Any]:
+        if any(x["input_ids"] is None for x in batch):
+            logger.info("some input_ids is None")
+            batch = [x for x in batch if x["input_ids"] is not None]
         # Find the maximum length in the batch
-        lengths = [len(x["input_ids"]) for x in batch if x["input_ids"] is not None]
+        lengths = [min(len(x["input_ids"]), self.max_seq_length) for x in batch]
         # Take the maximum length in the batch, if it exceeds max_seq_length, take max_seq_length
-        batch_max_len = min(max(lengths), self.max_seq_length)
-
-        input_ids_batch, attention_mask_batch, target_mask_batch = [], [], []
-        # Truncate and pad
-        for x in batch:
-            input_ids = x["input_ids"]
-            attention_mask = x["attention_mask"]
-            target_mask = x["target_mask"]
-            if input_ids is None:
-                logger.info("some input_ids is None")
-                continue
-            padding_len = batch_max_len - len(input_ids)
-            # Pad
-            input_ids = input_ids + [self.pad_token_id] * padding_len
-            attention_mask = attention_mask + [0] * padding_len
-            target_mask = target_mask + [0] * padding_len
+        batch_max_len = max(lengths)
+
+        # Pad by filling preallocated tensors, samples may be lists or numpy buffers
+        input_ids_batch = torch.full(
+            (len(batch), batch_max_len), self.pad_token_id, dtype=torch.long
+        )
+        attention_mask_batch = torch.zeros(
+            (len(batch), batch_max_len), dtype=torch.long
+        )
+        target_mask_batch = torch.zeros((len(batch), batch_max_len), dtype=torch.long)
+        for i, (x, length) in enumerate(zip(batch, lengths)):
             # Truncate
-            input_ids = input_ids[: self.max_seq_length]
-            attention_mask = attention_mask[: self.max_seq_length]
-            target_mask = target_mask[: self.max_seq_length]
-
-            input_ids_batch.append(input_ids)
-            attention_mask_batch.append(attention_mask)
-            target_mask_batch.append(target_mask)
-
-        # Convert lists to tensors to get the final model input
-        input_ids_batch = torch.tensor(input_ids_batch, dtype=torch.long)
-        attention_mask_batch = torch.tensor(attention_mask_batch, dtype=torch.long)
-        target_mask_batch = torch.tensor(target_mask_batch, dtype=torch.long)
+            input_ids_batch[i, :length] = torch.as_tensor(x["input_ids"][:length])
+            target_mask_batch[i, :length] = torch.as_tensor(x["target_mask"][:length])
+            attention_mask_batch[i, :length] = 1
+
+        if self.tokens_seen is not None:
+            with self.tokens_seen.get_lock():
+                self.tokens_seen.value += sum(lengths)
+            with self.samples_seen.get_lock():
+                self.samples_seen.value += len(batch)
 
         labels = torch.where(target_mask_batch == 1, input_ids_batch, -100)
         inputs = {
@@ -1,13 +1,45 @@
+import contextlib
+import math
 import os
+import time
+from collections import OrderedDict
 from dataclasses import dataclass
+from typing import Optional
 
+import numpy as np
 import torch
-from peft import LoraConfig
-from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+from loguru import logger
+from peft import LoraConfig, PeftModel, prepare_model_for_kbit_training
+from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers.trainer_utils import get_last_checkpoint
 from trl import SFTTrainer, SFTConfig
+from trl.trainer.utils import peft_module_casting_to_bf16
 
-from dataset import SFTDataCollator, SFTDataset
+from dataset import (
+    CompiledSFTDataset,
+    SFTDataCollator,
+    SFTDataset,
+    StreamingSFTDataset,
+    StreamStateCallback,
+    load_stream_state,
+)
+from utils.adapter_export import export_adapter
+from utils.chunked_loss import ChunkedLossSFTTrainer
 from utils.constants import model2template
+from utils.device_utils import backend_kwargs, configure_cpu_threads, resolve_device
+from utils.distributed import (
+    all_reduce_sum,
+    is_distributed,
+    is_main_process,
+    local_rank,
+    rank_cpus,
+)
+from utils.local_eval import evaluate_model
+from utils.metrics import TrainingMetricsCallback
+from utils.profiling import ProfilerCallback, profile_data_pipeline
+from utils.run_ledger import span
+from utils.sample_cache import SampleCache
+from utils.time_budget import TimeBudgetCallback
 
 
 @dataclass
@@ -18,21 +50,53 @@ class LoraTrainingArguments:
     lora_rank: int
     lora_alpha: int
     lora_dropout: int
+    learning_rate: float = 2e-4
+    warmup_steps: int = 100
+    # in-memory tokenized sample cache shared by dataloader workers, 0 disables it
+    sample_cache_mb: int = 0
+    # tokenize into a store kept across runs (utils/token_store.py), only new or changed rows are tokenized
+    compiled_dataset: bool = False
+    # tokenization runs in the dataloader workers, overlapped with the training step
+    dataloader_num_workers: int = 0
+    dataloader_prefetch_factor: Optional[int] = None
+    dataloader_pin_memory: bool = True
+    dataloader_persistent_workers: bool = False
+    # profile this many training steps plus the data pipeline, also set by PROFILE_STEPS
+    profile_steps: int = 0
+    # "cuda" trains qLoRA, "cpu" trains unquantized; None picks cuda when available
+    device: Optional[str] = None
+    cpu_dtype: str = "float32"
+    # adapter export: cast to bfloat16/float16 and/or SVD-truncate ranks within an error bound
+    export_dtype: Optional[str] = None
+    export_max_rank: Optional[int] = None
+    export_max_error: Optional[float] = None
+    # project and score only the assistant positions, in chunks, never building [B, L, V] logits
+    chunked_loss: bool = False
+    loss_chunk_size: int = 1024
+    # stream the data file through a shuffle buffer instead of indexing it, for corpora larger than RAM
+    streaming: bool = False
+    shuffle_buffer: int = 1024
+    # train over this many DDP processes (devices, or core sets on CPU) launched with torchrun
+    nproc_per_node: int = 1
+    # continue from the task's last adapter for warm_start_epochs on its new rows (utils/warm_start.py)
+    warm_start: bool = False
+    warm_start_epochs: int = 1
+    # share of the rows the parent adapter already trained on that are trained on again
+    warm_start_replay: float = 0.25
+    # train for as many steps as fit in this many seconds from the call, at most
+    # time_budget_max_epochs (num_train_epochs by default) epochs (utils/time_budget.py)
+    time_budget_s: Optional[float] = None
+    time_budget_max_epochs: Optional[float] = None
 
 
-def train_lora(
-    model_id: str, context_length: int, training_args: LoraTrainingArguments
-):
-    assert model_id in model2template, f"model_id {model_id} not supported"
-    template = model2template[model_id]
-    
+def build_lora_config(model_id: str, training_args: LoraTrainingArguments):
     # 根据模型ID选择正确的target_modules
     if "phi" in model_id.lower():
         target_modules = ["q_proj", "k_proj", "v_proj", "o_proj"]  # Phi模型的目标模块
     else:
         target_modules = ["q_proj", "v_proj"]  # 其他模型的默认目标模块
-    
-    lora_config = LoraConfig(
+
+    return LoraConfig(
         r=training_args.lora_rank,
         target_modules=target_modules,  # 使用根据模型选择的目标模块
         lora_alpha=training_args.lora_alpha,
@@ -40,66 +104,360 @@ def train_lora(
         task_type="CAUSAL_LM",
     )
 
-    # Load model in 4-bit to do qLoRA
-    bnb_config = BitsAndBytesConfig(
-        load_in_4bit=True,
-        bnb_4bit_quant_type="nf4",
-        bnb_4bit_compute_dtype=torch.bfloat16,
+
+def load_trainable_adapter(model, adapter_dir: str, config_kwargs: dict):
+    """Wrap `model` with the adapter in `adapter_dir` to train further, prepared as SFTTrainer prepares a new one."""
+    if getattr(model, "is_loaded_in_4bit", False):
+        model = prepare_model_for_kbit_training(
+            model,
+            use_gradient_checkpointing=config_kwargs.get(
+                "gradient_checkpointing", False
+            ),
+        )
+    elif config_kwargs.get("gradient_checkpointing", False):
+        model.enable_input_require_grads()
+    model = PeftModel.from_pretrained(model, adapter_dir, is_trainable=True)
+    if config_kwargs.get("bf16") and getattr(model, "is_loaded_in_4bit", False):
+        peft_module_casting_to_bf16(model)
+    return model
+
+
+def load_model(model_id: str, device: str, cpu_dtype: str = "float32"):
+    """Load tokenizer and base model for `device`, plus the SFTConfig kwargs of that backend."""
+    # Load model in 4-bit to do qLoRA on CUDA, unquantized with AdamW on CPU
+    # under torchrun every rank loads its own copy onto its own device or cores
+    model_kwargs, config_kwargs = backend_kwargs(device, cpu_dtype, local_rank())
+    if device == "cpu":
+        configure_cpu_threads(rank_cpus())
+
+    tokenizer = AutoTokenizer.from_pretrained(
+        model_id,
+        use_fast=True,
     )
+    model = AutoModelForCausalLM.from_pretrained(
+        model_id,
+        token=os.environ.get("HF_TOKEN"),
+        **model_kwargs,
+    )
+    return model, tokenizer, config_kwargs
+
 
-    training_args = SFTConfig(
+# base models kept loaded between train_lora calls of a long-lived process (daemon.py)
+_warm_models = OrderedDict()
+_warm_models_limit = 0
+
+
+def keep_models_warm(max_models: int = 1):
+    """Keep up to `max_models` base models in memory after training, least recently used dropped first."""
+    global _warm_models_limit
+    _warm_models_limit = max_models
+    while len(_warm_models) > max_models:
+        _warm_models.popitem(last=False)
+
+
+def take_model(model_id: str, device: str, cpu_dtype: str = "float32"):
+    """`load_model`, served from the warm models when one is kept for the same backend."""
+    key = (model_id, device, cpu_dtype)
+    if key in _warm_models:
+        logger.info(f"Reusing warm base model {model_id}")
+        # taken out while training, the LoRA layers go into it in place
+        return _warm_models.pop(key)
+    return load_model(model_id, device, cpu_dtype)
+
+
+def release_model(
+    model_id: str, device: str, cpu_dtype: str, model, tokenizer, config_kwargs
+):
+    if _warm_models_limit <= 0:
+        return
+    # strip every adapter so the next task starts from the clean base weights
+    if hasattr(model, "unload"):
+        model = model.unload()
+    _warm_models[(model_id, device, cpu_dtype)] = (model, tokenizer, config_kwargs)
+    while len(_warm_models) > _warm_models_limit:
+        _warm_models.popitem(last=False)
+
+
+def build_sft_config(
+    training_args: LoraTrainingArguments,
+    context_length: int,
+    output_dir: str,
+    device: str,
+    config_kwargs: dict,
+    **overrides,
+):
+    num_workers = training_args.dataloader_num_workers
+    kwargs = dict(
         per_device_train_batch_size=training_args.per_device_train_batch_size,
         gradient_accumulation_steps=training_args.gradient_accumulation_steps,
-        warmup_steps=100,
-        learning_rate=2e-4,
-        bf16=True,
+        warmup_steps=training_args.warmup_steps,
+        learning_rate=training_args.learning_rate,
         logging_steps=20,
-        output_dir="outputs",
-        optim="paged_adamw_8bit",
+        output_dir=output_dir,
         remove_unused_columns=False,
         num_train_epochs=training_args.num_train_epochs,
         max_seq_length=context_length,
+        dataloader_num_workers=num_workers,
+        dataloader_prefetch_factor=(
+            training_args.dataloader_prefetch_factor if num_workers > 0 else None
+        ),
+        dataloader_pin_memory=training_args.dataloader_pin_memory and device == "cuda",
+        dataloader_persistent_workers=(
+            training_args.dataloader_persistent_workers and num_workers > 0
+        ),
+        **config_kwargs,
     )
-    tokenizer = AutoTokenizer.from_pretrained(
-        model_id,
-        use_fast=True,
-    )
-    model = AutoModelForCausalLM.from_pretrained(
-        model_id,
-        quantization_config=bnb_config,
-        device_map={"": 0},
-        token=os.environ["HF_TOKEN"],
-    )
+    if is_distributed():
+        # only the LoRA parameters require grad and all of them are used every step
+        kwargs["ddp_find_unused_parameters"] = False
+        if device == "cpu":
+            kwargs["ddp_backend"] = "gloo"
+    kwargs.update(overrides)
+    return SFTConfig(**kwargs)
 
-    # Load dataset
-    dataset = SFTDataset(
-        file="data/demo_data.jsonl",
+
+def build_streaming_dataset(
+    data_file, tokenizer, context_length, template, training_args
+):
+    # the trainer's accelerator dispatches the batches of an iterable dataset from the main
+    # process to every rank, so this process reads the whole stream as a single shard
+    micro_batch = training_args.per_device_train_batch_size * int(
+        os.environ.get("WORLD_SIZE", 1)
+    )
+    return StreamingSFTDataset(
+        data_file,
         tokenizer=tokenizer,
         max_seq_length=context_length,
         template=template,
+        shuffle_buffer=training_args.shuffle_buffer,
+        rank=0,
+        world_size=1,
+        # a state per buffer's worth of samples, covering the batches the dataloader fetches
+        # ahead of a checkpointed step; resuming replays at most one interval untokenized
+        keep_states=8,
+        state_interval=max(training_args.shuffle_buffer, micro_batch),
+    )
+
+
+def checkpoint_rng_globals():
+    """Let the trainer read back the numpy RNG state it saved in a checkpoint.
+
+    transformers <= 4.45 loads it with torch.load's defaults, which torch >= 2.6 restricts to tensors.
+    """
+    safe_globals = getattr(torch.serialization, "safe_globals", None)
+    if safe_globals is None:
+        return contextlib.nullcontext()
+    reconstruct = np.ndarray(0).__reduce__()[0]
+    return safe_globals([reconstruct, np.ndarray, np.dtype, type(np.dtype(np.uint32))])
+
+
+def build_trainer(training_args: LoraTrainingArguments, **kwargs):
+    """SFTTrainer, or its chunked-loss variant when `training_args.chunked_loss` is set."""
+    if training_args.chunked_loss:
+        return ChunkedLossSFTTrainer(
+            loss_chunk_size=training_args.loss_chunk_size, **kwargs
+        )
+    return SFTTrainer(**kwargs)
+
+
+def train_lora(
+    model_id: str,
+    context_length: int,
+    training_args: LoraTrainingArguments,
+    data_file: str = "data/demo_data.jsonl",
+    output_dir: str = "outputs",
+    eval_file: Optional[str] = None,
+    sample_cache: Optional[SampleCache] = None,
+    init_adapter: Optional[str] = None,
+):
+    """Train a LoRA adapter into `output_dir`, return local eval metrics when `eval_file` is given.
+
+    `sample_cache` is a cache of `data_file` already holding tokenized samples, it
+    replaces the one `sample_cache_mb` would create and is closed after training.
+    `init_adapter` is an adapter folder to continue training from instead of a new
+    LoRA, its own config (rank, alpha, target modules) then applies. A streaming run
+    interrupted before it finished resumes from the last checkpoint in `output_dir`,
+    where checkpoints are kept until the adapter is saved, exported and evaluated.
+    """
+    assert model_id in model2template, f"model_id {model_id} not supported"
+    # the budget covers loading the model and data too
+    deadline = (
+        time.time() + training_args.time_budget_s
+        if training_args.time_budget_s is not None
+        else None
+    )
+    template = model2template[model_id]
+    lora_config = build_lora_config(model_id, training_args)
+
+    num_workers = training_args.dataloader_num_workers
+    if num_workers > 0:
+        # fast tokenizers must not spawn their own thread pool in forked workers
+        os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+    device = resolve_device(training_args.device)
+    with span("load_model", model_id):
+        model, tokenizer, config_kwargs = take_model(
+            model_id, device, training_args.cpu_dtype
+        )
+        if init_adapter is not None:
+            logger.info(f"Continuing from the adapter in {init_adapter}")
+            model = load_trainable_adapter(model, init_adapter, config_kwargs)
+            lora_config = None
+
+    # Load dataset
+    overrides = {}
+    resume_from = None
+    if training_args.streaming and os.path.isdir(output_dir):
+        resume_from = get_last_checkpoint(output_dir)
+    batch = (
+        training_args.per_device_train_batch_size
+        * training_args.gradient_accumulation_steps
+        * int(os.environ.get("WORLD_SIZE", 1))
+    )
+    with span("load_dataset", model_id, bytes=os.path.getsize(data_file)) as record:
+        if training_args.streaming:
+            dataset = build_streaming_dataset(
+                data_file, tokenizer, context_length, template, training_args
+            )
+            record["rows"] = dataset.count_lines()
+            # an iterable dataset has no length, the trainer needs the step count up front
+            overrides["max_steps"] = (
+                -(-record["rows"] // batch) * training_args.num_train_epochs
+            )
+            if resume_from is not None:
+                logger.info(f"Resuming from {resume_from}")
+                # the stream seeks to where the checkpoint was taken, the trainer need not skip batches
+                overrides["ignore_data_skip"] = load_stream_state(dataset, resume_from)
+        elif training_args.compiled_dataset:
+            dataset = CompiledSFTDataset(data_file, tokenizer, context_length, template)
+            record["rows"] = len(dataset)
+        else:
+            dataset = SFTDataset(
+                file=data_file,
+                tokenizer=tokenizer,
+                max_seq_length=context_length,
+                template=template,
+                cache_size_mb=training_args.sample_cache_mb,
+                cache=sample_cache,
+            )
+            record["rows"] = len(dataset)
+    if deadline is not None:
+        # the most steps it may train, the callback cuts them to what fits before the deadline
+        max_epochs = (
+            training_args.time_budget_max_epochs or training_args.num_train_epochs
+        )
+        overrides["max_steps"] = max(
+            1, math.ceil(-(-record["rows"] // batch) * max_epochs)
+        )
+    sft_config = build_sft_config(
+        training_args, context_length, output_dir, device, config_kwargs, **overrides
     )
 
+    # samples are tokenized lazily by the dataloader, the collator counts what was trained on
+    data_collator = SFTDataCollator(
+        tokenizer, max_seq_length=context_length, count_tokens=True
+    )
+
+    # throughput gauges are refreshed on the trainer's log steps only
+    callbacks = [TrainingMetricsCallback(data_collator, model_id)]
+    if training_args.streaming and num_workers == 0:
+        callbacks.append(StreamStateCallback(dataset, samples_per_epoch=record["rows"]))
+    if deadline is not None:
+        callbacks.append(
+            TimeBudgetCallback(deadline, overrides["max_steps"], collator=data_collator)
+        )
+    profile_steps = training_args.profile_steps or int(
+        os.environ.get("PROFILE_STEPS", 0)
+    )
+    if profile_steps > 0:
+        # profiler output is kept next to the outputs, which get uploaded as a whole
+        profile_dir = output_dir.rstrip("/") + "_profile"
+        if not training_args.streaming:
+            profile_data_pipeline(
+                dataset,
+                # a collator of its own, the profiled batches are not counted as trained on
+                SFTDataCollator(tokenizer, max_seq_length=context_length),
+                output_dir=profile_dir,
+                batch_size=training_args.per_device_train_batch_size,
+            )
+        callbacks.append(ProfilerCallback(output_dir=profile_dir, active=profile_steps))
+
     # Define trainer
-    trainer = SFTTrainer(
+    trainer = build_trainer(
+        training_args,
         model=model,
         train_dataset=dataset,
-        args=training_args,
+        args=sft_config,
         peft_config=lora_config,
-        data_collator=SFTDataCollator(tokenizer, max_seq_length=context_length),
+        data_collator=data_collator,
+        callbacks=callbacks,
     )
 
     # Train model
-    trainer.train()
+    with span("train", model_id) as record:
+        with checkpoint_rng_globals() if resume_from is not None else contextlib.nullcontext():
+            trainer.train(resume_from_checkpoint=resume_from)
+        # every rank trained on its own shard, the record covers all of them
+        record["rows"], record["tokens"] = all_reduce_sum(
+            [data_collator.samples_seen.value, data_collator.tokens_seen.value]
+        )
 
-    # save model
-    trainer.save_model("outputs")
+    if not training_args.streaming and dataset.cache is not None:
+        stats = dataset.cache.stats()
+        logger.info(
+            f"Sample cache hit rate: {stats['hit_rate']:.2%}, "
+            f"{stats['bytes_per_sample']:.0f} bytes/sample, "
+            f"{stats['entries']} entries, {stats['evictions']} evictions"
+        )
+        dataset.cache.close()
+    if training_args.compiled_dataset:
+        dataset.close()
 
-    # remove checkpoint folder
-    os.system("rm -rf outputs/checkpoint-*")
+    # save model, the trainer writes from rank 0 only
+    trainer.save_model(output_dir)
+    if not is_main_process():
+        return None
+
+    exported = (
+        training_args.export_dtype
+        or training_args.export_max_rank
+        or training_args.export_max_error is not None
+    )
+    if exported:
+        with span("export", model_id) as record:
+            report = export_adapter(
+                output_dir,
+                dtype=training_args.export_dtype,
+                max_rank=training_args.export_max_rank,
+                max_error=training_args.export_max_error,
+            )
+            record["bytes"] = report["bytes_after"]
 
     # upload lora weights and tokenizer
     print("Training Completed.")
 
+    # optimizer state is not needed anymore, free it before running the eval batches
+    model = trainer.model
+    trainer.optimizer = trainer.lr_scheduler = None
+    del trainer
+    metrics = None
+    if eval_file is not None:
+        if exported:
+            # score what gets uploaded, the exported adapter goes onto the same base weights
+            model.load_adapter(output_dir, adapter_name="exported")
+            model.set_adapter("exported")
+        with span("eval", model_id) as record:
+            metrics = evaluate_model(
+                model, tokenizer, template, eval_file, max_seq_length=context_length
+            )
+            record.update(rows=metrics["samples"], tokens=metrics["tokens"])
+    release_model(
+        model_id, device, training_args.cpu_dtype, model, tokenizer, config_kwargs
+    )
+    # remove checkpoint folder, nothing is left to resume
+    os.system(f"rm -rf {output_dir}/checkpoint-*")
+    return metrics
+
 
 if __name__ == "__main__":
     # Define training arguments for LoRA fine-tuning
@@ -1,6 +1,8 @@
 import json
 import os
+import shutil
 import sys
+import time
 
 import requests
 import yaml
@@ -8,20 +10,39 @@ from loguru import logger
 from huggingface_hub import HfApi
 
 from demo import LoraTrainingArguments, train_lora
-from utils.constants import model2base_model, model2size
+from sweep import load_sweep_spec, run_sweep
+from utils.cache_manager import CacheManager, budget_from_env, model_key, run_key
+from utils.constants import model2base_model, model2size, model2template
+from utils.distributed import run_distributed
 from utils.flock_api import get_task, submit_task
 from utils.gpu_utils import get_gpu_type
+from utils.hub_upload import upload_outputs
+from utils.local_eval import split_holdout
+from utils.metrics import REGISTRY, start_exporter
+from utils.prepare import Preparation
+from utils.run_ledger import end_run, span, start_run
+from utils.scheduler import Job, detect_workers, estimate_cost, run_jobs
+from utils.time_budget import deadline_from_env, model_budget, split_deadline
+from utils.warm_start import (
+    from_scratch,
+    plan_warm_start,
+    record_lineage,
+    remember_adapter,
+    repo_name,
+)
+from utils.workspace import Workspace, file_lock
 
 HF_USERNAME = os.environ["HF_USERNAME"]
+# shipped with the repository, read by every run
+EXTRA_DATA_FILE = "data/agent_training_data.jsonl"
 
-if __name__ == "__main__":
-    task_id = 5
-    
+
+def load_training_args():
     # load training args
     current_folder = os.path.dirname(os.path.realpath(__file__))
     with open(f"{current_folder}/training_args.yaml", "r") as f:
         all_training_args = yaml.safe_load(f)
-    
+
     # 如果设置了MODEL_ID环境变量，就只使用指定的模型
     if "MODEL_ID" in os.environ:
         model_id = os.environ["MODEL_ID"]
@@ -30,116 +51,524 @@ if __name__ == "__main__":
         else:
             logger.error(f"Model {model_id} not found in training_args.yaml")
             sys.exit(1)
+    return all_training_args
+
+
+def download_task_data(data_url, path="data/demo_data.jsonl"):
+    # 下载任务数据
+    response = requests.get(data_url, stream=True)
+    size, rows = 0, 0
+    with open(path, "wb") as f:
+        for chunk in response.iter_content(chunk_size=8192):
+            f.write(chunk)
+            size += len(chunk)
+            rows += chunk.count(b"\n")
+    return size, rows
+
+
+def merge_datasets(
+    path="data/demo_data.jsonl", extra_path="data/agent_training_data.jsonl"
+):
+    # 合并数据集
+    logger.info("合并数据集...")
+    merged_data = []
+
+    # 读取任务数据
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            merged_data.append(line.strip())
 
+    # 读取处理后的数据
+    with open(extra_path, "r", encoding="utf-8") as f:
+        for line in f:
+            merged_data.append(line.strip())
+
+    # 保存合并后的数据
+    with open(path, "w", encoding="utf-8") as f:
+        for line in merged_data:
+            f.write(line + "\n")
+
+    logger.info(f"数据集合并完成，共 {len(merged_data)} 条数据")
+    return len(merged_data)
+
+
+def upload_and_submit(task_id, model_id, output_dir):
+    gpu_type = get_gpu_type()
+
+    logger.info("Start to push the lora weight to the hub...")
+    api = HfApi(token=os.environ["HF_TOKEN"])
+    repo = repo_name(task_id, model_id)
+    # check whether the repo exists
     try:
-        # 获取任务信息
-        task = get_task(task_id)
-        logger.info(f"Retrieved task: {task}")
-        
-        if 'data' not in task:
-            logger.error(f"Task does not contain 'data' field. Task content: {task}")
-            sys.exit(1)
-        
-        data_url = task["data"]["training_set_url"]
-        context_length = task["data"]["context_length"]
-        max_params = task["data"]["max_params"]
-
-        # filter out the model within the max_params
-        model2size = {k: v for k, v in model2size.items() if v <= max_params}
-        all_training_args = {k: v for k, v in all_training_args.items() if k in model2size}
-        logger.info(f"Models within the max_params: {all_training_args.keys()}")
-        
-        # 下载任务数据
-        response = requests.get(data_url, stream=True)
-        with open("data/demo_data.jsonl", "wb") as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        
-        # 合并数据集
-        logger.info("合并数据集...")
-        merged_data = []
-        
-        # 读取任务数据
-        with open("data/demo_data.jsonl", "r", encoding="utf-8") as f:
-            for line in f:
-                merged_data.append(line.strip())
-                
-        # 读取处理后的数据
-        with open("data/agent_training_data.jsonl", "r", encoding="utf-8") as f:
-            for line in f:
-                merged_data.append(line.strip())
-        
-        # 保存合并后的数据
-        with open("data/demo_data.jsonl", "w", encoding="utf-8") as f:
-            for line in merged_data:
-                f.write(line + "\n")
-        
-        logger.info(f"数据集合并完成，共 {len(merged_data)} 条数据")
-
-        # train all feasible models and merge
-        for model_id in all_training_args.keys():
-            logger.info(f"Start to train the model {model_id}...")
-            # if OOM, proceed to the next model
-            try:
-                # 确保只传入需要的参数
-                training_args = LoraTrainingArguments(**all_training_args[model_id])
-                train_lora(
-                    model_id=model_id,
-                    context_length=context_length,
-                    training_args=training_args,
+        api.create_repo(
+            repo,
+            exist_ok=False,
+            repo_type="model",
+        )
+    except Exception:
+        logger.info(f"Repo {repo} already exists. Will commit the new version.")
+
+    # only the adapter and tokenizer, skipping files the repo already has at HEAD
+    with span("upload", model_id):
+        commit_hash = upload_outputs(api, repo, output_dir)
+    logger.info(f"Commit hash: {commit_hash}")
+    logger.info(f"Repo name: {repo}")
+    # submit
+    with span("submit", model_id):
+        submit_task(task_id, repo, model2base_model[model_id], gpu_type, commit_hash)
+    logger.info("Task submitted successfully")
+    return commit_hash
+
+
+def submit_and_cleanup(task_id, workspace: Workspace, model_id, output_dir):
+    try:
+        commit_hash = upload_and_submit(task_id, model_id, output_dir)
+        # the parent of the next warm start of this task and model
+        remember_adapter(workspace, model_id, output_dir, commit_hash)
+    except Exception as e:
+        logger.error(f"Error: {e}")
+        logger.info("Proceed to the next model...")
+    finally:
+        # cleanup output
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+
+def train_model(
+    model_id,
+    context_length,
+    args,
+    data_file,
+    output_dir,
+    eval_file=None,
+    sample_cache=None,
+    sweep_dir=None,
+    warm_start=None,
+):
+    """Train one model, through a hyperparameter sweep when SWEEP_CONFIG has an entry for it.
+
+    `warm_start` is the plan of `plan_warm_start`: the adapter to continue from, the
+    rows to train it on and the lineage stamped into the result.
+    """
+    spec = load_sweep_spec(os.environ.get("SWEEP_CONFIG")).get(model_id)
+    if spec is not None and eval_file is not None:
+        # trials start from scratch and train their full epochs, so they compare with each other;
+        # the budget bounds the rungs instead
+        budget = args.get("time_budget_s")
+        args = {name: value for name, value in args.items() if name != "time_budget_s"}
+        if warm_start is not None:
+            warm_start = from_scratch(
+                warm_start["lineage"]["task_id"], model_id, data_file
+            )
+        # the trials are kept per task, a concurrent run of the same task waits for them
+        with span("sweep", model_id), file_lock(sweep_dir):
+            metrics = run_sweep(
+                model_id=model_id,
+                spec=spec,
+                base_args=args,
+                context_length=context_length,
+                data_file=data_file,
+                eval_file=eval_file,
+                sweep_dir=sweep_dir,
+                output_dir=output_dir,
+                deadline=time.time() + budget if budget is not None else None,
+            )["metrics"]
+    else:
+        train_file, init_adapter = data_file, None
+        if warm_start is not None and warm_start["adapter"] is not None:
+            train_file, init_adapter = warm_start["data_file"], warm_start["adapter"]
+            args = dict(args, num_train_epochs=args.get("warm_start_epochs", 1))
+            if train_file != data_file:
+                # the prepared samples are indexed by the lines of the full data file
+                sample_cache = None
+        metrics = train_once(
+            model_id,
+            context_length,
+            args,
+            train_file,
+            output_dir,
+            eval_file,
+            sample_cache,
+            init_adapter,
+        )
+    if warm_start is not None:
+        record_lineage(output_dir, warm_start, data_file)
+    return metrics
+
+
+def train_once(
+    model_id,
+    context_length,
+    args,
+    data_file,
+    output_dir,
+    eval_file,
+    sample_cache,
+    init_adapter,
+):
+    if args.get("nproc_per_node", 1) > 1:
+        result = run_distributed(
+            model_id,
+            context_length,
+            args,
+            args["nproc_per_node"],
+            data_file=data_file,
+            output_dir=output_dir,
+            eval_file=eval_file,
+            init_adapter=init_adapter,
+        )
+        # the ranks ran in their own processes, fold their summed throughput into this one's metrics
+        REGISTRY.inc(
+            "flock_train_samples_total", result["samples"] or 0, model=model_id
+        )
+        REGISTRY.inc("flock_train_tokens_total", result["tokens"] or 0, model=model_id)
+        return result["metrics"]
+    # 确保只传入需要的参数
+    return train_lora(
+        model_id=model_id,
+        context_length=context_length,
+        training_args=LoraTrainingArguments(**args),
+        data_file=data_file,
+        output_dir=output_dir,
+        eval_file=eval_file,
+        sample_cache=sample_cache,
+        init_adapter=init_adapter,
+    )
+
+
+def submit_ranked(task_id, workspace: Workspace, ranked):
+    """Submit models best local eval loss first, skipping any above MAX_EVAL_LOSS."""
+    max_loss = (
+        float(os.environ["MAX_EVAL_LOSS"]) if "MAX_EVAL_LOSS" in os.environ else None
+    )
+    ranked = sorted(
+        ranked, key=lambda item: item[0] if item[0] == item[0] else float("inf")
+    )
+    for loss, model_id, output_dir in ranked:
+        if max_loss is not None and not loss <= max_loss:
+            logger.info(
+                f"Skip {model_id}: local eval loss {loss:.4f} is above {max_loss}"
+            )
+            shutil.rmtree(output_dir, ignore_errors=True)
+            continue
+        logger.info(f"Submitting {model_id} with local eval loss {loss:.4f}")
+        submit_and_cleanup(task_id, workspace, model_id, output_dir)
+
+
+def with_time_budget(model_id, args, share, deadline):
+    """`args` training `model_id` within its `share` of the time left, None when no time is left for it."""
+    if deadline is None:
+        return args
+    budget = model_budget(model_id, share, deadline)
+    if budget <= 0:
+        logger.warning(f"No time left to train {model_id} within TIME_BUDGET_S")
+        return None
+    logger.info(f"Time budget of {model_id}: {budget:.0f}s of training")
+    return dict(args, time_budget_s=budget)
+
+
+def model_job_args(
+    workspace: Workspace, model_id, context_length, args, eval_file=None
+):
+    return {
+        "context_length": context_length,
+        "training_args": args,
+        "data_file": workspace.data_file,
+        "output_dir": workspace.output_dir(model_id),
+        "sweep_dir": workspace.sweep_dir(model_id),
+        "eval_file": eval_file,
+        "warm_start": plan_warm_start(
+            workspace,
+            model_id,
+            args,
+            workspace.data_file,
+            api=HfApi(token=os.environ["HF_TOKEN"]),
+        ),
+    }
+
+
+def train_job(job: Job):
+    """Scheduler target, runs in a worker process pinned to one device."""
+    # the share is counted from when the job starts, it may have waited for a worker
+    args = with_time_budget(
+        job.model_id,
+        job.args["training_args"],
+        job.args.get("time_share"),
+        job.args.get("deadline"),
+    )
+    if args is None:
+        raise RuntimeError(f"time budget exhausted before training {job.model_id}")
+    metrics = train_model(
+        job.model_id,
+        job.args["context_length"],
+        args,
+        data_file=job.args["data_file"],
+        output_dir=job.args["output_dir"],
+        eval_file=job.args.get("eval_file"),
+        sweep_dir=job.args["sweep_dir"],
+        warm_start=job.args["warm_start"],
+    )
+    # the worker is a fresh process, everything in its registry is this job's
+    return {
+        "output_dir": job.args["output_dir"],
+        "metrics": metrics,
+        "registry": REGISTRY.snapshot(),
+    }
+
+
+def train_models(
+    task_id,
+    workspace: Workspace,
+    all_training_args,
+    context_length,
+    eval_file=None,
+    sample_cache=None,
+    deadline=None,
+):
+    ranked = []
+    models = list(all_training_args)
+    # train all feasible models and merge
+    for index, model_id in enumerate(models):
+        # samples tokenized during preparation are the first model's, the others tokenize their own
+        cache, sample_cache = sample_cache, None
+        logger.info(f"Start to train the model {model_id}...")
+        # every model trains into its own folder of the workspace, kept until it is ranked
+        job_args = model_job_args(
+            workspace, model_id, context_length, all_training_args[model_id], eval_file
+        )
+        # if OOM, proceed to the next model
+        try:
+            if deadline is not None:
+                # shared among the models left, time a model did not use goes to the next ones
+                costs = {
+                    other: estimate_cost(other, all_training_args[other])
+                    for other in models[index:]
+                }
+                share = split_deadline(deadline, costs)[model_id]
+                job_args["training_args"] = with_time_budget(
+                    model_id, job_args["training_args"], share, deadline
                 )
-            except RuntimeError as e:
-                logger.error(f"Error: {e}")
-                logger.info("Proceed to the next model...")
-                continue
-
-            # generate a random repo id based on timestamp
-            gpu_type = get_gpu_type()
-
-            try:
-                logger.info("Start to push the lora weight to the hub...")
-                api = HfApi(token=os.environ["HF_TOKEN"])
-                repo_name = f"{HF_USERNAME}/task-{task_id}-{model_id.replace('/', '-')}"
-                # check whether the repo exists
-                try:
-                    api.create_repo(
-                        repo_name,
-                        exist_ok=False,
-                        repo_type="model",
-                    )
-                except Exception:
-                    logger.info(
-                        f"Repo {repo_name} already exists. Will commit the new version."
-                    )
-
-                commit_message = api.upload_folder(
-                    folder_path="outputs",
-                    repo_id=repo_name,
-                    repo_type="model",
+                if job_args["training_args"] is None:
+                    continue
+            metrics = train_model(
+                model_id,
+                context_length,
+                job_args["training_args"],
+                data_file=job_args["data_file"],
+                output_dir=job_args["output_dir"],
+                eval_file=eval_file,
+                sample_cache=cache,
+                sweep_dir=job_args["sweep_dir"],
+                warm_start=job_args["warm_start"],
+            )
+        except RuntimeError as e:
+            logger.error(f"Error: {e}")
+            logger.info("Proceed to the next model...")
+            workspace.cleanup_model(model_id)
+            continue
+        finally:
+            if cache is not None:
+                cache.close()
+
+        if eval_file is None:
+            submit_and_cleanup(task_id, workspace, model_id, job_args["output_dir"])
+        else:
+            ranked.append((metrics["loss"], model_id, job_args["output_dir"]))
+    submit_ranked(task_id, workspace, ranked)
+
+
+def train_models_parallel(
+    task_id,
+    workspace: Workspace,
+    all_training_args,
+    context_length,
+    workers,
+    eval_file=None,
+    deadline=None,
+):
+    # every worker trains into its own folder, uploads happen here one at a time
+    jobs = [
+        Job(
+            model_id=model_id,
+            args=model_job_args(workspace, model_id, context_length, args, eval_file),
+            cost=estimate_cost(model_id, args),
+        )
+        for model_id, args in all_training_args.items()
+    ]
+    if deadline is not None:
+        shares = split_deadline(
+            deadline, {job.model_id: job.cost for job in jobs}, workers=len(workers)
+        )
+        for job in jobs:
+            job.args.update(deadline=deadline, time_share=shares[job.model_id])
+    ranked = []
+
+    def on_result(result):
+        if not result.ok:
+            logger.error(f"Error: {result.error}")
+            logger.info("Proceed to the next model...")
+            workspace.cleanup_model(result.model_id)
+            return
+        REGISTRY.merge(result.value["registry"])
+        output_dir, metrics = result.value["output_dir"], result.value["metrics"]
+        if eval_file is None:
+            submit_and_cleanup(
+                task_id, workspace, result.model_id, output_dir=output_dir
+            )
+        else:
+            ranked.append((metrics["loss"], result.model_id, output_dir))
+
+    run_jobs(jobs, workers, train_job, on_result=on_result)
+    submit_ranked(task_id, workspace, ranked)
+
+
+def run_task(task_id, all_training_args=None):
+    """Fetch `task_id` from the ledger, train every feasible model on its data and submit them."""
+    if all_training_args is None:
+        all_training_args = load_training_args()
+    # TIME_BUDGET_S counts from here, the models share what the other stages leave
+    deadline = deadline_from_env()
+
+    # every stage of this run is timed into runs/task-<id>.jsonl
+    run_id = start_run(task_id)
+    logger.info(f"Run {run_id} of task {task_id}")
+    # data and outputs live in workspaces/task-<id>/<run-id>, runs never touch each other's files
+    workspace = Workspace(task_id, run_id)
+    cache = CacheManager(
+        workspace.root, warm_models=int(os.environ.get("CACHE_WARM_MODELS", 2))
+    )
+    try:
+        # everything the run holds is released when it ends, whatever the outcome
+        with cache:
+            cache.acquire(run_key(workspace))
+            run_stages(task_id, workspace, all_training_args, cache, deadline)
+    finally:
+        end_run()
+    # a failed run keeps its workspace for inspection
+    if os.environ.get("KEEP_WORKSPACE", "0") == "0":
+        workspace.cleanup()
+
+
+def run_stages(
+    task_id, workspace: Workspace, all_training_args, cache: CacheManager, deadline=None
+):
+    # 获取任务信息
+    with span("fetch_task"):
+        task = get_task(task_id)
+    logger.info(f"Retrieved task: {task}")
+
+    if "data" not in task:
+        raise KeyError(f"Task does not contain 'data' field. Task content: {task}")
+
+    data_url = task["data"]["training_set_url"]
+    context_length = task["data"]["context_length"]
+    max_params = task["data"]["max_params"]
+
+    # filter out the model within the max_params
+    feasible = {k for k, v in model2size.items() if v <= max_params}
+    all_training_args = {k: v for k, v in all_training_args.items() if k in feasible}
+    logger.info(f"Models within the max_params: {all_training_args.keys()}")
+
+    # hold the snapshots this run trains on, then make room within CACHE_BUDGET_GB around them
+    for model_id in all_training_args:
+        cache.acquire(model_key(model_id))
+    budget = budget_from_env()
+    if budget is not None:
+        with span("cache_prune") as record:
+            record["evicted"] = len(cache.prune(budget))
+
+    # one worker per device (or CPUS_PER_WORKER cores), several models train side by side
+    cpus_per_worker = os.environ.get("CPUS_PER_WORKER")
+    workers = detect_workers(int(cpus_per_worker) if cpus_per_worker else None)
+
+    # fetch the first model and tokenize its data while the data downloads
+    preparation = None
+    if all_training_args and os.environ.get("OVERLAP_PREPARE", "1") != "0":
+        first_model = next(iter(all_training_args))
+        # worker processes build their own caches, the prepared one only serves this process
+        cache_mb = (
+            all_training_args[first_model].get("sample_cache_mb", 0)
+            if len(workers) == 1
+            else 0
+        )
+        preparation = Preparation(
+            first_model,
+            model2template[first_model],
+            context_length,
+            cache_bytes=int(cache_mb * 1024 * 1024),
+            num_workers=int(os.environ.get("PREPARE_WORKERS", 2)),
+        )
+        preparation.start(extra_path=EXTRA_DATA_FILE)
+
+    data_file = workspace.data_file
+    try:
+        with span("download") as record:
+            if preparation is None:
+                record["bytes"], record["rows"] = download_task_data(
+                    data_url, data_file
                 )
-                # get commit hash
-                commit_hash = commit_message.oid
-                logger.info(f"Commit hash: {commit_hash}")
-                logger.info(f"Repo name: {repo_name}")
-                # submit
-                submit_task(
-                    task_id, repo_name, model2base_model[model_id], gpu_type, commit_hash
+            else:
+                record["bytes"], record["rows"] = preparation.download(
+                    data_url, data_file
                 )
-                logger.info("Task submitted successfully")
-            except Exception as e:
-                logger.error(f"Error: {e}")
-                logger.info("Proceed to the next model...")
-            finally:
-                # cleanup merged_model and output
-                os.system("rm -rf merged_model")
-                os.system("rm -rf outputs")
-                continue
+    except Exception:
+        if preparation is not None:
+            preparation.cancel()
+        raise
+    # hold out part of the task data (not the auxiliary data) to score models locally
+    # (sweeps rank their trials on it, so SWEEP_CONFIG holds out 5% by default)
+    eval_fraction = float(
+        os.environ.get("EVAL_FRACTION", 0.05 if "SWEEP_CONFIG" in os.environ else 0)
+    )
+    eval_file = None
+    if eval_fraction > 0:
+        eval_file = workspace.eval_file
+        split_holdout(data_file, eval_file, eval_fraction)
+    with span("merge") as record:
+        record["rows"] = merge_datasets(data_file, EXTRA_DATA_FILE)
+
+    sample_cache = None
+    if preparation is not None:
+        with span("prepare_wait", preparation.model_id):
+            preparation.wait()
+            sample_cache = preparation.build_cache(data_file)
+
+    # a model trained with DDP takes all the devices, the models then train one after the other
+    distributed = any(
+        args.get("nproc_per_node", 1) > 1 for args in all_training_args.values()
+    )
+    if len(workers) > 1 and not distributed:
+        logger.info(f"Training on {len(workers)} workers: {[w.name for w in workers]}")
+        train_models_parallel(
+            task_id,
+            workspace,
+            all_training_args,
+            context_length,
+            workers,
+            eval_file,
+            deadline,
+        )
+    else:
+        train_models(
+            task_id,
+            workspace,
+            all_training_args,
+            context_length,
+            eval_file,
+            sample_cache=sample_cache,
+            deadline=deadline,
+        )
+
 
+if __name__ == "__main__":
+    task_id = int(os.environ.get("TASK_ID", 5))
+    # METRICS_PORT / METRICS_TEXTFILE
+    start_exporter()
+
+    try:
+        run_task(task_id)
     except KeyError as e:
         logger.error(f"Failed to access required field: {e}")
-        logger.error(f"Task structure: {task}")
         sys.exit(1)
     except Exception as e:
         logger.error(f"Unexpected error: {e}")
-        logger.error(f"Full task response: {task}")
         sys.exit(1)
@@ -0,0 +1,331 @@
+import argparse
+import gc
+import hashlib
+import json
+import math
+import os
+import random
+import shutil
+import time
+from dataclasses import asdict, replace
+from typing import Dict, List, Optional
+
+import torch
+import yaml
+from loguru import logger
+from peft import PeftModel, get_peft_model, prepare_model_for_kbit_training
+
+from dataset import SFTDataCollator, SFTDataset
+from demo import (
+    LoraTrainingArguments,
+    build_lora_config,
+    build_sft_config,
+    build_trainer,
+    load_model,
+)
+from utils.adapter_export import export_adapter
+from utils.constants import model2template
+from utils.device_utils import resolve_device
+from utils.local_eval import evaluate_model
+
+SEARCH_KEYS = ["lora_rank", "lora_alpha", "lora_dropout", "learning_rate"]
+TRIALS_FILE = "trials.jsonl"
+
+
+def sample_value(rng: random.Random, space):
+    """A list is a set of choices, {min, max, log} a (log-)uniform range, anything else is fixed."""
+    if isinstance(space, list):
+        return rng.choice(space)
+    if isinstance(space, dict):
+        low, high = float(space["min"]), float(space["max"])
+        if space.get("log", False):
+            return math.exp(rng.uniform(math.log(low), math.log(high)))
+        return rng.uniform(low, high)
+    return space
+
+
+def sample_trials(spec: Dict, seed: int = 0) -> List[Dict]:
+    # seeded, so a resumed sweep sees the same trials in the same order
+    rng = random.Random(seed)
+    return [
+        {key: sample_value(rng, spec[key]) for key in SEARCH_KEYS if key in spec}
+        for _ in range(spec.get("num_trials", 8))
+    ]
+
+
+def rung_epochs(
+    min_epochs: float, max_epochs: float, reduction_factor: int
+) -> List[float]:
+    rungs = [min_epochs]
+    while rungs[-1] * reduction_factor < max_epochs:
+        rungs.append(rungs[-1] * reduction_factor)
+    if rungs[-1] < max_epochs:
+        rungs.append(max_epochs)
+    return rungs
+
+
+def sweep_fingerprint(
+    spec: Dict,
+    base_args: Dict,
+    context_length: int,
+    data_file: str,
+    eval_file: str,
+    seed: int,
+) -> str:
+    """Changes with anything a trial's loss depends on, so only the same sweep is resumed."""
+    digest = hashlib.blake2b(digest_size=8)
+    settings = {
+        "spec": spec,
+        "base_args": base_args,
+        "context_length": context_length,
+        "seed": seed,
+    }
+    digest.update(json.dumps(settings, sort_keys=True, default=str).encode("utf8"))
+    for path in (data_file, eval_file):
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def load_records(sweep_dir: str, fingerprint: str) -> Dict[tuple, Dict]:
+    records = {}
+    path = os.path.join(sweep_dir, TRIALS_FILE)
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                record = json.loads(line)
+                if record.get("fingerprint") == fingerprint:
+                    records[(record["trial"], record["rung"])] = record
+    return records
+
+
+def seconds_per_epoch(records: Dict[tuple, Dict], rungs: List[float]) -> float:
+    """Training and eval seconds per epoch of the timed trials in `records`, 0 without any."""
+    seconds = epochs = 0.0
+    for (_, rung), record in records.items():
+        if "duration_s" in record:
+            seconds += record["duration_s"]
+            epochs += record["epochs"] - (rungs[rung - 1] if rung else 0.0)
+    return seconds / epochs if epochs else 0.0
+
+
+def run_sweep(
+    model_id: str,
+    spec: Dict,
+    base_args: Dict,
+    context_length: int,
+    data_file: str,
+    eval_file: str,
+    sweep_dir: str,
+    output_dir: str = "outputs",
+    seed: int = 0,
+    deadline: Optional[float] = None,
+) -> Dict:
+    """Successive-halving search over LoRA hyperparameters, promoting the best adapter to `output_dir`.
+
+    Every trial trains for the first rung's epochs, then only the best 1/reduction_factor
+    continue from their saved adapter to the next rung, scored by the local eval loss.
+    The base model and the tokenized samples are loaded once and shared by all trials,
+    and each finished (trial, rung) is appended to trials.jsonl so an interrupted sweep
+    resumes where it stopped. Trials go to `<sweep_dir>/<fingerprint>/`, keyed by the
+    data, eval data, spec and arguments, so a sweep on anything else starts afresh.
+
+    A promoted trial continues from its adapter weights only: every rung builds a new
+    trainer, so the optimizer state and LR schedule (warmup included) start over. The
+    winner is exported with the `export_*` settings of `base_args`, as `train_lora` does.
+
+    With a `deadline` (a `time.time()` value) a rung is only started if it fits going by
+    the seconds per epoch of the trials so far, otherwise the best of the last rung wins.
+    """
+    fingerprint = sweep_fingerprint(
+        spec, base_args, context_length, data_file, eval_file, seed
+    )
+    sweep_dir = os.path.join(sweep_dir, fingerprint)
+    os.makedirs(sweep_dir, exist_ok=True)
+    template = model2template[model_id]
+    training_args = LoraTrainingArguments(**base_args)
+    epochs = spec.get(
+        "num_train_epochs", {"min": 1, "max": training_args.num_train_epochs}
+    )
+    rungs = rung_epochs(
+        float(epochs["min"]), float(epochs["max"]), spec.get("reduction_factor", 3)
+    )
+    trials = sample_trials(spec, seed)
+    records = load_records(sweep_dir, fingerprint)
+    logger.info(
+        f"Sweeping {len(trials)} trials for {model_id} over epoch rungs {rungs}"
+    )
+
+    device = resolve_device(training_args.device)
+    model, tokenizer, config_kwargs = load_model(
+        model_id, device, training_args.cpu_dtype
+    )
+    if device == "cuda":
+        model = prepare_model_for_kbit_training(model)
+    # one dataset for all trials, its sample cache keeps the tokenized rows across them
+    dataset = SFTDataset(
+        data_file,
+        tokenizer,
+        context_length,
+        template,
+        cache_size_mb=spec.get("sample_cache_mb", 64),
+    )
+    collator = SFTDataCollator(tokenizer, max_seq_length=context_length)
+
+    alive = list(range(len(trials)))
+    for rung, rung_end in enumerate(rungs):
+        rung_start = rungs[rung - 1] if rung else 0.0
+        for trial in alive:
+            record = records.get((trial, rung))
+            if (
+                record is not None
+                and record["params"] == trials[trial]
+                and record["epochs"] == rung_end
+            ):
+                continue
+            args = replace(
+                training_args, **trials[trial], num_train_epochs=rung_end - rung_start
+            )
+            trial_dir = os.path.join(sweep_dir, f"trial-{trial}", f"rung-{rung}")
+
+            if rung:
+                previous = records[(trial, rung - 1)]["adapter_dir"]
+                peft_model = PeftModel.from_pretrained(
+                    model, previous, is_trainable=True
+                )
+            else:
+                peft_model = get_peft_model(model, build_lora_config(model_id, args))
+            trainer = build_trainer(
+                args,
+                model=peft_model,
+                train_dataset=dataset,
+                args=build_sft_config(
+                    args,
+                    context_length,
+                    trial_dir,
+                    device,
+                    config_kwargs,
+                    warmup_steps=0,
+                    warmup_ratio=0.03,
+                    save_strategy="no",
+                    report_to=[],
+                ),
+                data_collator=collator,
+            )
+            started = time.time()
+            trainer.train()
+            trainer.save_model(trial_dir)
+            metrics = evaluate_model(
+                peft_model, tokenizer, template, eval_file, context_length
+            )
+
+            record = {
+                "fingerprint": fingerprint,
+                "trial": trial,
+                "rung": rung,
+                "epochs": rung_end,
+                "params": trials[trial],
+                "loss": metrics["loss"],
+                "adapter_dir": trial_dir,
+                "duration_s": time.time() - started,
+            }
+            records[(trial, rung)] = record
+            with open(os.path.join(sweep_dir, TRIALS_FILE), "a") as f:
+                f.write(json.dumps(record) + "\n")
+            logger.info(
+                f"Trial {trial} rung {rung} ({rung_end} epochs): loss {metrics['loss']:.4f}"
+            )
+
+            # drop the LoRA layers so the next trial starts from the clean shared base
+            model = peft_model.unload()
+            del trainer, peft_model
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+        ranked = sorted(alive, key=lambda t: records[(t, rung)]["loss"])
+        if rung + 1 < len(rungs):
+            alive = ranked[: max(1, len(alive) // spec.get("reduction_factor", 3))]
+            if deadline is not None:
+                needed = (
+                    len(alive)
+                    * (rungs[rung + 1] - rung_end)
+                    * seconds_per_epoch(records, rungs)
+                )
+                if time.time() + needed > deadline:
+                    logger.warning(
+                        f"Rung {rung + 1} needs ~{needed:.0f}s, past the deadline: stopping at rung {rung}"
+                    )
+                    break
+            logger.info(f"Promoting trials {alive} to rung {rung + 1}")
+
+    best = records[(ranked[0], rung)]
+    if dataset.cache is not None:
+        dataset.cache.close()
+
+    # only the winner becomes the upload candidate
+    os.makedirs(output_dir, exist_ok=True)
+    for name in os.listdir(best["adapter_dir"]):
+        path = os.path.join(best["adapter_dir"], name)
+        if os.path.isfile(path):
+            shutil.copy(path, output_dir)
+    tokenizer.save_pretrained(output_dir)
+    # the same artifact train_lora uploads, cast and rank-reduced by the export settings
+    if (
+        training_args.export_dtype
+        or training_args.export_max_rank
+        or training_args.export_max_error is not None
+    ):
+        export_adapter(
+            output_dir,
+            dtype=training_args.export_dtype,
+            max_rank=training_args.export_max_rank,
+            max_error=training_args.export_max_error,
+        )
+    result = {
+        **best,
+        "metrics": {"loss": best["loss"]},
+        "base_args": asdict(training_args),
+        "sweep_dir": sweep_dir,
+    }
+    with open(os.path.join(sweep_dir, "best.json"), "w") as f:
+        json.dump(result, f, indent=2)
+    logger.info(f"Best trial {best['trial']} {best['params']}: loss {best['loss']:.4f}")
+    return result
+
+
+def load_sweep_spec(path: Optional[str]) -> Dict:
+    if not path:
+        return {}
+    with open(path) as f:
+        return yaml.safe_load(f) or {}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-id", required=True)
+    parser.add_argument("--config", default="sweep_args.yaml")
+    parser.add_argument("--training-args", default="training_args.yaml")
+    parser.add_argument("--data-file", default="data/demo_data.jsonl")
+    parser.add_argument("--eval-file", default="data/eval_data.jsonl")
+    parser.add_argument("--context-length", type=int, default=2048)
+    parser.add_argument("--sweep-dir", default=None)
+    parser.add_argument("--output-dir", default="outputs")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with open(args.training_args) as f:
+        base_args = yaml.safe_load(f)[args.model_id]
+    run_sweep(
+        model_id=args.model_id,
+        spec=load_sweep_spec(args.config)[args.model_id],
+        base_args=base_args,
+        context_length=args.context_length,
+        data_file=args.data_file,
+        eval_file=args.eval_file,
+        sweep_dir=args.sweep_dir or f"sweeps/{args.model_id.replace('/', '-')}",
+        output_dir=args.output_dir,
+        seed=args.seed,
+    )
@@ -0,0 +1,85 @@
+import json
+import os
+
+import pytest
+import torch
+from peft import LoraConfig, PeftModel, get_peft_model
+from transformers import AutoModelForCausalLM
+
+from merge import merge_lora_to_base_model
+from utils.adapter_export import delta_error, export_adapter, truncate_lora
+from utils.synthetic import build_tiny_model, build_tokenizer
+
+
+@pytest.fixture
+def adapter(tmp_path):
+    base_dir, adapter_dir = str(tmp_path / "base"), str(tmp_path / "adapter")
+    tokenizer = build_tokenizer(base_dir)
+    build_tiny_model(base_dir, tokenizer)
+    torch.manual_seed(0)
+    model = get_peft_model(
+        AutoModelForCausalLM.from_pretrained(base_dir),
+        LoraConfig(
+            r=8,
+            lora_alpha=16,
+            target_modules=["q_proj", "v_proj"],
+            task_type="CAUSAL_LM",
+        ),
+    )
+    # a trained-looking update: rank 2 signal plus small noise, lora_B is zero at init
+    for name, param in model.named_parameters():
+        if "lora_B" in name:
+            param.data = torch.randn(param.shape[0], 2) @ torch.randn(2, param.shape[1])
+            param.data += 1e-3 * torch.randn_like(param)
+    model.save_pretrained(adapter_dir)
+    tokenizer.save_pretrained(adapter_dir)
+    return base_dir, adapter_dir
+
+
+def merged_weights(base_dir, adapter_dir, save_dir):
+    merge_lora_to_base_model(base_dir, adapter_dir, save_dir)
+    model = AutoModelForCausalLM.from_pretrained(save_dir, torch_dtype=torch.float32)
+    return {
+        k: v
+        for k, v in model.state_dict().items()
+        if k.endswith(("q_proj.weight", "v_proj.weight"))
+    }
+
+
+def test_truncate_lora_error_bound():
+    torch.manual_seed(0)
+    b = torch.randn(32, 3) @ torch.randn(3, 8)
+    a = torch.randn(8, 48)
+    b_new, a_new = truncate_lora(b, a, max_rank=None, max_error=1e-6)
+    assert a_new.shape[0] == 3 and b_new.shape[1] == 3
+    assert delta_error(b, a, b_new, a_new) < 1e-6
+    b_new, a_new = truncate_lora(b, a, max_rank=1, max_error=None)
+    assert a_new.shape[0] == 1 and 0 < delta_error(b, a, b_new, a_new) < 1
+
+
+def test_export_loads_back_and_merges(adapter, tmp_path):
+    base_dir, adapter_dir = adapter
+    reference = merged_weights(base_dir, adapter_dir, str(tmp_path / "merged-ref"))
+
+    report = export_adapter(adapter_dir, dtype="bfloat16", max_error=0.01)
+    assert report["size_reduction"] > 0.5
+    assert all(layer["new_rank"] == 2 for layer in report["layers"].values())
+    assert report["max_relative_error"] < 0.01
+    with open(os.path.join(adapter_dir, "adapter_config.json")) as f:
+        config = json.load(f)
+    assert set(config["rank_pattern"].values()) == {2}
+
+    model = PeftModel.from_pretrained(
+        AutoModelForCausalLM.from_pretrained(base_dir), adapter_dir
+    )
+    assert (
+        model.base_model.model.model.layers[0]
+        .self_attn.q_proj.lora_A["default"]
+        .weight.shape[0]
+        == 2
+    )
+
+    exported = merged_weights(base_dir, adapter_dir, str(tmp_path / "merged"))
+    for key, weight in reference.items():
+        # bf16 factors merged in fp16, compare at the precision of the merged checkpoint
+        assert (exported[key] - weight).norm() / weight.norm() < 1e-2
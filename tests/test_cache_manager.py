@@ -0,0 +1,137 @@
+import multiprocessing
+import os
+import sys
+
+from utils.cache_manager import CacheManager, model_key, run_key
+from utils.workspace import Workspace, file_lock, shared_path
+
+
+def write(path, size):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+
+
+def fake_snapshot(hub, repo_id, size):
+    repo = os.path.join(hub, "models--" + repo_id.replace("/", "--"))
+    write(os.path.join(repo, "blobs", "abc"), size)
+    os.makedirs(os.path.join(repo, "snapshots", "main"))
+    # snapshots link into the blobs, counted once
+    os.symlink(
+        "../../blobs/abc", os.path.join(repo, "snapshots", "main", "model.safetensors")
+    )
+
+
+def manager(tmp_path, **kwargs):
+    return CacheManager(str(tmp_path / "workspaces"), str(tmp_path / "hub"), **kwargs)
+
+
+def test_lists_every_kind_of_entry(tmp_path):
+    cache = manager(tmp_path)
+    fake_snapshot(cache.hub_cache, "Qwen/Qwen1.5-0.5B", 1000)
+    workspace = Workspace(3, "run-a", root=cache.root)
+    write(workspace.data_file, 300)
+    write(os.path.join(workspace.sweep_dir("Qwen/Qwen1.5-0.5B"), "trials.jsonl"), 20)
+    write(shared_path("tokens.bin", cache.root), 50)
+
+    sizes = {entry.key: entry.size for entry in cache.entries()}
+    assert sizes == {
+        "model/Qwen/Qwen1.5-0.5B": 1000,
+        run_key(workspace): 300,
+        "sweep/task-3/sweeps/Qwen-Qwen1.5-0.5B": 20,
+        "shared/tokens.bin": 50,
+    }
+
+
+def test_prunes_least_recently_used_first(tmp_path):
+    cache = manager(tmp_path, warm_models=0)
+    for i, repo_id in enumerate(["org/old", "org/mid", "org/new"]):
+        fake_snapshot(cache.hub_cache, repo_id, 100)
+        with cache:
+            cache.acquire(model_key(repo_id))
+        # distinct last uses, regardless of the clock resolution
+        cache._update_index(model_key(repo_id), last_used=float(i + 1))
+
+    assert [entry.key for entry in cache.prune(250, dry_run=True)] == ["model/org/old"]
+    assert len(cache.entries()) == 3
+    assert [entry.key for entry in cache.prune(150)] == [
+        "model/org/old",
+        "model/org/mid",
+    ]
+    assert [entry.key for entry in cache.entries()] == ["model/org/new"]
+
+
+def test_keeps_pinned_held_and_warm_entries(tmp_path):
+    cache = manager(tmp_path, warm_models=1)
+    for repo_id in ["org/pinned", "org/held", "org/warm", "org/cold"]:
+        fake_snapshot(cache.hub_cache, repo_id, 100)
+    cache.pin(model_key("org/pinned"))
+    for _ in range(3):
+        with cache:
+            cache.acquire(model_key("org/warm"))
+    cache._update_index(model_key("org/warm"), last_used=1.0)
+
+    with manager(tmp_path) as run:
+        run.acquire(model_key("org/held"))
+        # the warm model goes after the colder one, the pinned and held ones never
+        assert [entry.key for entry in cache.prune(300)] == ["model/org/cold"]
+        assert [entry.key for entry in cache.prune(0)] == ["model/org/warm"]
+    assert sorted(entry.key for entry in cache.entries()) == [
+        "model/org/held",
+        "model/org/pinned",
+    ]
+
+
+def hold_and_wait(root, hub, key, held, done):
+    with CacheManager(root, hub) as cache:
+        cache.acquire(key)
+        held.set()
+        done.wait(30)
+
+
+def test_skips_entries_held_by_another_process(tmp_path):
+    cache = manager(tmp_path, warm_models=0)
+    workspace = Workspace(1, "run-a", root=cache.root)
+    write(workspace.data_file, 100)
+    key = run_key(workspace)
+
+    context = multiprocessing.get_context("spawn")
+    held, done = context.Event(), context.Event()
+    holder = context.Process(
+        target=hold_and_wait, args=(cache.root, cache.hub_cache, key, held, done)
+    )
+    holder.start()
+    try:
+        held.wait(30)
+        (entry,) = cache.entries()
+        assert entry.in_use and cache.prune(0) == []
+    finally:
+        done.set()
+        holder.join()
+    assert [entry.key for entry in cache.prune(0)] == [key]
+    assert not os.path.exists(workspace.run_dir)
+
+
+def test_sweep_in_progress_is_in_use(tmp_path):
+    cache = manager(tmp_path)
+    workspace = Workspace(1, "run-a", root=cache.root)
+    write(os.path.join(workspace.sweep_dir("org/model"), "trials.jsonl"), 10)
+    with file_lock(workspace.sweep_dir("org/model")):
+        (entry,) = [entry for entry in cache.entries() if entry.kind == "sweep"]
+        assert entry.in_use
+
+
+def test_cli_lists_and_pins(tmp_path, monkeypatch, capsys):
+    from utils import cache_manager
+
+    cache = manager(tmp_path)
+    fake_snapshot(cache.hub_cache, "org/model", 100)
+    base = ["cache_manager", "--root", cache.root, "--hub-cache", cache.hub_cache]
+    monkeypatch.setattr(sys, "argv", base + ["pin", "model/org/model"])
+    cache_manager.main()
+    monkeypatch.setattr(sys, "argv", base + ["prune", "--budget-gb", "0"])
+    cache_manager.main()
+    assert "Evicted 0 entries" in capsys.readouterr().out
+    monkeypatch.setattr(sys, "argv", base + ["list"])
+    cache_manager.main()
+    assert "P" in capsys.readouterr().out.splitlines()[0]
@@ -0,0 +1,95 @@
+import os
+
+import pytest
+import torch
+from transformers import Qwen2Config, Qwen2ForCausalLM
+
+from demo import LoraTrainingArguments, train_lora
+from utils.chunked_loss import chunked_lm_loss
+from utils.constants import model2template, qwen_template
+from utils.synthetic import build_tiny_model, build_tokenizer, write_conversations
+
+
+@pytest.fixture
+def model_and_batch():
+    torch.manual_seed(0)
+    config = Qwen2Config(
+        vocab_size=997,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+    )
+    model = Qwen2ForCausalLM(config)
+    input_ids = torch.randint(0, 997, (3, 40))
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[1, 30:] = 0
+    labels = input_ids.clone()
+    labels[:, :15] = -100  # prompt
+    labels[attention_mask == 0] = -100
+    return model, input_ids, attention_mask, labels
+
+
+def grads(model):
+    return {
+        name: p.grad.clone()
+        for name, p in model.named_parameters()
+        if p.grad is not None
+    }
+
+
+def test_matches_standard_loss_and_gradients(model_and_batch):
+    model, input_ids, attention_mask, labels = model_and_batch
+    reference = model(
+        input_ids=input_ids, attention_mask=attention_mask, labels=labels
+    ).loss
+    reference.backward()
+    expected = grads(model)
+    model.zero_grad()
+
+    hidden = model.get_decoder()(input_ids=input_ids, attention_mask=attention_mask)[0]
+    loss = chunked_lm_loss(hidden, labels, model.get_output_embeddings(), chunk_size=7)
+    loss.backward()
+    actual = grads(model)
+
+    torch.testing.assert_close(loss, reference, rtol=1e-5, atol=1e-6)
+    assert expected.keys() == actual.keys()
+    for name in expected:
+        torch.testing.assert_close(actual[name], expected[name], rtol=1e-4, atol=1e-6)
+
+
+def test_no_labeled_positions(model_and_batch):
+    model, input_ids, attention_mask, labels = model_and_batch
+    hidden = model.get_decoder()(input_ids=input_ids, attention_mask=attention_mask)[0]
+    loss = chunked_lm_loss(
+        hidden, torch.full_like(labels, -100), model.get_output_embeddings()
+    )
+    loss.backward()
+    assert loss.item() == 0.0
+
+
+def test_train_lora_with_chunked_loss(tmp_path, monkeypatch):
+    model_dir = str(tmp_path / "tiny-qwen")
+    build_tiny_model(model_dir, build_tokenizer(model_dir))
+    write_conversations(str(tmp_path / "train.jsonl"), num_samples=6, tool_turns=1)
+    monkeypatch.setitem(model2template, model_dir, qwen_template)
+    monkeypatch.chdir(tmp_path)
+
+    train_lora(
+        model_id=model_dir,
+        context_length=128,
+        training_args=LoraTrainingArguments(
+            per_device_train_batch_size=2,
+            gradient_accumulation_steps=1,
+            num_train_epochs=1,
+            lora_rank=4,
+            lora_alpha=8,
+            lora_dropout=0.0,
+            device="cpu",
+            chunked_loss=True,
+            loss_chunk_size=16,
+        ),
+        data_file=str(tmp_path / "train.jsonl"),
+    )
+    assert os.path.exists("outputs/adapter_model.safetensors")
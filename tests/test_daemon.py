@@ -0,0 +1,107 @@
+import json
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from daemon import TaskDaemon, serve_status
+
+
+@pytest.fixture
+def ledger(monkeypatch):
+    """A fake ledger serving /tasks/get, tasks without data are not open yet."""
+    tasks = {
+        1: {
+            "id": 1,
+            "data": {
+                "training_set_url": "http://data/1",
+                "context_length": 64,
+                "max_params": 1,
+            },
+        }
+    }
+    requests_seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            task_id = int(self.path.split("task_id=")[1])
+            requests_seen.append(task_id)
+            body = json.dumps(tasks.get(task_id, {"detail": "not found"})).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv("FLOCK_API_KEY", "key")
+    from utils import flock_api
+
+    monkeypatch.setattr(
+        flock_api, "FED_LEDGER_BASE_URL", f"http://127.0.0.1:{server.server_port}"
+    )
+    yield tasks, requests_seen, flock_api.get_task
+    server.shutdown()
+
+
+def test_daemon_runs_due_tasks_with_backoff(ledger, tmp_path):
+    tasks, requests_seen, get_task = ledger
+    runs, sleeps = [], []
+
+    def run_task(task_id):
+        runs.append(task_id)
+        if task_id == 2 and runs.count(2) == 1:
+            raise RuntimeError("CUDA out of memory")
+
+    status_file = str(tmp_path / "status.json")
+    daemon = TaskDaemon(
+        [1, 2],
+        run_task,
+        get_task,
+        status_file=status_file,
+        poll_interval=1,
+        max_interval=4,
+        sleep=sleeps.append,
+    )
+    daemon.run(max_polls=2)
+    # task 1 ran once, task 2 is not open yet; the idle second poll backed off
+    assert runs == [1] and requests_seen == [1, 2, 1, 2]
+    assert sleeps == [1]
+    status = json.load(open(status_file))
+    assert status["state"] == "stopped" and status["interval"] == 2
+    assert status["tasks"]["1"]["runs"] == 1
+
+    # task 2 opens: its first run fails and is retried on the next poll
+    tasks[2] = {"id": 2, "data": {}}
+    daemon.run(max_polls=3)
+    assert runs == [1, 2, 2]
+    status = json.load(open(status_file))
+    assert status["tasks"]["2"]["failures"] == 1 and status["tasks"]["2"]["runs"] == 1
+
+    # a restarted daemon does not repeat completed tasks
+    TaskDaemon(
+        [1, 2], run_task, get_task, status_file=status_file, sleep=sleeps.append
+    ).run(max_polls=1)
+    assert runs == [1, 2, 2]
+
+
+def test_status_endpoint(tmp_path):
+    daemon = TaskDaemon(
+        [7],
+        lambda task_id: None,
+        lambda task_id: {},
+        status_file=str(tmp_path / "s.json"),
+    )
+    server = serve_status(daemon, port=0)
+    try:
+        with urllib.request.urlopen(
+            f"http://127.0.0.1:{server.server_port}/status"
+        ) as response:
+            status = json.load(response)
+        assert status["state"] == "starting" and status["tasks"] == {}
+    finally:
+        server.shutdown()
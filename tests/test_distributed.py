@@ -0,0 +1,48 @@
+import os
+
+from safetensors.torch import load_file
+
+from utils.constants import model2template, qwen_template
+from utils.distributed import all_reduce_sum, run_distributed
+from utils.synthetic import build_tiny_model, build_tokenizer, write_conversations
+
+
+def test_all_reduce_outside_of_a_process_group():
+    assert all_reduce_sum([3, 5]) == [3, 5]
+
+
+def test_ddp_on_cpu_with_gloo(tmp_path, monkeypatch):
+    model_dir = str(tmp_path / "tiny-qwen")
+    build_tiny_model(model_dir, build_tokenizer(model_dir))
+    write_conversations(str(tmp_path / "train.jsonl"), num_samples=16)
+    write_conversations(str(tmp_path / "eval.jsonl"), num_samples=4, seed=1)
+    monkeypatch.setitem(model2template, model_dir, qwen_template)
+    monkeypatch.chdir(tmp_path)
+    # the ranks import the repo modules, as torchrun does from the repository root
+    monkeypatch.setenv(
+        "PYTHONPATH", os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    )
+    monkeypatch.setenv("TRAIN_DEVICE", "cpu")
+
+    result = run_distributed(
+        model_dir,
+        context_length=128,
+        training_args=dict(
+            per_device_train_batch_size=2,
+            gradient_accumulation_steps=1,
+            num_train_epochs=1,
+            lora_rank=4,
+            lora_alpha=8,
+            lora_dropout=0.0,
+            warmup_steps=0,
+        ),
+        nproc_per_node=2,
+        data_file=str(tmp_path / "train.jsonl"),
+        output_dir=str(tmp_path / "outputs"),
+        eval_file=str(tmp_path / "eval.jsonl"),
+    )
+    # each rank trained on half of the samples, the result covers both
+    assert result["samples"] == 16 and result["tokens"] > 0
+    assert result["metrics"]["samples"] == 4
+    weights = load_file(str(tmp_path / "outputs" / "adapter_model.safetensors"))
+    assert weights and all("lora_" in name for name in weights)
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+from types import SimpleNamespace
+
+from huggingface_hub.hf_api import RepoFile
+
+from utils.hub_upload import MANIFEST_FILE, hash_file, upload_outputs
+
+
+class StubHfApi:
+    """In-memory stand-in for the HfApi calls the upload stage makes."""
+
+    def __init__(self):
+        self.files = {
+            ".gitattributes": b"*.safetensors filter=lfs diff=lfs merge=lfs -text\n"
+        }
+        self.commits = ["initial"]
+        self.uploaded = []
+
+    def create_repo(self, repo_id, exist_ok=False, repo_type=None):
+        raise Exception("409 Conflict: repo already exists")
+
+    def repo_info(self, repo_id, repo_type=None):
+        return SimpleNamespace(sha=self.commits[-1])
+
+    def list_repo_tree(self, repo_id, recursive=False, revision=None, repo_type=None):
+        assert revision == self.commits[-1]
+        for path, content in self.files.items():
+            blob_id = hashlib.sha1(b"blob %d\0" % len(content) + content).hexdigest()
+            lfs = None
+            if path.endswith(".safetensors"):
+                sha256 = hashlib.sha256(content).hexdigest()
+                lfs = {"size": len(content), "oid": sha256, "pointerSize": 130}
+                blob_id = hashlib.sha1(b"pointer " + sha256.encode()).hexdigest()
+            yield RepoFile(path=path, size=len(content), oid=blob_id, lfs=lfs)
+
+    def create_commit(
+        self,
+        repo_id,
+        operations,
+        commit_message,
+        repo_type=None,
+        parent_commit=None,
+        num_threads=5,
+    ):
+        assert parent_commit == self.commits[-1]
+        for op in operations:
+            with open(op.path_or_fileobj, "rb") as f:
+                self.files[op.path_in_repo] = f.read()
+            self.uploaded.append(op.path_in_repo)
+        self.commits.append(f"commit-{len(self.commits)}")
+        return SimpleNamespace(oid=self.commits[-1])
+
+
+def write_outputs(folder, adapter=b"weights-v1"):
+    os.makedirs(folder, exist_ok=True)
+    files = {
+        "adapter_model.safetensors": adapter,
+        "adapter_config.json": b'{"r": 8}',
+        "tokenizer.json": b'{"model": {}}',
+        "tokenizer_config.json": b"{}",
+        "special_tokens_map.json": b"{}",
+        "training_args.bin": b"pickled",
+        "README.md": b"# card",
+    }
+    for name, content in files.items():
+        with open(os.path.join(folder, name), "wb") as f:
+            f.write(content)
+
+
+def test_hash_file_matches_git_blob_id(tmp_path):
+    path = tmp_path / "f.txt"
+    path.write_bytes(b"hello\n")
+    # `git hash-object` of "hello\n"
+    assert hash_file(str(path))["blob_id"] == "ce013625030ba8dba906f756967f9e9ca394464a"
+
+
+def test_only_changed_manifest_files_are_uploaded(tmp_path):
+    api = StubHfApi()
+    folder = str(tmp_path / "outputs")
+
+    write_outputs(folder)
+    first = upload_outputs(api, "user/task-1-model", folder)
+    assert first == "commit-1"
+    assert "training_args.bin" not in api.files and "README.md" not in api.files
+    with open(os.path.join(folder, MANIFEST_FILE)) as f:
+        assert "tokenizer.json" in json.load(f)
+
+    # same tokenizer, retrained adapter: only the adapter (and manifest) are sent
+    api.uploaded.clear()
+    write_outputs(folder, adapter=b"weights-v2")
+    second = upload_outputs(api, "user/task-1-model", folder)
+    assert second == "commit-2"
+    assert sorted(api.uploaded) == ["adapter_model.safetensors", MANIFEST_FILE]
+
+    # nothing changed: no new commit, HEAD is submitted
+    api.uploaded.clear()
+    assert upload_outputs(api, "user/task-1-model", folder) == "commit-2"
+    assert api.uploaded == []
+
+
+def test_upload_and_submit_uses_dedup_stage(tmp_path, monkeypatch):
+    monkeypatch.setenv("HF_USERNAME", "user")
+    monkeypatch.setenv("HF_TOKEN", "hf_test")
+    monkeypatch.setenv("FLOCK_API_KEY", "key")
+    import full_automation
+
+    api = StubHfApi()
+    submitted = []
+    monkeypatch.setattr(full_automation, "HfApi", lambda token: api)
+    monkeypatch.setattr(
+        full_automation, "submit_task", lambda *args: submitted.append(args)
+    )
+    monkeypatch.setattr(full_automation, "get_gpu_type", lambda: "cpu")
+
+    folder = str(tmp_path / "outputs")
+    write_outputs(folder)
+    full_automation.upload_and_submit(1, "Qwen/Qwen1.5-0.5B", folder)
+    assert submitted == [
+        (1, "user/task-1-Qwen-Qwen1.5-0.5B", "qwen1.5", "cpu", "commit-1")
+    ]
@@ -0,0 +1,110 @@
+import json
+
+import pytest
+import torch
+from peft import LoraConfig, get_peft_model
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+import demo
+from dataset import ConversationTokenizer
+from utils.constants import qwen_template
+from utils.inference import (
+    AdapterHarness,
+    build_prompts,
+    generate,
+    load_prompts,
+    stop_token_ids,
+)
+from utils.synthetic import build_tiny_model, build_tokenizer, write_conversations
+
+
+@pytest.fixture(scope="module")
+def tiny(tmp_path_factory):
+    root = tmp_path_factory.mktemp("inference")
+    model_dir = str(root / "tiny-qwen")
+    build_tiny_model(model_dir, build_tokenizer(model_dir))
+    adapters = {}
+    for seed in (1, 2):
+        torch.manual_seed(seed)
+        # random B as well, a fresh adapter would otherwise leave the base model unchanged
+        config = LoraConfig(
+            r=4,
+            lora_alpha=32,
+            target_modules=["q_proj", "v_proj"],
+            init_lora_weights=False,
+        )
+        model = get_peft_model(AutoModelForCausalLM.from_pretrained(model_dir), config)
+        adapters[f"adapter-{seed}"] = str(root / f"adapter-{seed}")
+        model.save_pretrained(adapters[f"adapter-{seed}"])
+    data = str(root / "eval.jsonl")
+    write_conversations(data, num_samples=6, tool_turns=1, seed=3)
+    return model_dir, adapters, data
+
+
+def test_assistant_prompts_are_the_training_prefix(tiny):
+    model_dir, _, data = tiny
+    tokenizer = AutoTokenizer.from_pretrained(model_dir)
+    line = open(data).readline()
+    sample = ConversationTokenizer(tokenizer, 4096, qwen_template).tokenize(line)
+    prompts = build_prompts(json.loads(line), tokenizer, qwen_template, 4096)
+    assert [prompt.role for prompt in prompts] == [
+        "function_call",
+        "assistant",
+        "assistant",
+    ]
+    first_target = sample["target_mask"].index(1)
+    assert prompts[1].input_ids == sample["input_ids"][:first_target]
+
+
+def test_stop_tokens_follow_the_template(tiny):
+    tokenizer = AutoTokenizer.from_pretrained(tiny[0])
+    assert tokenizer.convert_tokens_to_ids("<|im_end|>") in stop_token_ids(
+        tokenizer, qwen_template
+    )
+
+
+def test_hot_swaps_adapters_on_one_base_model(tiny, monkeypatch):
+    model_dir, adapters, data = tiny
+    loads = []
+    load_model = demo.load_model
+    monkeypatch.setattr(
+        demo, "load_model", lambda *args: loads.append(args) or load_model(*args)
+    )
+
+    harness = AdapterHarness(model_dir, qwen_template, device="cpu")
+    for name, path in adapters.items():
+        harness.add_adapter(name, path)
+    prompts = load_prompts(
+        data, harness.tokenizer, qwen_template, max_prompts=12, max_prompt_tokens=512
+    )
+    reports = [
+        harness.run(name, prompts, max_new_tokens=8) for name in [None, *adapters]
+    ]
+
+    assert len(loads) == 1
+    assert [report["adapter"] for report in reports] == [None, "adapter-1", "adapter-2"]
+    for report in reports:
+        assert report["prompts"] == 12 and report["function_call_prompts"] == 4
+        assert 0 <= report["parse_rate"] <= 1 and 0 <= report["stop_rate"] <= 1
+        assert report["generated_tokens"] > 0 and report["tokens_per_sec"] > 0
+    # every adapter changes what the model generates
+    assert len({tuple(report["examples"]) for report in reports}) == 3
+
+
+def test_batched_generation_matches_one_by_one(tiny):
+    model_dir, _, data = tiny
+    model = AutoModelForCausalLM.from_pretrained(model_dir).eval()
+    tokenizer = AutoTokenizer.from_pretrained(model_dir)
+    prompts = load_prompts(
+        data, tokenizer, qwen_template, max_prompts=8, max_prompt_tokens=512
+    )
+    stop_ids = stop_token_ids(tokenizer, qwen_template)
+    batched = generate(
+        model, tokenizer, prompts, stop_ids, max_new_tokens=8, max_batch_size=8
+    )
+    single = generate(
+        model, tokenizer, prompts, stop_ids, max_new_tokens=8, max_batch_size=1
+    )
+    assert [output["tokens"] for output in batched] == [
+        output["tokens"] for output in single
+    ]
@@ -0,0 +1,83 @@
+import pytest
+import torch
+from peft import LoraConfig, get_peft_model
+from transformers import AutoModelForCausalLM
+
+from dataset import SFTDataCollator, SFTDataset
+from utils.constants import qwen_template
+from utils.local_eval import evaluate_model, length_sorted_batches, split_holdout
+from utils.synthetic import build_tiny_model, build_tokenizer, write_conversations
+
+
+@pytest.fixture(scope="module")
+def tiny(tmp_path_factory):
+    root = tmp_path_factory.mktemp("tiny")
+    tokenizer = build_tokenizer(str(root / "model"))
+    build_tiny_model(str(root / "model"), tokenizer)
+    write_conversations(str(root / "eval.jsonl"), num_samples=12, turns=3)
+    return root, tokenizer
+
+
+def test_split_holdout(tmp_path):
+    data = tmp_path / "data.jsonl"
+    write_conversations(str(data), num_samples=20)
+    rows = data.read_text().splitlines()
+    assert split_holdout(str(data), str(tmp_path / "eval.jsonl"), 0.25) == 5
+    train, held = (
+        data.read_text().splitlines(),
+        (tmp_path / "eval.jsonl").read_text().splitlines(),
+    )
+    assert len(held) == 5 and sorted(train + held) == sorted(rows)
+
+
+def test_length_sorted_batches():
+    lengths = [5, 100, 7, 90, 6, 95]
+    batches = length_sorted_batches(lengths, max_tokens=200, max_batch_size=4)
+    assert batches == [[1, 5], [3, 2], [4, 0]]
+    assert sorted(i for batch in batches for i in batch) == list(range(6))
+
+
+def test_matches_per_sample_model_loss(tiny):
+    root, tokenizer = tiny
+    model = AutoModelForCausalLM.from_pretrained(str(root / "model"))
+    metrics = evaluate_model(
+        model,
+        tokenizer,
+        qwen_template,
+        str(root / "eval.jsonl"),
+        max_seq_length=256,
+        max_tokens=512,
+    )
+
+    dataset = SFTDataset(str(root / "eval.jsonl"), tokenizer, 256, qwen_template)
+    collator = SFTDataCollator(tokenizer, 256)
+    with torch.no_grad():
+        expected = [
+            model(**collator([dataset[i]])).loss.item() for i in range(len(dataset))
+        ]
+    assert metrics["samples"] == len(dataset)
+    assert metrics["loss"] == pytest.approx(sum(expected) / len(expected), rel=1e-4)
+    assert model.training is False
+
+
+def test_chunked_scoring_through_an_adapter(tiny):
+    root, tokenizer = tiny
+    model = AutoModelForCausalLM.from_pretrained(str(root / "model"))
+    expected = evaluate_model(
+        model, tokenizer, qwen_template, str(root / "eval.jsonl"), max_seq_length=256
+    )
+    # a fresh LoRA adds zero, the adapter's model scores like its base, however the positions are chunked
+    peft_model = get_peft_model(
+        model,
+        LoraConfig(r=2, target_modules=["q_proj", "v_proj"], task_type="CAUSAL_LM"),
+    )
+    metrics = evaluate_model(
+        peft_model,
+        tokenizer,
+        qwen_template,
+        str(root / "eval.jsonl"),
+        max_seq_length=256,
+        loss_chunk_size=3,
+    )
+    assert metrics["loss"] == pytest.approx(expected["loss"], rel=1e-5)
+    assert metrics["tokens"] == expected["tokens"]
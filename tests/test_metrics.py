@@ -0,0 +1,78 @@
+import socket
+import urllib.request
+
+import pytest
+
+from utils.metrics import REGISTRY, Registry, start_exporter, write_textfile
+from utils.run_ledger import end_run, span, start_run
+
+
+def test_render_prometheus_text():
+    registry = Registry()
+    registry.inc("flock_tasks_fetched_total")
+    registry.inc("flock_tasks_fetched_total")
+    registry.set("flock_train_tokens_per_second", 1234.5, model="Qwen/Qwen1.5-0.5B")
+    text = registry.render()
+    assert (
+        "# TYPE flock_tasks_fetched_total counter\nflock_tasks_fetched_total 2\n"
+        in text
+    )
+    assert 'flock_train_tokens_per_second{model="Qwen/Qwen1.5-0.5B"} 1234.5' in text
+
+
+def test_merge_adds_counters_and_replaces_gauges():
+    registry, worker = Registry(), Registry()
+    registry.inc("flock_train_samples_total", 3, model="a")
+    registry.set("flock_train_tokens_per_second", 10.0, model="a")
+    worker.inc("flock_train_samples_total", 2, model="a")
+    worker.set("flock_train_tokens_per_second", 20.0, model="a")
+    worker.set("flock_stage_duration_seconds", 5.0, stage="train")
+    registry.merge(worker.snapshot())
+    assert registry.get("flock_train_samples_total", model="a") == 5
+    assert registry.get("flock_train_tokens_per_second", model="a") == 20.0
+    assert registry.get("flock_stage_duration_seconds", stage="train") == 5.0
+
+
+def test_pipeline_spans_update_metrics(tmp_path):
+    fetched = REGISTRY.get("flock_tasks_fetched_total") or 0
+    failures = REGISTRY.get("flock_submit_failures_total") or 0
+    start_run(1, ledger_dir=str(tmp_path))
+    try:
+        with span("fetch_task"):
+            assert REGISTRY.get("flock_stage", stage="fetch_task") == 1
+        with span("download") as record:
+            record["bytes"] = 10_000
+        with pytest.raises(RuntimeError):
+            with span("submit", "model-a"):
+                raise RuntimeError("ledger down")
+    finally:
+        end_run()
+
+    assert REGISTRY.get("flock_stage", stage="fetch_task") == 0
+    assert REGISTRY.get("flock_tasks_fetched_total") == fetched + 1
+    assert REGISTRY.get("flock_submit_failures_total") == failures + 1
+    assert REGISTRY.get("flock_download_bytes_per_second") > 0
+    assert REGISTRY.get("flock_peak_rss_bytes") > 0
+
+    path = str(tmp_path / "node.prom")
+    write_textfile(path)
+    assert "flock_download_bytes_per_second" in open(path).read()
+
+
+def test_metrics_endpoint():
+    # port 0 disables the endpoint, so pick a free one
+    server = start_exporter(port=_free_port())
+    try:
+        with urllib.request.urlopen(
+            f"http://127.0.0.1:{server.server_port}/metrics"
+        ) as response:
+            assert response.headers["Content-Type"].startswith("text/plain")
+            assert response.read().decode() == REGISTRY.render()
+    finally:
+        server.shutdown()
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
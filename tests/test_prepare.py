@@ -0,0 +1,134 @@
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import utils.prepare as prepare
+from dataset import SFTDataset
+from utils.constants import qwen_template
+from utils.prepare import Preparation, line_key
+from utils.synthetic import build_tokenizer, write_conversations
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def data_url(tmp_path):
+    served = tmp_path / "served"
+    served.mkdir()
+    write_conversations(str(served / "task.jsonl"), num_samples=40, tool_turns=1)
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), partial(QuietHandler, directory=str(served))
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/task.jsonl"
+    server.shutdown()
+
+
+@pytest.fixture
+def snapshot(tmp_path, monkeypatch):
+    # the hub stand-in: a local folder handed out for any model id
+    folder = tmp_path / "snapshot"
+    tokenizer = build_tokenizer(str(folder))
+    calls = []
+
+    def snapshot_download(model_id, token=None, allow_patterns=None):
+        calls.append((model_id, allow_patterns))
+        return str(folder)
+
+    monkeypatch.setattr(prepare, "snapshot_download", snapshot_download)
+    return tokenizer, calls
+
+
+def test_prefetches_and_tokenizes_while_downloading(tmp_path, data_url, snapshot):
+    tokenizer, calls = snapshot
+    extra = tmp_path / "extra.jsonl"
+    write_conversations(str(extra), num_samples=10, seed=1)
+    merged = tmp_path / "merged.jsonl"
+
+    preparation = Preparation(
+        "org/model", qwen_template, 128, cache_bytes=1 << 20, chunk_lines=8
+    )
+    preparation.start(extra_path=str(extra))
+    size, rows = preparation.download(data_url, str(tmp_path / "task.jsonl"))
+    assert rows == 40 and size == (tmp_path / "task.jsonl").stat().st_size
+
+    # what merge_datasets writes: the task data then the extra data, stripped
+    lines = (
+        tmp_path / "task.jsonl"
+    ).read_text().splitlines() + extra.read_text().splitlines()
+    merged.write_text("".join(line.strip() + "\n" for line in lines))
+    preparation.wait()
+    preparation.prefetch_thread.join()
+    # the tokenizer files first, then the weights
+    assert [patterns for _, patterns in calls] == [
+        prepare.TOKENIZER_PATTERNS,
+        prepare.TOKENIZER_PATTERNS + prepare.WEIGHT_PATTERNS,
+    ]
+
+    cache = preparation.build_cache(str(merged))
+    try:
+        assert cache.stats()["entries"] == 50
+        dataset = SFTDataset(str(merged), tokenizer, 128, qwen_template, cache=cache)
+        for index in range(len(dataset)):
+            expected = dataset.tokenize(dataset.read_line(index))
+            sample = dataset[index]
+            assert sample["input_ids"].tolist() == expected["input_ids"]
+            assert sample["target_mask"].tolist() == expected["target_mask"]
+        assert cache.stats()["misses"] == 0
+    finally:
+        cache.close()
+
+
+def test_stops_at_the_cache_budget(tmp_path, data_url, snapshot):
+    preparation = Preparation(
+        "org/model", qwen_template, 128, cache_bytes=2000, chunk_lines=4
+    )
+    preparation.start()
+    preparation.download(data_url, str(tmp_path / "task.jsonl"))
+    preparation.wait()
+    assert 0 < len(preparation.samples) < 40
+    assert preparation.sample_bytes >= 2000
+
+
+def test_without_a_cache_only_prefetches(tmp_path, data_url, snapshot):
+    _, calls = snapshot
+    preparation = Preparation("org/model", qwen_template, 128)
+    preparation.start()
+    preparation.download(data_url, str(tmp_path / "task.jsonl"))
+    preparation.wait()
+    preparation.prefetch_thread.join()
+    assert len(calls) == 2
+    assert preparation.pool is None and not preparation.samples
+    assert preparation.build_cache(str(tmp_path / "task.jsonl")) is None
+
+
+def test_wait_does_not_block_on_the_weights(tmp_path, data_url, snapshot, monkeypatch):
+    tokenizer, calls = snapshot
+    fetch = prepare.snapshot_download
+    weights_fetched = threading.Event()
+
+    def slow_weights(model_id, token=None, allow_patterns=None):
+        if allow_patterns != prepare.TOKENIZER_PATTERNS:
+            weights_fetched.wait(30)
+        return fetch(model_id, token=token, allow_patterns=allow_patterns)
+
+    monkeypatch.setattr(prepare, "snapshot_download", slow_weights)
+    preparation = Preparation(
+        "org/model", qwen_template, 128, cache_bytes=1 << 20, chunk_lines=8
+    )
+    preparation.start()
+    preparation.download(data_url, str(tmp_path / "task.jsonl"))
+    preparation.wait()
+    # tokenized while the weights are still downloading
+    assert len(preparation.samples) == 40 and preparation.prefetch_thread.is_alive()
+    weights_fetched.set()
+    preparation.prefetch_thread.join()
+
+
+def test_line_key_ignores_surrounding_whitespace():
+    assert line_key(b'{"a": 1}\n') == line_key('{"a": 1}') != line_key('{"a": 2}')
@@ -0,0 +1,70 @@
+import os
+
+import pytest
+from transformers import AutoModelForCausalLM, Trainer, TrainingArguments
+
+from dataset import SFTDataCollator, SFTDataset
+from utils.constants import qwen_template
+from utils.profiling import ProfilerCallback, profile_data_pipeline
+from utils.synthetic import build_tiny_model, build_tokenizer, write_conversations
+
+
+@pytest.fixture(scope="module")
+def tiny(tmp_path_factory):
+    root = tmp_path_factory.mktemp("tiny")
+    tokenizer = build_tokenizer(str(root / "model"))
+    build_tiny_model(str(root / "model"), tokenizer)
+    write_conversations(str(root / "data.jsonl"), num_samples=16)
+    return root, tokenizer
+
+
+def test_profile_training_window_on_cpu(tiny, tmp_path):
+    root, tokenizer = tiny
+    dataset = SFTDataset(str(root / "data.jsonl"), tokenizer, 128, qwen_template)
+    collator = SFTDataCollator(tokenizer, max_seq_length=128)
+    profile_dir = str(tmp_path / "profile")
+
+    profile_data_pipeline(dataset, collator, profile_dir, batch_size=2, num_batches=4)
+    assert os.path.exists(os.path.join(profile_dir, "data_pipeline.prof"))
+    with open(os.path.join(profile_dir, "data_pipeline.txt")) as f:
+        assert "tokenize" in f.read()
+
+    trainer = Trainer(
+        model=AutoModelForCausalLM.from_pretrained(str(root / "model")),
+        args=TrainingArguments(
+            output_dir=str(tmp_path / "outputs"),
+            per_device_train_batch_size=2,
+            max_steps=5,
+            use_cpu=True,
+            report_to=[],
+            remove_unused_columns=False,
+        ),
+        train_dataset=dataset,
+        data_collator=collator,
+        callbacks=[ProfilerCallback(profile_dir, active=2)],
+    )
+    trainer.train()
+
+    assert os.path.exists(os.path.join(profile_dir, "trace_step4.json"))
+    with open(os.path.join(profile_dir, "operators.txt")) as f:
+        assert "aten::" in f.read()
+
+
+def test_profiling_leaves_the_sample_cache_alone(tiny, tmp_path):
+    root, tokenizer = tiny
+    dataset = SFTDataset(
+        str(root / "data.jsonl"), tokenizer, 128, qwen_template, cache_size_mb=1
+    )
+    try:
+        profile_data_pipeline(
+            dataset,
+            SFTDataCollator(tokenizer, max_seq_length=128),
+            str(tmp_path / "profile"),
+            batch_size=2,
+            num_batches=4,
+        )
+        assert dataset.cache is not None
+        stats = dataset.cache.stats()
+        assert (stats["hits"], stats["misses"], stats["entries"]) == (0, 0, 0)
+    finally:
+        dataset.cache.close()
@@ -0,0 +1,113 @@
+import os
+
+import pytest
+
+from demo import LoraTrainingArguments, train_lora
+from utils import run_ledger
+from utils.constants import model2template, qwen_template
+from utils.metrics import REGISTRY
+from utils.run_ledger import (
+    annotate,
+    end_run,
+    format_summary,
+    load_spans,
+    span,
+    start_run,
+    summarize,
+)
+from utils.synthetic import build_tiny_model, build_tokenizer, write_conversations
+
+
+@pytest.fixture
+def ledger_dir(tmp_path):
+    path = str(tmp_path / "runs")
+    start_run(3, ledger_dir=path)
+    yield path
+    end_run()
+
+
+def test_spans_are_appended_per_task(ledger_dir):
+    with span("download") as record:
+        record["bytes"] = 1024
+    with span("upload", "model-a"):
+        annotate(bytes=10, rows=2)
+    with pytest.raises(RuntimeError):
+        with span("submit", "model-a"):
+            raise RuntimeError("ledger down")
+
+    spans = load_spans([ledger_dir])
+    assert [s["stage"] for s in spans] == ["download", "upload", "submit"]
+    assert {s["task_id"] for s in spans} == {"3"} and len(
+        {s["run_id"] for s in spans}
+    ) == 1
+    assert (
+        spans[0]["bytes"] == 1024
+        and spans[1]["rows"] == 2
+        and spans[0]["peak_rss_mb"] > 0
+    )
+    assert spans[2]["status"] == "error" and "ledger down" in spans[2]["error"]
+
+    # outside of a run nothing is written
+    end_run()
+    with span("download"):
+        pass
+    assert len(load_spans([ledger_dir])) == 3
+
+
+def test_summary_percentiles_and_throughput():
+    spans = [
+        {
+            "stage": "train",
+            "status": "ok",
+            "duration_s": float(d),
+            "tokens": 100 * d,
+            "model_id": "m",
+            "gpu_type": "cpu",
+        }
+        for d in range(1, 21)
+    ] + [{"stage": "submit", "status": "error", "duration_s": 1.0}]
+    summary = summarize(spans)
+    assert summary["stages"]["train"] == {
+        "count": 20,
+        "failures": 0,
+        "p50_s": 10.0,
+        "p95_s": 19.0,
+    }
+    assert (
+        summary["stages"]["submit"]["failures"] == 1
+        and summary["stages"]["submit"]["p50_s"] is None
+    )
+    assert summary["tokens_per_sec"] == [
+        {"model_id": "m", "gpu_type": "cpu", "runs": 20, "p50": 100.0, "p95": 100.0}
+    ]
+    assert "submit" in format_summary(summary)
+
+
+def test_train_lora_records_stages(ledger_dir, tmp_path, monkeypatch):
+    model_dir = str(tmp_path / "tiny-qwen")
+    build_tiny_model(model_dir, build_tokenizer(model_dir))
+    write_conversations(str(tmp_path / "train.jsonl"), num_samples=6)
+    monkeypatch.setitem(model2template, model_dir, qwen_template)
+    monkeypatch.chdir(tmp_path)
+
+    train_lora(
+        model_id=model_dir,
+        context_length=64,
+        training_args=LoraTrainingArguments(
+            per_device_train_batch_size=2,
+            gradient_accumulation_steps=1,
+            num_train_epochs=2,
+            lora_rank=2,
+            lora_alpha=4,
+            lora_dropout=0.0,
+            device="cpu",
+        ),
+        data_file=str(tmp_path / "train.jsonl"),
+    )
+    spans = {s["stage"]: s for s in load_spans([ledger_dir])}
+    assert set(spans) == {"load_model", "load_dataset", "train"}
+    assert spans["load_dataset"]["rows"] == 6
+    assert spans["train"]["rows"] == 12 and spans["train"]["tokens"] > 0
+    assert os.path.basename(os.environ[run_ledger.LEDGER_ENV]) == "task-3.jsonl"
+    # the metrics callback read the same collator counters
+    assert REGISTRY.get("flock_train_samples_total", model=model_dir) == 12
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+from torch.utils.data import DataLoader
+
+from dataset import SFTDataCollator, SFTDataset
+from utils.constants import qwen_template
+from utils.sample_cache import SampleCache
+from utils.synthetic import build_tokenizer, write_conversations
+
+
+@pytest.fixture(scope="module")
+def tokenizer(tmp_path_factory):
+    return build_tokenizer(str(tmp_path_factory.mktemp("tokenizer")))
+
+
+@pytest.fixture
+def data_file(tmp_path):
+    path = tmp_path / "data.jsonl"
+    write_conversations(str(path), num_samples=32)
+    return str(path)
+
+
+def test_cache_roundtrip_and_eviction():
+    cache = SampleCache(num_samples=4, max_bytes=64)
+    try:
+        assert cache.get(0) is None
+        assert cache.put(0, [1, 2, 3], [0, 1, 1])
+        ids, mask = cache.get(0)
+        assert ids.dtype == np.int32 and mask.dtype == np.uint8
+        assert ids.tolist() == [1, 2, 3] and mask.tolist() == [0, 1, 1]
+
+        # 8-token entries take 40 bytes, the third put wraps and overwrites both earlier ones
+        cache.put(1, list(range(8)), [1] * 8)
+        cache.put(2, list(range(8)), [1] * 8)
+        assert cache.get(0) is None and cache.get(1) is None
+        assert cache.get(2)[0].tolist() == list(range(8))
+        stats = cache.stats()
+        assert stats["evictions"] == 2 and stats["entries"] == 1
+        assert stats["bytes_per_sample"] == 40
+    finally:
+        cache.close()
+
+
+def test_cached_samples_match_uncached(tokenizer, data_file):
+    plain = SFTDataset(data_file, tokenizer, 128, qwen_template)
+    cached = SFTDataset(data_file, tokenizer, 128, qwen_template, cache_size_mb=1)
+    try:
+        for _ in range(2):
+            for i in range(len(plain)):
+                expected, actual = plain[i], cached[i]
+                assert "attention_mask" not in actual
+                assert list(actual["input_ids"]) == expected["input_ids"]
+                assert list(actual["target_mask"]) == expected["target_mask"]
+        assert cached.cache.stats()["hit_rate"] == pytest.approx(0.5)
+
+        collator = SFTDataCollator(tokenizer, max_seq_length=128)
+        batch = [cached[i] for i in range(4)]
+        reference = collator([plain[i] for i in range(4)])
+        for key, value in collator(batch).items():
+            assert value.equal(reference[key])
+    finally:
+        cached.cache.close()
+
+
+def test_cache_shared_across_workers(tokenizer, data_file):
+    dataset = SFTDataset(data_file, tokenizer, 128, qwen_template, cache_size_mb=1)
+    collator = SFTDataCollator(tokenizer, max_seq_length=128)
+    try:
+        loader = DataLoader(dataset, batch_size=4, num_workers=2, collate_fn=collator)
+        for _ in range(2):
+            for _ in loader:
+                pass
+        stats = dataset.cache.stats()
+        assert stats["entries"] == len(dataset)
+        assert stats["hits"] == len(dataset)
+    finally:
+        dataset.cache.close()
@@ -0,0 +1,164 @@
+import os
+import shutil
+import time
+
+import pytest
+
+from utils.scheduler import Job, WorkerSpec, run_jobs
+from utils.synthetic import build_tiny_model, build_tokenizer, write_conversations
+
+
+def tiny_train_job(job):
+    # runs in a spawned worker, so register the local model there
+    from demo import LoraTrainingArguments, train_lora
+    from utils.constants import model2template, qwen_template
+
+    model2template[job.args["model_dir"]] = qwen_template
+    train_lora(
+        model_id=job.args["model_dir"],
+        context_length=64,
+        training_args=LoraTrainingArguments(
+            per_device_train_batch_size=2,
+            gradient_accumulation_steps=1,
+            num_train_epochs=1,
+            lora_rank=4,
+            lora_alpha=8,
+            lora_dropout=0.0,
+        ),
+        data_file=job.args["data_file"],
+        output_dir=job.args["output_dir"],
+    )
+    return {
+        "device": os.environ["TRAIN_DEVICE"],
+        "affinity": sorted(os.sched_getaffinity(0)),
+    }
+
+
+def registered_train_job(job):
+    # the pipeline's own job, with the local model registered in the worker
+    import full_automation
+    from utils.constants import model2template, qwen_template
+
+    model2template[job.model_id] = qwen_template
+    return full_automation.train_job(job)
+
+
+def failing_job(job):
+    if job.args["mode"] == "raise":
+        raise RuntimeError("CUDA out of memory")
+    # what the OOM killer leaves behind: no exception, no result
+    os._exit(137)
+
+
+def timing_job(job):
+    start = time.time()
+    time.sleep(job.args["sleep"])
+    return start
+
+
+@pytest.fixture(scope="module")
+def tiny(tmp_path_factory):
+    root = tmp_path_factory.mktemp("tiny")
+    model_dir = str(root / "model")
+    build_tiny_model(model_dir, build_tokenizer(model_dir))
+    write_conversations(str(root / "data.jsonl"), num_samples=4)
+    return root, model_dir
+
+
+def two_cpu_workers():
+    cpu = sorted(os.sched_getaffinity(0))[0]
+    return [WorkerSpec("cpu:a", cpus=[cpu]), WorkerSpec("cpu:b", cpus=[cpu])]
+
+
+def test_trains_tiny_models_on_two_cpu_workers(tiny):
+    root, model_dir = tiny
+    jobs = [
+        Job(
+            model_id=f"tiny-{i}",
+            args={
+                "model_dir": model_dir,
+                "data_file": str(root / "data.jsonl"),
+                "output_dir": str(root / f"outputs-{i}"),
+            },
+        )
+        for i in range(2)
+    ]
+    received = []
+    results = run_jobs(
+        jobs, two_cpu_workers(), tiny_train_job, on_result=received.append
+    )
+
+    assert received == results
+    assert {r.worker for r in results} == {"cpu:a", "cpu:b"}
+    for i, result in enumerate(sorted(results, key=lambda r: r.model_id)):
+        assert result.ok, result.error
+        assert result.value["device"] == "cpu" and len(result.value["affinity"]) == 1
+        assert os.path.exists(root / f"outputs-{i}" / "adapter_model.safetensors")
+
+
+def test_failures_are_isolated():
+    jobs = [
+        Job("raises", {"mode": "raise"}),
+        Job("killed", {"mode": "kill"}),
+    ]
+    results = {
+        r.model_id: r
+        for r in run_jobs(jobs, two_cpu_workers(), failing_job, poll_interval=0.1)
+    }
+
+    assert not results["raises"].ok and "CUDA out of memory" in results["raises"].error
+    assert not results["killed"].ok and results["killed"].exitcode == 137
+
+    # the pool keeps going after a crash
+    results = run_jobs([Job("after", {"sleep": 0})], two_cpu_workers(), timing_job)
+    assert results[0].ok
+
+
+def test_longest_jobs_start_first():
+    jobs = [Job(f"job-{cost}", {"sleep": 0.5}, cost=cost) for cost in (1, 3, 2, 4)]
+    results = run_jobs(jobs, two_cpu_workers(), timing_job, poll_interval=0.05)
+    started = sorted(results, key=lambda r: r.value)
+    assert {r.model_id for r in started[:2]} == {"job-4", "job-3"}
+
+
+def test_worker_metrics_reach_the_parent(tiny, tmp_path, monkeypatch):
+    # read on import, by this process and the worker
+    monkeypatch.setenv("FLOCK_API_KEY", "key")
+    monkeypatch.setenv("HF_USERNAME", "user")
+    monkeypatch.setenv("HF_TOKEN", "unused")
+    import full_automation
+    from utils.metrics import REGISTRY
+    from utils.workspace import Workspace
+
+    root, model_dir = tiny
+    workspace = Workspace(1, "run-a", root=str(tmp_path / "workspaces"))
+    os.makedirs(os.path.dirname(workspace.data_file), exist_ok=True)
+    shutil.copy(root / "data.jsonl", workspace.data_file)
+    submitted = []
+    monkeypatch.setattr(
+        full_automation, "plan_warm_start", lambda *args, **kwargs: None
+    )
+    monkeypatch.setattr(full_automation, "train_job", registered_train_job)
+    monkeypatch.setattr(
+        full_automation,
+        "submit_and_cleanup",
+        lambda *args, **kwargs: submitted.append(args[2]),
+    )
+    samples = REGISTRY.get("flock_train_samples_total", model=model_dir) or 0
+
+    args = {
+        "per_device_train_batch_size": 2,
+        "gradient_accumulation_steps": 1,
+        "num_train_epochs": 1,
+        "lora_rank": 4,
+        "lora_alpha": 8,
+        "lora_dropout": 0.0,
+    }
+    full_automation.train_models_parallel(
+        1, workspace, {model_dir: args}, 64, two_cpu_workers()[:1]
+    )
+
+    assert submitted == [model_dir]
+    # counted in the worker, merged into this process's registry
+    assert REGISTRY.get("flock_train_samples_total", model=model_dir) == samples + 4
+    assert REGISTRY.get("flock_train_tokens_per_second", model=model_dir) is not None
@@ -0,0 +1,227 @@
+import gzip
+import json
+import os
+import shutil
+
+import pytest
+from torch.utils.data import DataLoader
+
+import demo
+from dataset import ConversationTokenizer, SFTDataCollator, StreamingSFTDataset
+from demo import LoraTrainingArguments, train_lora
+from utils.constants import model2template, qwen_template
+from utils.synthetic import build_tiny_model, build_tokenizer, write_conversations
+
+
+@pytest.fixture(scope="module")
+def tokenizer(tmp_path_factory):
+    return build_tokenizer(str(tmp_path_factory.mktemp("tokenizer")))
+
+
+@pytest.fixture
+def files(tmp_path):
+    first, second = str(tmp_path / "task.jsonl"), str(tmp_path / "extra.jsonl")
+    write_conversations(first, num_samples=30, tool_turns=1)
+    write_conversations(second, num_samples=20, seed=1)
+    # gzip input streams the same way
+    with open(second, "rb") as src, gzip.open(second + ".gz", "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    return [first, second + ".gz"]
+
+
+def stream(tokenizer, files, **kwargs):
+    return StreamingSFTDataset(files, tokenizer, 128, qwen_template, **kwargs)
+
+
+def key(sample):
+    return tuple(sample["input_ids"])
+
+
+def reference(tokenizer, files):
+    conversations = ConversationTokenizer(tokenizer, 128, qwen_template)
+    keys = []
+    for path in files:
+        with gzip.open(path, "rt") if path.endswith(".gz") else open(path) as f:
+            keys.extend(key(conversations.tokenize(line)) for line in f if line.strip())
+    return keys
+
+
+def test_every_sample_once_per_epoch_and_reshuffled(tokenizer, files):
+    dataset = stream(tokenizer, files, shuffle_buffer=8, rank=0, world_size=1)
+    expected = reference(tokenizer, files)
+    assert dataset.count_lines() == len(expected) == 50
+
+    first = [key(sample) for sample in dataset]
+    assert sorted(first) == sorted(expected) and first != expected
+    assert [key(sample) for sample in dataset] == first
+    dataset.set_epoch(1)
+    second = [key(sample) for sample in dataset]
+    assert sorted(second) == sorted(expected) and second != first
+
+
+def test_shards_across_ranks_and_workers(tokenizer, files):
+    expected = sorted(reference(tokenizer, files))
+    seen = []
+    for rank in range(2):
+        dataset = stream(tokenizer, files, shuffle_buffer=4, rank=rank, world_size=2)
+        loader = DataLoader(dataset, batch_size=None, num_workers=2)
+        seen.extend(key(sample) for sample in loader)
+    assert sorted(seen) == expected
+
+
+def test_resumes_exactly_from_the_state(tokenizer, files):
+    uninterrupted = [
+        key(sample)
+        for sample in stream(tokenizer, files, shuffle_buffer=8, rank=0, world_size=1)
+    ]
+
+    dataset = stream(tokenizer, files, shuffle_buffer=8, rank=0, world_size=1)
+    iterator = iter(dataset)
+    head = [key(next(iterator)) for _ in range(35)]
+    # past the first file, into the gzip one
+    state = json.loads(json.dumps(dataset.state_dict()))
+    assert (
+        state["shards"]["0"]["file"] == 1 and len(state["shards"]["0"]["buffer"]) == 8
+    )
+
+    resumed = stream(tokenizer, files, shuffle_buffer=8, rank=0, world_size=1)
+    resumed.load_state_dict(state)
+    assert head + [key(sample) for sample in resumed] == uninterrupted
+
+
+def test_keeps_states_behind_the_read_position(tokenizer, files):
+    dataset = stream(
+        tokenizer, files, shuffle_buffer=8, rank=0, world_size=1, keep_states=4
+    )
+    samples = [key(sample) for sample in dataset]
+    assert dataset.state_dict(samples=10) is None
+
+    dataset = stream(
+        tokenizer, files, shuffle_buffer=8, rank=0, world_size=1, keep_states=4
+    )
+    iterator = iter(dataset)
+    for _ in range(12):
+        next(iterator)
+    state = dataset.state_dict(samples=10)
+    resumed = stream(tokenizer, files, shuffle_buffer=8, rank=0, world_size=1)
+    resumed.load_state_dict(state)
+    assert [key(sample) for sample in resumed] == samples[10:]
+
+
+def test_sparse_states_replay_to_the_sample(tokenizer, files):
+    samples = [
+        key(sample)
+        for sample in stream(tokenizer, files, shuffle_buffer=8, rank=0, world_size=1)
+    ]
+
+    dataset = stream(
+        tokenizer,
+        files,
+        shuffle_buffer=8,
+        rank=0,
+        world_size=1,
+        keep_states=4,
+        state_interval=8,
+    )
+    iterator = iter(dataset)
+    for _ in range(20):
+        next(iterator)
+    # kept at 8 and 16, the state after 19 replays 3 samples from the one at 16
+    assert dataset.state_dict(samples=19)["skip"] == 3
+    resumed = stream(tokenizer, files, shuffle_buffer=8, rank=0, world_size=1)
+    resumed.load_state_dict(json.loads(json.dumps(dataset.state_dict(samples=19))))
+    assert [key(sample) for sample in resumed] == samples[19:]
+
+    # at the end of an epoch the next one starts, with the epochs counted from it
+    for _ in iterator:
+        pass
+    resumed = stream(tokenizer, files, shuffle_buffer=8, rank=0, world_size=1)
+    resumed.load_state_dict(dataset.state_dict(samples=50))
+    resumed.set_epoch(0)
+    dataset.set_epoch(1)
+    assert [key(sample) for sample in resumed] == [key(sample) for sample in dataset]
+
+
+def test_interrupted_run_resumes_with_the_remaining_samples(tmp_path, monkeypatch):
+    model_dir = str(tmp_path / "tiny-qwen")
+    build_tiny_model(model_dir, build_tokenizer(model_dir))
+    # an odd count, the first epoch ends on a partial batch
+    write_conversations(str(tmp_path / "train.jsonl"), num_samples=11)
+    monkeypatch.setitem(model2template, model_dir, qwen_template)
+    monkeypatch.chdir(tmp_path)
+    build_sft_config = demo.build_sft_config
+    monkeypatch.setattr(
+        demo,
+        "build_sft_config",
+        lambda *args, **kwargs: build_sft_config(*args, **kwargs, save_steps=2),
+    )
+    batches, interrupt_at = [], None
+
+    class RecordingCollator(SFTDataCollator):
+        def __call__(self, batch):
+            batches.append([key(sample) for sample in batch])
+            if len(batches) == interrupt_at:
+                raise RuntimeError("preempted")
+            return super().__call__(batch)
+
+    monkeypatch.setattr(demo, "SFTDataCollator", RecordingCollator)
+
+    def train(output_dir):
+        train_lora(
+            model_id=model_dir,
+            context_length=128,
+            training_args=LoraTrainingArguments(
+                per_device_train_batch_size=2,
+                gradient_accumulation_steps=1,
+                num_train_epochs=2,
+                lora_rank=4,
+                lora_alpha=8,
+                lora_dropout=0.0,
+                device="cpu",
+                streaming=True,
+                shuffle_buffer=4,
+            ),
+            data_file=str(tmp_path / "train.jsonl"),
+            output_dir=output_dir,
+        )
+
+    train("uninterrupted")
+    uninterrupted, batches[:] = list(batches), []
+
+    # stopped in the second epoch, past the checkpoint of step 8
+    interrupt_at = 10
+    with pytest.raises(RuntimeError, match="preempted"):
+        train("outputs")
+    assert os.path.exists("outputs/checkpoint-8/stream_state.json")
+    interrupt_at, batches[:] = None, []
+    train("outputs")
+    assert batches == uninterrupted[8:]
+    assert os.path.exists("outputs/adapter_model.safetensors") and not os.path.exists(
+        "outputs/checkpoint-8"
+    )
+
+
+def test_train_lora_streaming(tmp_path, monkeypatch):
+    model_dir = str(tmp_path / "tiny-qwen")
+    build_tiny_model(model_dir, build_tokenizer(model_dir))
+    write_conversations(str(tmp_path / "train.jsonl"), num_samples=6)
+    monkeypatch.setitem(model2template, model_dir, qwen_template)
+    monkeypatch.chdir(tmp_path)
+
+    train_lora(
+        model_id=model_dir,
+        context_length=128,
+        training_args=LoraTrainingArguments(
+            per_device_train_batch_size=2,
+            gradient_accumulation_steps=1,
+            num_train_epochs=2,
+            lora_rank=4,
+            lora_alpha=8,
+            lora_dropout=0.0,
+            device="cpu",
+            streaming=True,
+            shuffle_buffer=4,
+        ),
+        data_file=str(tmp_path / "train.jsonl"),
+    )
+    assert os.path.exists("outputs/adapter_model.safetensors")
@@ -0,0 +1,153 @@
+import json
+import os
+import time
+
+import pytest
+import torch
+from safetensors.torch import load_file
+
+from sweep import TRIALS_FILE, rung_epochs, run_sweep, sample_trials, seconds_per_epoch
+from utils.constants import model2template, qwen_template
+from utils.synthetic import build_tiny_model, build_tokenizer, write_conversations
+
+SPEC = {
+    "num_trials": 3,
+    "reduction_factor": 3,
+    "lora_rank": [2, 4],
+    "lora_alpha": [4, 8],
+    "lora_dropout": 0.0,
+    "learning_rate": {"min": 1e-4, "max": 1e-2, "log": True},
+    "num_train_epochs": {"min": 1, "max": 2},
+}
+BASE_ARGS = {
+    "per_device_train_batch_size": 2,
+    "gradient_accumulation_steps": 1,
+    "num_train_epochs": 2,
+    "lora_rank": 8,
+    "lora_alpha": 16,
+    "lora_dropout": 0.1,
+    "device": "cpu",
+}
+
+
+@pytest.fixture
+def tiny(tmp_path, monkeypatch):
+    model_dir = str(tmp_path / "model")
+    build_tiny_model(model_dir, build_tokenizer(model_dir))
+    write_conversations(str(tmp_path / "train.jsonl"), num_samples=6)
+    write_conversations(str(tmp_path / "eval.jsonl"), num_samples=3, seed=1)
+    monkeypatch.setitem(model2template, model_dir, qwen_template)
+    return tmp_path, model_dir
+
+
+def test_sampling_and_rungs():
+    assert sample_trials(SPEC, seed=1) == sample_trials(SPEC, seed=1)
+    assert all(
+        1e-4 <= t["learning_rate"] <= 1e-2 and t["lora_rank"] in (2, 4)
+        for t in sample_trials(SPEC)
+    )
+    assert rung_epochs(1, 9, 3) == [1, 3, 9]
+    assert rung_epochs(1, 4, 3) == [1, 3, 4]
+
+
+def sweep(root, model_dir, deadline=None, **base_args):
+    return run_sweep(
+        model_id=model_dir,
+        spec=SPEC,
+        base_args=dict(BASE_ARGS, **base_args),
+        context_length=64,
+        data_file=str(root / "train.jsonl"),
+        eval_file=str(root / "eval.jsonl"),
+        sweep_dir=str(root / "sweep"),
+        output_dir=str(root / "outputs"),
+        deadline=deadline,
+    )
+
+
+def read_records(best):
+    with open(os.path.join(best["sweep_dir"], TRIALS_FILE)) as f:
+        return [json.loads(line) for line in f]
+
+
+def write_records(best, records):
+    with open(os.path.join(best["sweep_dir"], TRIALS_FILE), "w") as f:
+        f.writelines(json.dumps(r) + "\n" for r in records)
+
+
+def test_sweep_promotes_best_and_resumes(tiny):
+    root, model_dir = tiny
+    best = sweep(root, model_dir)
+
+    records = read_records(best)
+    # three trials at one epoch, the best one continues to two
+    assert [(r["rung"], r["epochs"]) for r in records] == [
+        (0, 1),
+        (0, 1),
+        (0, 1),
+        (1, 2),
+    ]
+    assert (
+        best["trial"]
+        == min(records[:3], key=lambda r: r["loss"])["trial"]
+        == records[3]["trial"]
+    )
+    assert os.path.exists(root / "outputs" / "adapter_model.safetensors")
+    assert os.path.exists(root / "outputs" / "tokenizer.json")
+
+    # drop the last finished trial as if the sweep was interrupted, only that one reruns
+    write_records(best, records[:3])
+    resumed = sweep(root, model_dir)
+    assert len(read_records(best)) == 4
+    assert resumed["trial"] == best["trial"]
+
+    # a recorded trial whose params differ from the sampled ones is trained again
+    records[1]["params"] = dict(records[1]["params"], lora_rank=64)
+    write_records(best, records)
+    sweep(root, model_dir)
+    rerun = read_records(best)[4]
+    assert (rerun["trial"], rerun["rung"]) == (records[1]["trial"], 0) and rerun[
+        "params"
+    ]["lora_rank"] != 64
+
+
+def test_sweep_on_new_data_starts_afresh(tiny):
+    root, model_dir = tiny
+    best = sweep(root, model_dir)
+
+    write_conversations(str(root / "train.jsonl"), num_samples=6, seed=5)
+    fresh = sweep(root, model_dir)
+    assert fresh["sweep_dir"] != best["sweep_dir"]
+    assert len(read_records(fresh)) == 4 and len(read_records(best)) == 4
+    assert fresh["adapter_dir"].startswith(fresh["sweep_dir"])
+
+
+def test_winner_is_exported_like_a_trained_adapter(tiny):
+    root, model_dir = tiny
+    sweep(root, model_dir, export_dtype="bfloat16")
+    weights = load_file(str(root / "outputs" / "adapter_model.safetensors"))
+    assert weights and all(
+        tensor.dtype == torch.bfloat16 for tensor in weights.values()
+    )
+
+
+def test_sweep_stops_promoting_at_the_deadline(tiny):
+    root, model_dir = tiny
+    # the first rung always runs, the second would end past the deadline
+    best = sweep(root, model_dir, deadline=time.time())
+    records = read_records(best)
+    assert [r["rung"] for r in records] == [0, 0, 0]
+    assert (
+        best["trial"] == min(records, key=lambda r: r["loss"])["trial"]
+        and best["epochs"] == 1
+    )
+    assert os.path.exists(root / "outputs" / "adapter_model.safetensors")
+
+
+def test_seconds_per_epoch_of_the_timed_trials():
+    records = {
+        (0, 0): {"epochs": 1, "duration_s": 10.0},
+        (1, 0): {"epochs": 1},
+        (0, 1): {"epochs": 3, "duration_s": 30.0},
+    }
+    assert seconds_per_epoch(records, [1, 3]) == pytest.approx(40 / 3)
+    assert seconds_per_epoch({}, [1, 3]) == 0.0
@@ -0,0 +1,30 @@
+import json
+
+from dataset import SFTDataset
+from utils.constants import qwen_template
+from utils.synthetic import build_tokenizer, write_conversations
+from validate_dataset import validate_dataset
+
+
+def test_tool_turns_match_dataset_schema(tmp_path):
+    path = str(tmp_path / "data.jsonl")
+    write_conversations(path, num_samples=5, turns=2, tool_turns=1)
+    roles = [
+        turn["role"] for turn in json.loads(open(path).readline())["conversations"]
+    ]
+    assert roles == [
+        "user",
+        "function_call",
+        "observation",
+        "assistant",
+        "user",
+        "assistant",
+    ]
+    assert validate_dataset(path) == (5, 0)
+
+    dataset = SFTDataset(
+        path, build_tokenizer(str(tmp_path / "tok")), 512, qwen_template
+    )
+    sample = dataset[0]
+    # the tool call and its result are context, only the two answers are trained on
+    assert 0 < sum(sample["target_mask"]) < len(sample["input_ids"])
@@ -0,0 +1,190 @@
+import json
+import os
+
+import pytest
+import torch
+from transformers import TrainerControl, TrainerState, TrainingArguments, get_scheduler
+
+import demo
+from demo import LoraTrainingArguments
+from utils import time_budget
+from utils.constants import model2template, qwen_template
+from utils.synthetic import build_tiny_model, build_tokenizer, write_conversations
+from utils.time_budget import (
+    TimeBudgetCallback,
+    post_train_reserve,
+    refit_lr_schedule,
+    split_deadline,
+)
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time_budget.time, "time", clock)
+    return clock
+
+
+def linear_schedule(steps, warmup=0):
+    optimizer = torch.optim.SGD([torch.nn.Parameter(torch.zeros(1))], lr=1.0)
+    args = TrainingArguments(
+        output_dir="unused",
+        lr_scheduler_type="linear",
+        warmup_steps=warmup,
+        report_to=[],
+    )
+    return (
+        args,
+        optimizer,
+        get_scheduler(
+            "linear", optimizer, num_warmup_steps=warmup, num_training_steps=steps
+        ),
+    )
+
+
+def test_deadline_is_split_by_cost(clock):
+    assert split_deadline(clock.now + 100, {"a": 3, "b": 1}) == {"a": 75, "b": 25}
+    # side by side a model may take the whole window, never more
+    assert split_deadline(clock.now + 100, {"a": 3, "b": 1}, workers=2) == {
+        "a": 100,
+        "b": 50,
+    }
+    # models of unknown size share it evenly
+    assert split_deadline(clock.now + 100, {"a": 0, "b": 0}) == {"a": 50, "b": 50}
+    assert split_deadline(clock.now - 5, {"a": 1}) == {"a": 0}
+
+
+def test_reserve_is_the_p95_of_the_stages_after_training(tmp_path):
+    assert post_train_reserve("org/model", str(tmp_path / "runs"), default=30) == 30
+    os.makedirs(tmp_path / "runs")
+    with open(tmp_path / "runs" / "task-1.jsonl", "w") as f:
+        for stage, model_id, duration, status in [
+            ("upload", "org/model", 10, "ok"),
+            ("upload", "org/model", 20, "ok"),
+            ("submit", "org/model", 2, "ok"),
+            ("upload", "org/model", 500, "error"),
+            ("train", "org/model", 900, "ok"),
+            ("upload", "org/other", 300, "ok"),
+        ]:
+            f.write(
+                json.dumps(
+                    {
+                        "stage": stage,
+                        "model_id": model_id,
+                        "duration_s": duration,
+                        "status": status,
+                    }
+                )
+                + "\n"
+            )
+    assert post_train_reserve("org/model", str(tmp_path / "runs")) == 20 + 2
+
+
+def test_lr_schedule_is_refitted_to_the_horizon():
+    args, optimizer, scheduler = linear_schedule(100)
+    for _ in range(10):
+        optimizer.step()
+        scheduler.step()
+    assert scheduler.get_last_lr()[0] == pytest.approx(0.9)
+
+    assert refit_lr_schedule(scheduler, args, 20)
+    assert optimizer.param_groups[0]["lr"] == pytest.approx(0.5)
+    for _ in range(10):
+        optimizer.step()
+        scheduler.step()
+    assert optimizer.param_groups[0]["lr"] == pytest.approx(0.0)
+
+
+def test_callback_stops_at_the_steps_that_fit(clock):
+    args, optimizer, scheduler = linear_schedule(1000)
+    callback = TimeBudgetCallback(
+        deadline=clock.now + 60, max_steps=1000, calibration_steps=5
+    )
+    state, control = TrainerState(max_steps=1000), TrainerControl()
+    for step in range(1, 1001):
+        # the first step pays for warm-up, the others take two seconds
+        clock.now += 10 if step == 1 else 2
+        optimizer.step()
+        scheduler.step()
+        state.global_step = step
+        callback.on_step_end(args, state, control, lr_scheduler=scheduler)
+        if control.should_training_stop:
+            break
+    # at step 6 with 40s left, 20 more steps fit
+    assert step == callback.horizon == state.max_steps == 26
+    assert optimizer.param_groups[0]["lr"] == pytest.approx(0.0)
+
+
+def test_callback_keeps_the_step_cap(clock):
+    callback = TimeBudgetCallback(
+        deadline=clock.now + 3600, max_steps=8, calibration_steps=2
+    )
+    args, _, scheduler = linear_schedule(8)
+    state, control = TrainerState(max_steps=8), TrainerControl()
+    for step in range(1, 4):
+        clock.now += 1
+        state.global_step = step
+        callback.on_step_end(args, state, control, lr_scheduler=scheduler)
+    assert callback.horizon == 8 and not control.should_training_stop
+
+
+def test_ranks_stop_together_before_calibration(clock, monkeypatch):
+    # another rank is past its deadline, this one is not
+    reduced = []
+    monkeypatch.setattr(time_budget, "is_distributed", lambda: True)
+    monkeypatch.setattr(
+        time_budget,
+        "all_reduce_sum",
+        lambda values: reduced.append(values) or [values[0] + 1],
+    )
+    callback = TimeBudgetCallback(
+        deadline=clock.now + 3600, max_steps=100, calibration_steps=5
+    )
+    args, _, scheduler = linear_schedule(100)
+    state, control = TrainerState(max_steps=100), TrainerControl()
+    state.global_step = 1
+    callback.on_step_end(args, state, control, lr_scheduler=scheduler)
+    assert reduced == [[0]] and control.should_training_stop
+
+
+def test_train_lora_stops_at_the_deadline_with_an_adapter(tmp_path, monkeypatch):
+    model_dir = str(tmp_path / "tiny-qwen")
+    build_tiny_model(model_dir, build_tokenizer(model_dir))
+    write_conversations(str(tmp_path / "train.jsonl"), num_samples=8)
+    monkeypatch.setitem(model2template, model_dir, qwen_template)
+    monkeypatch.chdir(tmp_path)
+    stopped_at = []
+
+    class RecordedCallback(TimeBudgetCallback):
+        def on_train_end(self, args, state, control, **kwargs):
+            stopped_at.append(state.global_step)
+
+    monkeypatch.setattr(demo, "TimeBudgetCallback", RecordedCallback)
+
+    demo.train_lora(
+        model_id=model_dir,
+        context_length=128,
+        training_args=LoraTrainingArguments(
+            per_device_train_batch_size=2,
+            gradient_accumulation_steps=1,
+            num_train_epochs=3,
+            lora_rank=4,
+            lora_alpha=8,
+            lora_dropout=0.0,
+            device="cpu",
+            # spent before the first step ends, which still completes
+            time_budget_s=0.0,
+        ),
+        data_file="train.jsonl",
+    )
+    assert os.path.exists("outputs/adapter_model.safetensors")
+    # 12 steps at most, stopped after the first
+    assert stopped_at == [1]
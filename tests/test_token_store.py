@@ -0,0 +1,140 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from dataset import CompiledSFTDataset, ConversationTokenizer
+from demo import LoraTrainingArguments, train_lora
+from utils.constants import model2template, qwen_template
+from utils.synthetic import build_tiny_model, build_tokenizer, write_conversations
+from utils.token_store import TokenStore
+
+
+@pytest.fixture(scope="module")
+def tokenizer(tmp_path_factory):
+    return build_tokenizer(str(tmp_path_factory.mktemp("tokenizer")))
+
+
+class CountingTokenizer(ConversationTokenizer):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.calls = 0
+
+    def tokenize(self, data):
+        self.calls += 1
+        return super().tokenize(data)
+
+
+def compile_file(tokenizer, path, root):
+    conversations = CountingTokenizer(tokenizer, 128, qwen_template)
+    store = TokenStore.for_tokenization(tokenizer, qwen_template, 128, root)
+    starts, lengths = store.compile(path, conversations.tokenize)
+    return store, starts, lengths, conversations.calls
+
+
+def samples(tokenizer, path):
+    conversations = ConversationTokenizer(tokenizer, 128, qwen_template)
+    with open(path) as f:
+        return [conversations.tokenize(line) for line in f]
+
+
+def assert_same(store, starts, lengths, expected):
+    ids, mask = store.arrays(store.meta()["tokens"])
+    assert len(starts) == len(expected)
+    for start, length, sample in zip(starts, lengths, expected):
+        assert ids[start : start + length].tolist() == sample["input_ids"]
+        assert mask[start : start + length].tolist() == sample["target_mask"]
+
+
+def test_only_new_and_changed_rows_are_tokenized(tmp_path, tokenizer):
+    path, root = str(tmp_path / "train.jsonl"), str(tmp_path / "workspaces")
+    write_conversations(path, num_samples=100, tool_turns=1)
+    store, starts, lengths, calls = compile_file(tokenizer, path, root)
+    assert calls == 100
+    assert_same(store, starts, lengths, samples(tokenizer, path))
+
+    # regenerate one row and append another, the rest are reused
+    with open(path) as f:
+        lines = f.readlines()
+    row = json.loads(lines[10])
+    row["conversations"][0]["content"] += " again"
+    lines[10] = json.dumps(row) + "\n"
+    write_conversations(str(tmp_path / "more.jsonl"), num_samples=1, seed=7)
+    with open(path, "w") as f:
+        f.writelines(lines + open(tmp_path / "more.jsonl").readlines())
+
+    store, starts, lengths, calls = compile_file(tokenizer, path, root)
+    assert calls == 2 and store.meta()["rows"] == 102
+    assert_same(store, starts, lengths, samples(tokenizer, path))
+    assert compile_file(tokenizer, path, root)[3] == 0
+
+
+def test_a_torn_append_is_dropped(tmp_path, tokenizer):
+    path, root = str(tmp_path / "train.jsonl"), str(tmp_path / "workspaces")
+    write_conversations(path, num_samples=5)
+    store, *_ = compile_file(tokenizer, path, root)
+    meta = store.meta()
+    # an append that died before committing its meta
+    with open(os.path.join(store.path, "ids.bin"), "ab") as f:
+        f.write(b"\0" * 12)
+
+    store, starts, lengths, calls = compile_file(tokenizer, path, root)
+    assert calls == 0 and store.meta() == meta
+    assert os.path.getsize(os.path.join(store.path, "ids.bin")) == 4 * meta["tokens"]
+    assert_same(store, starts, lengths, samples(tokenizer, path))
+
+
+def test_tokenizations_get_their_own_store(tmp_path, tokenizer):
+    root = str(tmp_path / "workspaces")
+    assert TokenStore.for_tokenization(tokenizer, qwen_template, 128, root).path != (
+        TokenStore.for_tokenization(tokenizer, qwen_template, 256, root).path
+    )
+    assert TokenStore.for_tokenization(tokenizer, qwen_template, 128, root).path == (
+        TokenStore.for_tokenization(tokenizer, dict(qwen_template), 128, root).path
+    )
+
+
+def test_dataset_reads_the_store(tmp_path, tokenizer):
+    path, root = str(tmp_path / "train.jsonl"), str(tmp_path / "workspaces")
+    write_conversations(path, num_samples=6, tool_turns=1)
+    dataset = CompiledSFTDataset(path, tokenizer, 128, qwen_template, root=root)
+    try:
+        expected = samples(tokenizer, path)
+        assert len(dataset) == 6
+        for index, sample in enumerate(expected):
+            assert isinstance(dataset[index]["input_ids"], np.ndarray)
+            assert dataset[index]["input_ids"].tolist() == sample["input_ids"]
+            assert dataset[index]["target_mask"].tolist() == sample["target_mask"]
+    finally:
+        dataset.close()
+
+
+def test_train_lora_compiled(tmp_path, monkeypatch):
+    model_dir = str(tmp_path / "tiny-qwen")
+    build_tiny_model(model_dir, build_tokenizer(model_dir))
+    write_conversations(str(tmp_path / "train.jsonl"), num_samples=6)
+    monkeypatch.setitem(model2template, model_dir, qwen_template)
+    monkeypatch.setenv("WORKSPACE_ROOT", str(tmp_path / "workspaces"))
+    monkeypatch.chdir(tmp_path)
+
+    train_lora(
+        model_id=model_dir,
+        context_length=128,
+        training_args=LoraTrainingArguments(
+            per_device_train_batch_size=2,
+            gradient_accumulation_steps=1,
+            num_train_epochs=1,
+            lora_rank=4,
+            lora_alpha=8,
+            lora_dropout=0.0,
+            device="cpu",
+            compiled_dataset=True,
+        ),
+        data_file=str(tmp_path / "train.jsonl"),
+    )
+    assert os.path.exists("outputs/adapter_model.safetensors")
+    assert any(
+        name.startswith("tokens-")
+        for name in os.listdir(tmp_path / "workspaces" / "shared")
+    )
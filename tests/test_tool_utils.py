@@ -0,0 +1,75 @@
+import json
+
+import pytest
+
+from utils.synthetic import TOOLS
+from utils.tool_utils import (
+    _CANONICAL_CALL,
+    FormatCache,
+    format_tools,
+    function_formatter,
+    parse_function_calls,
+    render_function_call,
+    tool_formater,
+)
+
+CALLS = [
+    # canonical, taken by the fast path
+    '{"name": "swap", "arguments": {"amount": 5, "sell": "ETH", "buy": "USDC"}}',
+    '{"name": "search", "arguments": {"ingredients": ["chicken", "rice"], "vegan": false, "limit": null}}',
+    '{"name": "noop", "arguments": {}}',
+    '{"name": "翻译", "arguments": {"text": "你好"}}',
+    # not canonical, decoded and re-encoded
+    '{"name": "swap", "arguments": {"amount":5}}',
+    '{"name": "swap", "arguments": {"amount": 5.0, "pct": 1e-3}}',
+    '{"name": "translate", "arguments": {"text": "\\u4f60\\u597d \\"quoted\\""}}',
+    '{"name": "nested", "arguments": {"filter": {"chain": "eth", "ids": [1, 2]}}}',
+    '{"name": "swap", "arguments": {"amount": -0, "ids": [-0]}}',
+    '{"name": "swap", "arguments": {"amount": -0.0}}',
+    '{"name": "dup", "arguments": {"a": 1, "a": 2}}',
+    '{"arguments": {"a": 1}, "name": "reordered"}',
+    '[{"name": "a", "arguments": {"x": 1}}, {"name": "b", "arguments": {}}]',
+]
+
+
+@pytest.mark.parametrize("raw", CALLS)
+def test_render_matches_round_trip(raw):
+    assert render_function_call(raw) == function_formatter(json.loads(raw))
+
+
+def test_fast_path_only_for_canonical():
+    assert all(_CANONICAL_CALL.fullmatch(raw) for raw in CALLS[:4])
+    assert not any(_CANONICAL_CALL.fullmatch(raw) for raw in CALLS[4:10])
+
+
+def test_cache_by_content():
+    cache = FormatCache(maxsize=2)
+    calls = []
+
+    def render(raw):
+        calls.append(raw)
+        return raw.upper()
+
+    assert cache.get_or_render("a", render) == "A"
+    assert cache.get_or_render("a", render) == "A"
+    cache.get_or_render("b", render)
+    cache.get_or_render("c", render)  # evicts "a"
+    cache.get_or_render("a", render)
+    assert calls == ["a", "b", "c", "a"] and (cache.hits, cache.misses) == (1, 4)
+
+    raw_tools = json.dumps(TOOLS)
+    assert format_tools(raw_tools) == tool_formater(TOOLS)
+
+
+@pytest.mark.parametrize("raw", CALLS)
+def test_parse_function_calls_inverts_rendering(raw):
+    calls = json.loads(raw)
+    calls = calls if isinstance(calls, list) else [calls]
+    parsed = parse_function_calls(render_function_call(raw))
+    assert parsed == [(call["name"], call["arguments"]) for call in calls]
+
+
+def test_parse_function_calls_rejects_broken_input():
+    assert parse_function_calls("The balance is 5 ETH.") is None
+    assert parse_function_calls('Action: swap\nAction Input: {"amount": 5') is None
+    assert parse_function_calls("Action: swap\nAction Input: [5]") is None
@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+from demo import LoraTrainingArguments, train_lora
+from utils.constants import model2template, qwen_template
+from utils.synthetic import build_tiny_model, build_tokenizer, write_conversations
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    model_dir = str(tmp_path / "tiny-qwen")
+    build_tiny_model(model_dir, build_tokenizer(model_dir))
+    (tmp_path / "data").mkdir()
+    write_conversations(str(tmp_path / "data" / "demo_data.jsonl"), num_samples=8)
+    write_conversations(
+        str(tmp_path / "data" / "eval_data.jsonl"), num_samples=4, seed=1
+    )
+    monkeypatch.setitem(model2template, model_dir, qwen_template)
+    monkeypatch.chdir(tmp_path)
+    return model_dir
+
+
+def test_train_lora_on_cpu(workdir):
+    metrics = train_lora(
+        model_id=workdir,
+        context_length=128,
+        training_args=LoraTrainingArguments(
+            per_device_train_batch_size=2,
+            gradient_accumulation_steps=1,
+            num_train_epochs=1,
+            lora_rank=4,
+            lora_alpha=8,
+            lora_dropout=0.0,
+            device="cpu",
+        ),
+        eval_file="data/eval_data.jsonl",
+    )
+    assert os.path.exists("outputs/adapter_model.safetensors")
+    assert os.path.exists("outputs/adapter_config.json")
+    assert not any(name.startswith("checkpoint-") for name in os.listdir("outputs"))
+    assert metrics["samples"] == 4 and metrics["loss"] > 0
+
+
+def test_warm_model_is_reused(workdir, monkeypatch):
+    import demo
+
+    args = LoraTrainingArguments(
+        per_device_train_batch_size=2,
+        gradient_accumulation_steps=1,
+        num_train_epochs=1,
+        lora_rank=4,
+        lora_alpha=8,
+        lora_dropout=0.0,
+        device="cpu",
+    )
+    demo.keep_models_warm(1)
+    try:
+        train_lora(model_id=workdir, context_length=128, training_args=args)
+        # the second run must not load the base model again, nor see the first adapter
+        monkeypatch.setattr(
+            demo, "load_model", lambda *a, **k: pytest.fail("base model reloaded")
+        )
+        model, _, _ = demo._warm_models[(workdir, "cpu", "float32")]
+        assert not any("lora_" in name for name, _ in model.named_modules())
+        train_lora(
+            model_id=workdir,
+            context_length=128,
+            training_args=args,
+            output_dir="outputs-2",
+        )
+        assert os.path.exists("outputs-2/adapter_model.safetensors")
+    finally:
+        demo.keep_models_warm(0)
@@ -0,0 +1,220 @@
+import json
+import os
+import shutil
+
+import pytest
+import torch
+from safetensors.torch import load_file, save_file
+
+from demo import LoraTrainingArguments, train_lora
+from utils.constants import model2template, qwen_template
+from utils.synthetic import build_tiny_model, build_tokenizer, write_conversations
+from utils.warm_start import (
+    ROWS_FILE,
+    from_scratch,
+    plan_warm_start,
+    read_lineage,
+    record_lineage,
+    remember_adapter,
+)
+from utils.workspace import Workspace
+
+
+@pytest.fixture(autouse=True)
+def hf_username(monkeypatch):
+    monkeypatch.setenv("HF_USERNAME", "user")
+
+
+def write_adapter(folder):
+    os.makedirs(folder, exist_ok=True)
+    save_file(
+        {"lora_A": torch.ones(2, 4)},
+        os.path.join(folder, "adapter_model.safetensors"),
+        metadata={"format": "pt"},
+    )
+    with open(os.path.join(folder, "adapter_config.json"), "w") as f:
+        json.dump({"r": 2}, f)
+
+
+class StubHfApi:
+    def __init__(self, head, snapshot):
+        self.head, self.snapshot = head, snapshot
+        self.downloads = []
+
+    def repo_info(self, repo_id, repo_type=None):
+        if self.head is None:
+            raise Exception("404 Not Found")
+        return type("Info", (), {"sha": self.head})()
+
+    def snapshot_download(
+        self, repo_id, revision=None, allow_patterns=None, repo_type=None
+    ):
+        self.downloads.append((repo_id, revision))
+        return self.snapshot
+
+
+def first_run(tmp_path, num_samples=20):
+    workspace = Workspace(4, "run-1", root=str(tmp_path / "workspaces"))
+    write_conversations(workspace.data_file, num_samples=num_samples)
+    output_dir = workspace.output_dir("org/model")
+    write_adapter(output_dir)
+    record_lineage(
+        output_dir,
+        from_scratch(4, "org/model", workspace.data_file),
+        workspace.data_file,
+    )
+    remember_adapter(workspace, "org/model", output_dir, "commit-1")
+    return workspace
+
+
+def test_lineage_is_stamped_and_kept(tmp_path):
+    workspace = first_run(tmp_path)
+    lineage = read_lineage(workspace.adapter_dir("org/model"))
+    assert (
+        lineage["generation"] == 0
+        and lineage["parent"] is None
+        and lineage["rows"] == 20
+    )
+    # the weights are untouched by the metadata
+    assert torch.equal(
+        load_file(
+            os.path.join(
+                workspace.adapter_dir("org/model"), "adapter_model.safetensors"
+            )
+        )["lora_A"],
+        torch.ones(2, 4),
+    )
+    with open(os.path.join(workspace.adapter_dir("org/model"), "lineage.json")) as f:
+        assert json.load(f)["commit"] == "commit-1"
+
+
+def test_warm_start_trains_the_new_rows_and_some_old(tmp_path):
+    first_run(tmp_path)
+    workspace = Workspace(4, "run-2", root=str(tmp_path / "workspaces"))
+    write_conversations(workspace.data_file, num_samples=20)
+    write_conversations(str(tmp_path / "new.jsonl"), num_samples=5, seed=9)
+    with open(workspace.data_file, "a") as f:
+        f.write(open(tmp_path / "new.jsonl").read())
+
+    args = {"warm_start": True, "warm_start_replay": 0.5}
+    api = StubHfApi("commit-1", snapshot=None)
+    warm = plan_warm_start(workspace, "org/model", args, workspace.data_file, api=api)
+    # the hub HEAD is the commit kept locally, nothing is downloaded, the run trains from its own copy
+    assert api.downloads == [] and warm["adapter"].startswith(workspace.run_dir)
+    weights = load_file(os.path.join(warm["adapter"], "adapter_model.safetensors"))
+    assert torch.equal(weights["lora_A"], torch.ones(2, 4))
+    lineage = warm["lineage"]
+    assert lineage["generation"] == 1 and lineage["ancestors"] == ["commit-1"]
+    assert lineage["new_rows"] == 5 and 0 < lineage["replayed_rows"] < 20
+    with open(warm["data_file"]) as f:
+        assert len(f.readlines()) == 5 + lineage["replayed_rows"]
+
+    output_dir = workspace.output_dir("org/model")
+    write_adapter(output_dir)
+    record_lineage(output_dir, warm, workspace.data_file)
+    assert read_lineage(output_dir)["rows"] == 25
+    assert os.path.getsize(os.path.join(output_dir, ROWS_FILE)) == 8 * 25
+
+
+def test_newer_hub_head_is_downloaded(tmp_path):
+    workspace = first_run(tmp_path)
+    snapshot = str(tmp_path / "snapshot")
+    write_adapter(snapshot)
+    api = StubHfApi("commit-2", snapshot)
+
+    warm = plan_warm_start(
+        workspace, "org/model", {"warm_start": True}, workspace.data_file, api=api
+    )
+    assert api.downloads == [("user/task-4-org-model", "commit-2")]
+    assert (
+        warm["adapter"].startswith(workspace.run_dir)
+        and warm["lineage"]["parent"]["source"] == "hub"
+    )
+    # the rows the hub adapter was trained on are unknown, it trains on all of them
+    assert warm["data_file"] == workspace.data_file and warm["parent_rows"] is None
+
+
+def test_the_parent_copy_outlives_the_kept_adapter(tmp_path):
+    first_run(tmp_path)
+    workspace = Workspace(4, "run-2", root=str(tmp_path / "workspaces"))
+    write_conversations(workspace.data_file, num_samples=20)
+    api = StubHfApi("commit-1", None)
+    warm = plan_warm_start(
+        workspace, "org/model", {"warm_start": True}, workspace.data_file, api=api
+    )
+
+    # evicted, or replaced by another run of the task, before this one trains
+    shutil.rmtree(workspace.adapter_dir("org/model"))
+    assert os.path.exists(os.path.join(warm["adapter"], "adapter_model.safetensors"))
+    assert os.path.exists(warm["parent_rows"])
+
+
+def test_no_rows_to_train_on_falls_back_to_all_rows(tmp_path):
+    first_run(tmp_path)
+    workspace = Workspace(4, "run-2", root=str(tmp_path / "workspaces"))
+    write_conversations(workspace.data_file, num_samples=20)
+
+    args = {"warm_start": True, "warm_start_replay": 0.0}
+    warm = plan_warm_start(
+        workspace,
+        "org/model",
+        args,
+        workspace.data_file,
+        api=StubHfApi("commit-1", None),
+    )
+    # still continues from the parent, on every row rather than an empty file
+    assert warm["adapter"] is not None and warm["data_file"] == workspace.data_file
+    assert warm["lineage"]["new_rows"] == 0 and warm["lineage"]["replayed_rows"] == 0
+
+
+def test_without_a_parent_trains_from_scratch(tmp_path):
+    workspace = Workspace(5, "run-1", root=str(tmp_path / "workspaces"))
+    write_conversations(workspace.data_file, num_samples=4)
+    warm = plan_warm_start(
+        workspace,
+        "org/model",
+        {"warm_start": True},
+        workspace.data_file,
+        api=StubHfApi(None, None),
+    )
+    assert warm == from_scratch(5, "org/model", workspace.data_file)
+
+
+def test_train_lora_continues_from_an_adapter(tmp_path, monkeypatch):
+    model_dir = str(tmp_path / "tiny-qwen")
+    build_tiny_model(model_dir, build_tokenizer(model_dir))
+    write_conversations(str(tmp_path / "train.jsonl"), num_samples=4)
+    monkeypatch.setitem(model2template, model_dir, qwen_template)
+    monkeypatch.chdir(tmp_path)
+
+    def args(rank):
+        return LoraTrainingArguments(
+            per_device_train_batch_size=2,
+            gradient_accumulation_steps=1,
+            num_train_epochs=1,
+            lora_rank=rank,
+            lora_alpha=8,
+            lora_dropout=0.0,
+            warmup_steps=0,
+            device="cpu",
+        )
+
+    train_lora(model_dir, 128, args(4), data_file="train.jsonl", output_dir="parent")
+    train_lora(
+        model_dir,
+        128,
+        args(8),
+        data_file="train.jsonl",
+        output_dir="child",
+        init_adapter="parent",
+    )
+
+    # the parent's config carries over, its weights are trained further
+    with open("child/adapter_config.json") as f:
+        assert json.load(f)["r"] == 4
+    parent, child = (
+        load_file("parent/adapter_model.safetensors"),
+        load_file("child/adapter_model.safetensors"),
+    )
+    assert parent.keys() == child.keys()
+    assert any(not torch.equal(parent[name], child[name]) for name in parent)
@@ -0,0 +1,42 @@
+import multiprocessing
+import os
+import time
+
+from utils.workspace import Workspace, file_lock
+
+
+def test_runs_get_separate_trees(tmp_path):
+    first = Workspace(7, "run-a", root=str(tmp_path))
+    second = Workspace(7, "run-b", root=str(tmp_path))
+    model_id = "Qwen/Qwen1.5-0.5B"
+
+    assert first.data_file != second.data_file
+    assert first.output_dir(model_id) != second.output_dir(model_id)
+    assert first.output_dir(model_id).startswith(first.run_dir)
+    # sweeps outlive a run, sweep.py keys their trials by data so only a run on the same data resumes them
+    assert first.sweep_dir(model_id) == second.sweep_dir(model_id)
+
+    open(first.data_file, "w").close()
+    open(second.data_file, "w").close()
+    first.cleanup()
+    assert not os.path.exists(first.run_dir) and os.path.exists(second.data_file)
+
+
+def hold_lock(path, started, seconds):
+    with file_lock(path):
+        started.set()
+        time.sleep(seconds)
+
+
+def test_file_lock_is_exclusive(tmp_path):
+    path = str(tmp_path / "sweeps" / "model")
+    context = multiprocessing.get_context("spawn")
+    started = context.Event()
+    holder = context.Process(target=hold_lock, args=(path, started, 0.5))
+    holder.start()
+    started.wait(30)
+    start = time.monotonic()
+    with file_lock(path):
+        waited = time.monotonic() - start
+    holder.join()
+    assert waited > 0.2
@@ -0,0 +1,153 @@
+import json
+import os
+from typing import Dict, Optional
+
+import torch
+from loguru import logger
+from safetensors.torch import load_file, save_file
+
+ADAPTER_CONFIG = "adapter_config.json"
+ADAPTER_WEIGHTS = "adapter_model.safetensors"
+ADAPTER_WEIGHTS_BIN = "adapter_model.bin"
+EXPORT_REPORT = "export_report.json"
+
+
+def load_adapter_state_dict(adapter_dir: str) -> Dict[str, torch.Tensor]:
+    path = os.path.join(adapter_dir, ADAPTER_WEIGHTS)
+    if os.path.exists(path):
+        return load_file(path)
+    return torch.load(
+        os.path.join(adapter_dir, ADAPTER_WEIGHTS_BIN),
+        map_location="cpu",
+        weights_only=True,
+    )
+
+
+def delta_error(
+    b: torch.Tensor, a: torch.Tensor, b_new: torch.Tensor, a_new: torch.Tensor
+) -> float:
+    """Relative Frobenius error of `b_new @ a_new` against `b @ a`, without forming either product.
+
+    ||BA - B'A'||^2 = sum((C^T C) * (D D^T)) with C = [B, -B'] and D = [A; A'],
+    where both Gram matrices are only (r + r') x (r + r').
+    """
+    b, a, b_new, a_new = (t.double() for t in (b, a, b_new, a_new))
+    c = torch.cat([b, -b_new], dim=1)
+    d = torch.cat([a, a_new], dim=0)
+    diff = (c.T @ c * (d @ d.T)).sum().clamp(min=0)
+    ref = (b.T @ b * (a @ a.T)).sum()
+    return float((diff / ref).sqrt()) if ref > 0 else 0.0
+
+
+def truncate_lora(
+    b: torch.Tensor,
+    a: torch.Tensor,
+    max_rank: Optional[int],
+    max_error: Optional[float],
+):
+    """Lower the rank of the update B @ A by SVD, keeping the smallest rank within `max_error`.
+
+    Works on the r x r core of the QR factors, so the full out x in update is never built.
+    """
+    qb, rb = torch.linalg.qr(b.double())
+    qa, ra = torch.linalg.qr(a.double().T)
+    u, s, vt = torch.linalg.svd(rb @ ra.T)
+
+    rank = len(s)
+    if max_error is not None:
+        # relative error of keeping k singular values is the norm of the dropped tail
+        energy = s.pow(2)
+        tail = (energy.flip(0).cumsum(0).flip(0) / energy.sum()).sqrt()
+        within = (tail <= max_error).nonzero()
+        rank = int(within[0]) if len(within) else rank
+    if max_rank is not None:
+        rank = min(rank, max_rank)
+    rank = max(rank, 1)
+
+    root = s[:rank].sqrt()
+    b_new = qb @ (u[:, :rank] * root)
+    a_new = (root[:, None] * vt[:rank]) @ qa.T
+    return b_new, a_new
+
+
+def export_adapter(
+    adapter_dir: str,
+    dtype: Optional[str] = None,
+    max_rank: Optional[int] = None,
+    max_error: Optional[float] = None,
+) -> Dict:
+    """Rewrite the adapter in `adapter_dir` as LoRA-only safetensors, optionally cast and rank-reduced.
+
+    Reduced ranks are recorded in `rank_pattern` with a matching `alpha_pattern`, so the
+    `lora_alpha / r` scaling of every module is unchanged and PEFT loads it as-is.
+    """
+    with open(os.path.join(adapter_dir, ADAPTER_CONFIG)) as f:
+        config = json.load(f)
+    state_dict = load_adapter_state_dict(adapter_dir)
+    size_before = sum(t.numel() * t.element_size() for t in state_dict.values())
+    target_dtype = getattr(torch, dtype) if dtype else None
+
+    tensors, layers = {}, {}
+    rank_pattern = dict(config.get("rank_pattern") or {})
+    alpha_pattern = dict(config.get("alpha_pattern") or {})
+    for key, a in state_dict.items():
+        if ".lora_A." not in key:
+            continue
+        b_key = key.replace(".lora_A.", ".lora_B.")
+        b = state_dict[b_key]
+        b_new, a_new = b, a
+        if max_rank is not None or max_error is not None:
+            b_new, a_new = truncate_lora(b, a, max_rank, max_error)
+        b_new = b_new.to(target_dtype or b.dtype).contiguous()
+        a_new = a_new.to(target_dtype or a.dtype).contiguous()
+
+        # "base_model.model.model.layers.0.self_attn.q_proj.lora_A.weight" -> "layers.0.self_attn.q_proj",
+        # PEFT matches pattern keys as a suffix after a dot
+        module = key[len("base_model.model.") :].split(".lora_A.")[0]
+        pattern_key = module.split(".", 1)[1]
+        rank, new_rank = a.shape[0], a_new.shape[0]
+        if new_rank != rank:
+            alpha = alpha_pattern.get(pattern_key, config["lora_alpha"])
+            r = rank_pattern.get(pattern_key, config["r"])
+            rank_pattern[pattern_key] = new_rank
+            alpha_pattern[pattern_key] = alpha * new_rank / r
+
+        tensors[key], tensors[b_key] = a_new, b_new
+        layers[module] = {
+            "rank": rank,
+            "new_rank": new_rank,
+            "relative_error": delta_error(
+                b.float(), a.float(), b_new.float(), a_new.float()
+            ),
+        }
+
+    config["rank_pattern"] = rank_pattern
+    config["alpha_pattern"] = alpha_pattern
+    with open(os.path.join(adapter_dir, ADAPTER_CONFIG), "w") as f:
+        json.dump(config, f, indent=2, sort_keys=True)
+    save_file(
+        tensors, os.path.join(adapter_dir, ADAPTER_WEIGHTS), metadata={"format": "pt"}
+    )
+    if os.path.exists(os.path.join(adapter_dir, ADAPTER_WEIGHTS_BIN)):
+        os.remove(os.path.join(adapter_dir, ADAPTER_WEIGHTS_BIN))
+
+    size_after = sum(t.numel() * t.element_size() for t in tensors.values())
+    report = {
+        "dtype": dtype,
+        "max_rank": max_rank,
+        "max_error": max_error,
+        "bytes_before": size_before,
+        "bytes_after": size_after,
+        "size_reduction": 1 - size_after / size_before if size_before else 0.0,
+        "max_relative_error": max(
+            (v["relative_error"] for v in layers.values()), default=0.0
+        ),
+        "layers": layers,
+    }
+    with open(os.path.join(adapter_dir, EXPORT_REPORT), "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info(
+        f"Exported adapter: {size_before} -> {size_after} bytes "
+        f"({report['size_reduction']:.1%} smaller), max relative error {report['max_relative_error']:.2e}"
+    )
+    return report
@@ -0,0 +1,313 @@
+"""Keep the artifacts a node accumulates on disk under a size budget.
+
+Entries, each with its size, last use, use count and pin:
+
+    model/<repo id>                     a snapshot in the Hugging Face hub cache
+    run/task-<id>/<run>                 the workspace of a run (task data, outputs), kept when it failed
+    sweep/task-<id>/sweeps/<model>      the trials of a task's sweep
+    adapter/task-<id>/adapters/<model>  the last uploaded adapter, parent of a warm start
+    shared/<name>                       a cache shared by runs (e.g. a token store)
+
+A run holds a shared flock on every entry it uses (`acquire`) and eviction takes
+an exclusive one without waiting, so nothing an active run holds is ever evicted.
+Entries go least recently used first, the snapshots of the `warm_models` models
+trained most go last, pinned entries never.
+
+    python -m utils.cache_manager list
+    python -m utils.cache_manager prune --budget-gb 50 [--dry-run]
+    python -m utils.cache_manager pin model/Qwen/Qwen1.5-0.5B
+"""
+
+import argparse
+import json
+import os
+import shutil
+import time
+from contextlib import ExitStack
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional
+
+from huggingface_hub.constants import HF_HUB_CACHE
+from loguru import logger
+
+from utils.workspace import file_lock, try_lock, workspace_root
+
+INDEX_FILE = "cache_index.json"
+# folders of a task directory kept across its runs, by the kind of their entries
+TASK_ENTRIES = {"sweeps": "sweep", "adapters": "adapter"}
+
+
+@dataclass
+class CacheEntry:
+    key: str
+    path: str
+    size: int
+    last_used: float
+    uses: int = 0
+    pinned: bool = False
+    in_use: bool = False
+    warm: bool = False
+
+    @property
+    def kind(self) -> str:
+        return self.key.split("/", 1)[0]
+
+
+def disk_usage(path: str) -> int:
+    """Bytes of the files under `path`, symlinks (snapshots into hub blobs) not followed."""
+    if not os.path.isdir(path):
+        return os.lstat(path).st_size
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            file = os.path.join(dirpath, name)
+            if not os.path.islink(file):
+                total += os.lstat(file).st_size
+    return total
+
+
+def model_key(model_id: str) -> str:
+    return f"model/{model_id}"
+
+
+def run_key(workspace) -> str:
+    return f"run/{os.path.relpath(workspace.run_dir, workspace.root)}"
+
+
+class CacheManager(object):
+    def __init__(
+        self,
+        root: Optional[str] = None,
+        hub_cache: Optional[str] = None,
+        warm_models: int = 2,
+    ):
+        self.root = workspace_root(root)
+        self.hub_cache = hub_cache or HF_HUB_CACHE
+        self.warm_models = warm_models
+        self.index_file = os.path.join(self.root, INDEX_FILE)
+        self._held = ExitStack()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def path(self, key: str) -> str:
+        kind, name = key.split("/", 1)
+        if kind == "model":
+            return os.path.join(self.hub_cache, "models--" + name.replace("/", "--"))
+        return os.path.join(self.root, key if kind == "shared" else name)
+
+    def lock_target(self, key: str) -> str:
+        """Locked as `<target>.lock`, next to the entry in the workspace tree, under locks/ for models."""
+        if key.startswith("model/"):
+            return os.path.join(self.root, "locks", key.replace("/", "--"))
+        return self.path(key)
+
+    def _update_index(self, key: str, **changes):
+        with file_lock(self.index_file):
+            index = self.load_index()
+            record = index.setdefault(
+                key, {"last_used": 0.0, "uses": 0, "pinned": False}
+            )
+            for name, value in changes.items():
+                record[name] = value(record[name]) if callable(value) else value
+            tmp = f"{self.index_file}.tmp-{os.getpid()}"
+            with open(tmp, "w") as f:
+                json.dump(index, f, indent=1)
+            os.replace(tmp, self.index_file)
+
+    def load_index(self) -> Dict[str, Dict]:
+        if not os.path.exists(self.index_file):
+            return {}
+        with open(self.index_file) as f:
+            return json.load(f)
+
+    def acquire(self, key: str):
+        """Hold `key` until `release` and record its use, eviction skips it meanwhile."""
+        self._held.enter_context(file_lock(self.lock_target(key), shared=True))
+        self._update_index(key, last_used=time.time(), uses=lambda uses: uses + 1)
+
+    def release(self):
+        self._held.close()
+
+    def pin(self, key: str, pinned: bool = True):
+        self._update_index(key, pinned=pinned)
+
+    def _keys(self) -> List[str]:
+        keys = []
+        if os.path.isdir(self.hub_cache):
+            for name in sorted(os.listdir(self.hub_cache)):
+                if name.startswith("models--") and os.path.isdir(
+                    os.path.join(self.hub_cache, name)
+                ):
+                    keys.append(model_key(name[len("models--") :].replace("--", "/")))
+        if not os.path.isdir(self.root):
+            return keys
+        for name in sorted(os.listdir(self.root)):
+            path = os.path.join(self.root, name)
+            if name == "shared" and os.path.isdir(path):
+                keys.extend(
+                    f"shared/{entry}"
+                    for entry in sorted(os.listdir(path))
+                    if self._is_entry(entry)
+                )
+            elif name.startswith("task-") and os.path.isdir(path):
+                for entry in sorted(os.listdir(path)):
+                    if entry in TASK_ENTRIES:
+                        folder = os.path.join(path, entry)
+                        keys.extend(
+                            f"{TASK_ENTRIES[entry]}/{name}/{entry}/{item}"
+                            for item in sorted(os.listdir(folder))
+                            if self._is_entry(item)
+                        )
+                    elif self._is_entry(entry):
+                        keys.append(f"run/{name}/{entry}")
+        return keys
+
+    @staticmethod
+    def _is_entry(name: str) -> bool:
+        # lock files and builds in progress are not entries
+        return not name.endswith(".lock") and ".tmp-" not in name
+
+    def entries(self) -> List[CacheEntry]:
+        index = self.load_index()
+        entries = []
+        for key in self._keys():
+            path = self.path(key)
+            record = index.get(key, {})
+            with try_lock(self.lock_target(key)) as free:
+                in_use = not free
+            entries.append(
+                CacheEntry(
+                    key=key,
+                    path=path,
+                    size=disk_usage(path),
+                    # entries the pipeline never recorded (e.g. downloaded by hand) by their mtime
+                    last_used=record.get("last_used") or os.path.getmtime(path),
+                    uses=record.get("uses", 0),
+                    pinned=record.get("pinned", False),
+                    in_use=in_use,
+                )
+            )
+        models = sorted(
+            (e for e in entries if e.kind == "model" and e.uses), key=lambda e: -e.uses
+        )
+        for entry in models[: self.warm_models]:
+            entry.warm = True
+        return entries
+
+    def prune(self, budget_bytes: int, dry_run: bool = False) -> List[CacheEntry]:
+        """Evict entries, coldest first, until the total is within `budget_bytes`; return them."""
+        entries = self.entries()
+        total = sum(entry.size for entry in entries)
+        candidates = sorted(
+            (entry for entry in entries if not entry.pinned and not entry.in_use),
+            key=lambda entry: (entry.warm, entry.last_used),
+        )
+        evicted = []
+        for entry in candidates:
+            if total <= budget_bytes:
+                break
+            if not dry_run and not self._evict(entry):
+                continue
+            total -= entry.size
+            evicted.append(entry)
+        if total > budget_bytes:
+            logger.warning(
+                f"Cache still uses {total / 2**30:.2f} GiB, the rest is pinned or in use"
+            )
+        return evicted
+
+    def _evict(self, entry: CacheEntry) -> bool:
+        # a run acquiring the entry meanwhile waits for the removal, then sees it missing
+        with try_lock(self.lock_target(entry.key)) as free:
+            if not free:
+                return False
+            logger.info(f"Evicting {entry.key} ({entry.size / 2**20:.1f} MiB)")
+            if os.path.isdir(entry.path):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            elif os.path.exists(entry.path):
+                os.remove(entry.path)
+        return True
+
+
+def budget_from_env() -> Optional[int]:
+    budget = os.environ.get("CACHE_BUDGET_GB")
+    return int(float(budget) * 2**30) if budget else None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Inspect and prune the on-disk caches of the node."
+    )
+    parser.add_argument(
+        "--root",
+        default=None,
+        help="workspace root (default $WORKSPACE_ROOT or workspaces)",
+    )
+    parser.add_argument(
+        "--hub-cache",
+        default=None,
+        help="Hugging Face hub cache (default $HF_HUB_CACHE)",
+    )
+    parser.add_argument(
+        "--warm-models", type=int, default=int(os.environ.get("CACHE_WARM_MODELS", 2))
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    listing = commands.add_parser("list")
+    listing.add_argument("--json", action="store_true")
+    prune = commands.add_parser("prune")
+    prune.add_argument(
+        "--budget-gb", type=float, default=None, help="default $CACHE_BUDGET_GB"
+    )
+    prune.add_argument("--dry-run", action="store_true")
+    for name in ("pin", "unpin"):
+        commands.add_parser(name).add_argument("key")
+    args = parser.parse_args()
+
+    manager = CacheManager(args.root, args.hub_cache, args.warm_models)
+    if args.command == "list":
+        entries = manager.entries()
+        if args.json:
+            print(json.dumps([asdict(entry) for entry in entries], indent=2))
+            return
+        for entry in sorted(entries, key=lambda entry: -entry.last_used):
+            flags = "".join(
+                flag
+                for flag, on in (
+                    ("P", entry.pinned),
+                    ("U", entry.in_use),
+                    ("W", entry.warm),
+                )
+                if on
+            )
+            used = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry.last_used))
+            print(
+                f"{entry.size / 2**20:10.1f} MiB  {used}  {entry.uses:4d}  {flags:3s}  {entry.key}"
+            )
+        print(
+            f"{sum(entry.size for entry in entries) / 2**30:.2f} GiB in {len(entries)} entries"
+        )
+    elif args.command == "prune":
+        budget = (
+            int(args.budget_gb * 2**30)
+            if args.budget_gb is not None
+            else budget_from_env()
+        )
+        if budget is None:
+            parser.error("prune needs --budget-gb or CACHE_BUDGET_GB")
+        evicted = manager.prune(budget, dry_run=args.dry_run)
+        verb = "Would evict" if args.dry_run else "Evicted"
+        print(
+            f"{verb} {len(evicted)} entries, {sum(entry.size for entry in evicted) / 2**30:.2f} GiB"
+        )
+        for entry in evicted:
+            print(f"  {entry.key}")
+    else:
+        manager.pin(args.key, pinned=args.command == "pin")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+from typing import Optional
+
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.checkpoint import checkpoint
+from trl import SFTTrainer
+
+
+def _chunk_logits(
+    hidden: torch.Tensor, lm_head, softcap: Optional[float]
+) -> torch.Tensor:
+    logits = lm_head(hidden).float()
+    if softcap is not None:
+        logits = torch.tanh(logits / softcap) * softcap
+    return logits
+
+
+def _chunk_loss(
+    hidden: torch.Tensor, targets: torch.Tensor, lm_head, softcap: Optional[float]
+):
+    return F.cross_entropy(
+        _chunk_logits(hidden, lm_head, softcap), targets, reduction="sum"
+    )
+
+
+def chunked_lm_loss(
+    hidden_states: torch.Tensor,
+    labels: torch.Tensor,
+    lm_head,
+    chunk_size: int = 1024,
+    softcap: Optional[float] = None,
+) -> torch.Tensor:
+    """Causal LM loss computed only at labeled positions, `chunk_size` positions at a time.
+
+    Equal to the mean token cross-entropy of `labels` (shifted, -100 ignored) over the
+    logits of `lm_head(hidden_states)`, but the `[B, L, V]` logits are never built: the
+    hidden states of the labeled positions are gathered first, and each `[chunk, V]`
+    block is recomputed in backward instead of being kept for it.
+    """
+    hidden_size = hidden_states.shape[-1]
+    # the hidden state at t predicts the token at t + 1
+    hidden = hidden_states[:, :-1].reshape(-1, hidden_size)
+    targets = labels[:, 1:].reshape(-1).to(hidden.device)
+    positions = (targets != -100).nonzero(as_tuple=True)[0]
+    if len(positions) == 0:
+        # keep the graph connected, the step then contributes zero gradients
+        return hidden_states.sum() * 0.0
+
+    hidden = hidden.index_select(0, positions)
+    targets = targets.index_select(0, positions)
+    total = None
+    for start in range(0, len(positions), chunk_size):
+        loss = checkpoint(
+            _chunk_loss,
+            hidden[start : start + chunk_size],
+            targets[start : start + chunk_size],
+            lm_head,
+            softcap,
+            use_reentrant=False,
+        )
+        total = loss if total is None else total + loss
+    return total / len(positions)
+
+
+def chunked_token_losses(
+    hidden_states: torch.Tensor,
+    labels: torch.Tensor,
+    lm_head,
+    chunk_size: int = 1024,
+    softcap: Optional[float] = None,
+) -> torch.Tensor:
+    """Cross-entropy of every labeled token as `[B, L - 1]`, 0 at ignored positions.
+
+    The scoring counterpart of `chunked_lm_loss`, without grad: only the labeled
+    positions are projected, `chunk_size` at a time.
+    """
+    batch_size, length, hidden_size = hidden_states.shape
+    hidden = hidden_states[:, :-1].reshape(-1, hidden_size)
+    targets = labels[:, 1:].reshape(-1).to(hidden.device)
+    positions = (targets != -100).nonzero(as_tuple=True)[0]
+    losses = torch.zeros(len(targets), dtype=torch.float32, device=hidden.device)
+    for start in range(0, len(positions), chunk_size):
+        chunk = positions[start : start + chunk_size]
+        logits = _chunk_logits(hidden.index_select(0, chunk), lm_head, softcap)
+        losses[chunk] = F.cross_entropy(
+            logits, targets.index_select(0, chunk), reduction="none"
+        )
+    return losses.view(batch_size, length - 1)
+
+
+class ChunkedLossSFTTrainer(SFTTrainer):
+    """SFTTrainer whose loss runs the decoder alone and projects only the supervised positions."""
+
+    def __init__(self, *args, loss_chunk_size: int = 1024, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loss_chunk_size = loss_chunk_size
+
+    def compute_loss(self, model, inputs, return_outputs=False):
+        causal_lm = self.accelerator.unwrap_model(model)
+        if hasattr(causal_lm, "get_base_model"):
+            causal_lm = causal_lm.get_base_model()
+        # LoRA layers sit inside the decoder modules, so they run as part of this call
+        hidden_states = causal_lm.get_decoder()(
+            input_ids=inputs["input_ids"],
+            attention_mask=inputs["attention_mask"],
+        )[0]
+        loss = chunked_lm_loss(
+            hidden_states,
+            inputs["labels"],
+            causal_lm.get_output_embeddings(),
+            chunk_size=self.loss_chunk_size,
+            softcap=getattr(causal_lm.config, "final_logit_softcapping", None),
+        )
+        return (loss, None) if return_outputs else loss
+
+    def training_step(self, model, inputs):
+        loss = super().training_step(model, inputs)
+        # compute_loss runs below the DDP wrapper, whose gradient hooks are then never armed,
+        # so average the LoRA gradients over the ranks here, once per optimizer step
+        if (
+            isinstance(model, DistributedDataParallel)
+            and self.accelerator.sync_gradients
+        ):
+            grads = [p.grad for p in model.parameters() if p.grad is not None]
+            flat = torch.cat([grad.flatten() for grad in grads])
+            dist.all_reduce(flat)
+            flat /= dist.get_world_size()
+            offset = 0
+            for grad in grads:
+                grad.copy_(flat[offset : offset + grad.numel()].view_as(grad))
+                offset += grad.numel()
+        return loss
@@ -0,0 +1,62 @@
+import os
+from typing import Iterable, Optional
+
+import torch
+from loguru import logger
+from transformers import BitsAndBytesConfig
+
+
+def resolve_device(device: Optional[str] = None) -> str:
+    """Return "cuda" or "cpu"; `device` (or the TRAIN_DEVICE env var) overrides detection."""
+    device = device or os.environ.get("TRAIN_DEVICE")
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    assert device in ("cuda", "cpu"), f"unsupported device {device}"
+    return device
+
+
+def configure_cpu_threads(cpus: Optional[Iterable[int]] = None) -> int:
+    """Pin the process to `cpus` (default: the current affinity) and size torch thread pools to it."""
+    if cpus is not None:
+        os.sched_setaffinity(0, set(cpus))
+    num_threads = len(os.sched_getaffinity(0))
+    torch.set_num_threads(num_threads)
+    try:
+        # inter-op parallelism only oversubscribes the cores the intra-op pool already uses
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # can only be set once, before any inter-op work has started
+        pass
+    logger.info(f"Using {num_threads} CPU threads")
+    return num_threads
+
+
+def backend_kwargs(device: str, cpu_dtype: str = "float32", local_rank: int = 0):
+    """Model loading and SFTConfig kwargs for the training backend.
+
+    On CUDA this is the qLoRA setup: 4-bit nf4 weights, bf16 compute and the paged
+    8-bit optimizer, on device `local_rank`. On CPU the model is loaded unquantized
+    in `cpu_dtype` and trained with the standard torch AdamW.
+    """
+    if device == "cuda":
+        model_kwargs = {
+            "quantization_config": BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=torch.bfloat16,
+            ),
+            "device_map": {"": local_rank},
+        }
+        config_kwargs = {"bf16": True, "optim": "paged_adamw_8bit"}
+    else:
+        assert cpu_dtype in (
+            "float32",
+            "bfloat16",
+        ), f"unsupported cpu_dtype {cpu_dtype}"
+        model_kwargs = {"torch_dtype": getattr(torch, cpu_dtype)}
+        config_kwargs = {
+            "use_cpu": True,
+            "bf16": cpu_dtype == "bfloat16",
+            "optim": "adamw_torch",
+        }
+    return model_kwargs, config_kwargs
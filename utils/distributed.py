@@ -0,0 +1,156 @@
+"""Distributed (DDP) training of one model across the processes of a torchrun launch.
+
+`run_distributed` starts `torchrun --nproc_per_node N -m utils.distributed spec.json`,
+every rank then runs `train_lora` on its own device (or core set on CPU, with gloo),
+the trainer shards the dataset by rank and all-reduces the gradients of the LoRA
+parameters, the only ones that require grad. Rank 0 alone saves, exports, evaluates
+and writes the result file read back by the launching process.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from typing import Dict, List, Optional
+
+import torch
+import torch.distributed as dist
+from loguru import logger
+
+
+def world_size() -> int:
+    return int(os.environ.get("WORLD_SIZE", 1))
+
+
+def rank() -> int:
+    return int(os.environ.get("RANK", 0))
+
+
+def local_rank() -> int:
+    return int(os.environ.get("LOCAL_RANK", 0))
+
+
+def is_distributed() -> bool:
+    return world_size() > 1
+
+
+def is_main_process() -> bool:
+    return rank() == 0
+
+
+def rank_cpus() -> Optional[List[int]]:
+    """This rank's share of the CPU affinity, so local ranks don't oversubscribe the cores."""
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+    if local_world_size <= 1:
+        return None
+    cpus = sorted(os.sched_getaffinity(0))
+    per_rank = max(1, len(cpus) // local_world_size)
+    start = (local_rank() * per_rank) % len(cpus)
+    return cpus[start : start + per_rank]
+
+
+def all_reduce_sum(values: List[int]) -> List[int]:
+    """Sum `values` over all ranks, as is outside of an initialized process group."""
+    if not (dist.is_available() and dist.is_initialized()):
+        return values
+    # nccl reduces CUDA tensors only, gloo CPU ones
+    device = f"cuda:{local_rank()}" if dist.get_backend() == "nccl" else "cpu"
+    tensor = torch.tensor(values, dtype=torch.float64, device=device)
+    dist.all_reduce(tensor)
+    return [int(value) for value in tensor.tolist()]
+
+
+def run_distributed(
+    model_id: str,
+    context_length: int,
+    training_args: Dict,
+    nproc_per_node: int,
+    data_file: str = "data/demo_data.jsonl",
+    output_dir: str = "outputs",
+    eval_file: Optional[str] = None,
+    init_adapter: Optional[str] = None,
+) -> Dict:
+    """Train `model_id` over `nproc_per_node` torchrun processes, return rank 0's result."""
+    from utils.constants import model2template
+
+    with tempfile.TemporaryDirectory(prefix="ddp-") as workdir:
+        spec_file = os.path.join(workdir, "spec.json")
+        result_file = os.path.join(workdir, "result.json")
+        with open(spec_file, "w") as f:
+            json.dump(
+                {
+                    "model_id": model_id,
+                    # the ranks start from a fresh import, pass on templates registered at runtime
+                    "template": model2template.get(model_id),
+                    "context_length": context_length,
+                    "training_args": training_args,
+                    "data_file": data_file,
+                    "output_dir": output_dir,
+                    "eval_file": eval_file,
+                    "init_adapter": init_adapter,
+                    "result_file": result_file,
+                },
+                f,
+            )
+        command = [
+            sys.executable,
+            "-m",
+            "torch.distributed.run",
+            "--standalone",
+            f"--nproc_per_node={nproc_per_node}",
+            "-m",
+            "utils.distributed",
+            spec_file,
+        ]
+        logger.info(
+            f"Training {model_id} on {nproc_per_node} processes: {' '.join(command)}"
+        )
+        code = subprocess.call(command)
+        # RuntimeError, like an OOM in process, so the caller moves on to the next model
+        if code != 0:
+            raise RuntimeError(f"Distributed training of {model_id} exited with {code}")
+        with open(result_file) as f:
+            return json.load(f)
+
+
+def main():
+    from demo import LoraTrainingArguments, train_lora
+    from utils.constants import model2template
+    from utils.metrics import REGISTRY
+    from utils.run_ledger import end_run
+
+    with open(sys.argv[1]) as f:
+        spec = json.load(f)
+    if spec["template"] is not None:
+        model2template.setdefault(spec["model_id"], spec["template"])
+    if not is_main_process():
+        # one record per stage, rank 0's, with the throughput of all ranks
+        end_run()
+
+    model_id = spec["model_id"]
+    metrics = train_lora(
+        model_id=model_id,
+        context_length=spec["context_length"],
+        training_args=LoraTrainingArguments(**spec["training_args"]),
+        data_file=spec["data_file"],
+        output_dir=spec["output_dir"],
+        eval_file=spec["eval_file"],
+        init_adapter=spec["init_adapter"],
+    )
+    if is_main_process():
+        with open(spec["result_file"], "w") as f:
+            json.dump(
+                {
+                    "metrics": metrics,
+                    "samples": REGISTRY.get(
+                        "flock_train_samples_total", model=model_id
+                    ),
+                    "tokens": REGISTRY.get("flock_train_tokens_total", model=model_id),
+                },
+                f,
+            )
+
+
+if __name__ == "__main__":
+    main()
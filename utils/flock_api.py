@@ -4,7 +4,9 @@ import os
 import requests
 
 FLOCK_API_KEY = os.environ["FLOCK_API_KEY"]
-FED_LEDGER_BASE_URL = "https://fed-ledger-prod.flock.io/api/v1"
+FED_LEDGER_BASE_URL = os.environ.get(
+    "FED_LEDGER_BASE_URL", "https://fed-ledger-prod.flock.io/api/v1"
+)
 
 
 def get_task(task_id: int):
@@ -0,0 +1,118 @@
+import fnmatch
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from huggingface_hub import CommitOperationAdd, HfApi
+from loguru import logger
+
+from utils.run_ledger import annotate
+
+# only what the validator needs to load the adapter on top of the base model
+UPLOAD_PATTERNS = [
+    "adapter_config.json",
+    "adapter_model.safetensors",
+    "adapter_model.bin",
+    "tokenizer.json",
+    "tokenizer.model",
+    "tokenizer_config.json",
+    "special_tokens_map.json",
+    "added_tokens.json",
+    "vocab.json",
+    "merges.txt",
+]
+MANIFEST_FILE = "upload_manifest.json"
+
+
+def hash_file(path: str, chunk_size: int = 1 << 20) -> Dict[str, object]:
+    """sha256 for LFS-tracked files and the git blob id for regular ones, in one pass."""
+    size = os.path.getsize(path)
+    sha256 = hashlib.sha256()
+    git_sha1 = hashlib.sha1(b"blob %d\0" % size)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+            git_sha1.update(chunk)
+    return {"size": size, "sha256": sha256.hexdigest(), "blob_id": git_sha1.hexdigest()}
+
+
+def build_manifest(
+    folder: str, patterns: List[str] = UPLOAD_PATTERNS, num_workers: int = 4
+):
+    """Hash the files in `folder` that match `patterns` and write them to the manifest file."""
+    files = sorted(
+        name
+        for name in os.listdir(folder)
+        if os.path.isfile(os.path.join(folder, name))
+        and any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+    )
+    with ThreadPoolExecutor(num_workers) as pool:
+        hashes = pool.map(hash_file, [os.path.join(folder, name) for name in files])
+    manifest = dict(zip(files, hashes))
+    with open(os.path.join(folder, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def remote_hashes(api: HfApi, repo_id: str, revision: str) -> Dict[str, str]:
+    hashes = {}
+    for entry in api.list_repo_tree(
+        repo_id, recursive=True, revision=revision, repo_type="model"
+    ):
+        if not hasattr(entry, "blob_id"):
+            continue  # folder
+        hashes[entry.path] = (
+            entry.lfs.sha256 if entry.lfs is not None else entry.blob_id
+        )
+    return hashes
+
+
+def upload_outputs(
+    api: HfApi,
+    repo_id: str,
+    folder: str,
+    num_workers: int = 4,
+    commit_message: Optional[str] = None,
+) -> str:
+    """Upload the manifest files of `folder` that differ from the repo HEAD, return the commit hash.
+
+    Files whose content already matches HEAD (the tokenizer, on every run after the
+    first for a base model) are not sent again. If nothing changed, HEAD is returned.
+    """
+    manifest = build_manifest(folder, num_workers=num_workers)
+    head = api.repo_info(repo_id, repo_type="model").sha
+    existing = remote_hashes(api, repo_id, revision=head)
+
+    changed = [
+        name
+        for name, info in manifest.items()
+        if existing.get(name) not in (info["sha256"], info["blob_id"])
+    ]
+    skipped = sorted(set(manifest) - set(changed))
+    uploaded_bytes = sum(manifest[name]["size"] for name in changed)
+    logger.info(
+        f"Uploading {len(changed)} files ({uploaded_bytes} bytes), "
+        f"{len(skipped)} unchanged: {skipped}"
+    )
+    annotate(bytes=uploaded_bytes, rows=len(changed))
+    if not changed:
+        return head
+
+    # the manifest goes along so the repo records what this revision was built from
+    operations = [
+        CommitOperationAdd(
+            path_in_repo=name, path_or_fileobj=os.path.join(folder, name)
+        )
+        for name in changed + [MANIFEST_FILE]
+    ]
+    commit = api.create_commit(
+        repo_id=repo_id,
+        operations=operations,
+        commit_message=commit_message or f"Upload {', '.join(changed)}",
+        repo_type="model",
+        parent_commit=head,
+        num_threads=num_workers,
+    )
+    return commit.oid
@@ -0,0 +1,312 @@
+"""Generate from trained adapters before uploading them, to catch broken templates early.
+
+The base model is loaded once; every adapter is loaded next to the others and switched
+to with `set_adapter`, so sanity-checking several adapters costs one model load.
+Prompts are the held-out conversations cut before each assistant or function_call
+turn, rendered with `model2template` exactly as training renders them, and are
+generated greedily in left-padded, length-sorted batches with the KV cache on.
+
+    python -m utils.inference --base-model Qwen/Qwen1.5-0.5B \
+        --adapter task-1=workspaces/task-1/<run>/Qwen-Qwen1.5-0.5B/outputs \
+        --data workspaces/task-1/<run>/data/eval.jsonl
+"""
+
+import argparse
+import json
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import torch
+from loguru import logger
+from peft import PeftModel
+
+from utils.local_eval import length_sorted_batches
+from utils.tool_utils import format_function_call, parse_function_calls
+
+
+@dataclass
+class Prompt:
+    input_ids: List[int]
+    # "assistant" or "function_call", the role of the turn the model should produce
+    role: str
+    reference: str
+
+
+def build_prompts(
+    data: Dict, tokenizer, template: Dict, max_prompt_tokens: int
+) -> List[Prompt]:
+    """One prompt per assistant/function_call turn of a conversation, tokenized like training.
+
+    The prompt of an assistant turn is the same token prefix SFTDataset trains it after.
+    """
+    prefix = []
+    if template["system_format"] is not None:
+        system = data["system"].strip() if "system" in data else template["system"]
+        if system is not None:
+            prefix = tokenizer.encode(
+                template["system_format"].format(content=system),
+                add_special_tokens=False,
+            )
+
+    prompts, buffer = [], ""
+    for turn in data["conversations"]:
+        role, content = turn["role"], turn["content"].strip()
+        if role in ("assistant", "function_call"):
+            input_ids = prefix + tokenizer.encode(buffer, add_special_tokens=False)
+            if len(input_ids) <= max_prompt_tokens:
+                prompts.append(Prompt(input_ids, role, content))
+        if role == "user":
+            buffer += template["user_format"].format(
+                content=content, stop_token=tokenizer.eos_token
+            )
+        elif role == "function_call":
+            buffer += template["function_format"].format(
+                content=format_function_call(content)
+            )
+        elif role == "observation":
+            buffer += template["observation_format"].format(content=content)
+        elif role == "assistant":
+            assistant = template["assistant_format"].format(
+                content=content, stop_token=tokenizer.eos_token
+            )
+            prefix = prefix + tokenizer.encode(buffer, add_special_tokens=False)
+            prefix = prefix + tokenizer.encode(assistant, add_special_tokens=False)
+            buffer = ""
+    return prompts
+
+
+def load_prompts(
+    path: str, tokenizer, template: Dict, max_prompts: int, max_prompt_tokens: int
+) -> List[Prompt]:
+    prompts = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                prompts.extend(
+                    build_prompts(
+                        json.loads(line), tokenizer, template, max_prompt_tokens
+                    )
+                )
+            if len(prompts) >= max_prompts:
+                break
+    return prompts[:max_prompts]
+
+
+def stop_token_ids(tokenizer, template: Dict) -> List[int]:
+    """The token closing an assistant turn in `template`, plus the tokenizer's eos."""
+    suffix = template["assistant_format"].split("{content}", 1)[1]
+    suffix = suffix.format(stop_token=tokenizer.eos_token).strip()
+    ids = {tokenizer.eos_token_id}
+    if suffix:
+        ids.add(tokenizer.encode(suffix, add_special_tokens=False)[0])
+    return sorted(i for i in ids if i is not None)
+
+
+@torch.inference_mode()
+def generate(
+    model,
+    tokenizer,
+    prompts: List[Prompt],
+    stop_ids: List[int],
+    max_new_tokens: int = 64,
+    max_batch_size: int = 16,
+    max_tokens: int = 8192,
+) -> List[Dict[str, Any]]:
+    """Greedy generations of `prompts` (in order), each with its tokens and whether it stopped."""
+    device = next(model.parameters()).device
+    pad_id = (
+        tokenizer.pad_token_id if tokenizer.pad_token_id is not None else stop_ids[0]
+    )
+    lengths = [len(prompt.input_ids) + max_new_tokens for prompt in prompts]
+    outputs: List[Optional[Dict[str, Any]]] = [None] * len(prompts)
+    for batch in length_sorted_batches(lengths, max_tokens, max_batch_size):
+        width = max(len(prompts[i].input_ids) for i in batch)
+        # left padded, so every row's next token is generated at the same position
+        input_ids = torch.full((len(batch), width), pad_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch), width), dtype=torch.long)
+        for row, i in enumerate(batch):
+            ids = prompts[i].input_ids
+            input_ids[row, width - len(ids) :] = torch.tensor(ids)
+            attention_mask[row, width - len(ids) :] = 1
+        generated = model.generate(
+            input_ids=input_ids.to(device),
+            attention_mask=attention_mask.to(device),
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            use_cache=True,
+            eos_token_id=stop_ids,
+            pad_token_id=pad_id,
+        )[:, width:].tolist()
+        for row, i in enumerate(batch):
+            tokens = generated[row]
+            stop = next(
+                (k for k, token in enumerate(tokens) if token in stop_ids), None
+            )
+            outputs[i] = {
+                "tokens": tokens if stop is None else tokens[: stop + 1],
+                "stopped": stop is not None,
+            }
+    return outputs
+
+
+def score(
+    prompts: List[Prompt], outputs: List[Dict[str, Any]], tokenizer
+) -> Dict[str, Any]:
+    """Stop rate over all prompts, parse and tool-name match rates over the function_call ones."""
+    calls = parsed = names = 0
+    for prompt, output in zip(prompts, outputs):
+        output["text"] = tokenizer.decode(output["tokens"], skip_special_tokens=True)
+        if prompt.role != "function_call":
+            continue
+        calls += 1
+        generated = parse_function_calls(output["text"])
+        if generated is not None:
+            parsed += 1
+            expected = parse_function_calls(format_function_call(prompt.reference))
+            names += [name for name, _ in generated] == [name for name, _ in expected]
+    return {
+        "prompts": len(prompts),
+        "stop_rate": sum(output["stopped"] for output in outputs) / len(outputs)
+        if outputs
+        else 0.0,
+        "function_call_prompts": calls,
+        "parse_rate": parsed / calls if calls else None,
+        "name_match_rate": names / calls if calls else None,
+    }
+
+
+class AdapterHarness:
+    """A base model loaded once, with any number of LoRA adapters hot-swapped on top of it."""
+
+    def __init__(
+        self,
+        base_model: str,
+        template: Dict,
+        device: Optional[str] = None,
+        cpu_dtype: str = "float32",
+    ):
+        from demo import load_model
+        from utils.device_utils import resolve_device
+
+        self.base_model = base_model
+        self.template = template
+        self.model, self.tokenizer, _ = load_model(
+            base_model, resolve_device(device), cpu_dtype
+        )
+        self.model.eval()
+        self.adapters: List[str] = []
+        self.stop_ids = stop_token_ids(self.tokenizer, template)
+
+    def add_adapter(self, name: str, path: str):
+        if not self.adapters:
+            self.model = PeftModel.from_pretrained(self.model, path, adapter_name=name)
+        else:
+            self.model.load_adapter(path, adapter_name=name)
+        self.model.eval()
+        self.adapters.append(name)
+
+    def run(
+        self, adapter: Optional[str], prompts: List[Prompt], **generate_kwargs
+    ) -> Dict[str, Any]:
+        """Generate with `adapter` active (None for the bare base model) and score the outputs."""
+        start = time.perf_counter()
+        if adapter is None and self.adapters:
+            with self.model.disable_adapter():
+                outputs = generate(
+                    self.model,
+                    self.tokenizer,
+                    prompts,
+                    self.stop_ids,
+                    **generate_kwargs,
+                )
+        else:
+            if adapter is not None:
+                self.model.set_adapter(adapter)
+            outputs = generate(
+                self.model, self.tokenizer, prompts, self.stop_ids, **generate_kwargs
+            )
+        seconds = time.perf_counter() - start
+
+        report = {"adapter": adapter, **score(prompts, outputs, self.tokenizer)}
+        tokens = sum(len(output["tokens"]) for output in outputs)
+        report.update(
+            generated_tokens=tokens,
+            seconds=round(seconds, 3),
+            tokens_per_sec=round(tokens / seconds, 1) if seconds > 0 else None,
+            examples=[output["text"] for output in outputs[:3]],
+        )
+        logger.info(
+            f"{adapter or 'base'}: stop rate {report['stop_rate']:.2%}, parse rate {report['parse_rate']}, "
+            f"{report['tokens_per_sec']} tokens/s"
+        )
+        return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Sanity-check generations of trained LoRA adapters."
+    )
+    parser.add_argument("--base-model", required=True)
+    parser.add_argument(
+        "--adapter",
+        action="append",
+        default=[],
+        help="name=path (or hub repo), repeatable",
+    )
+    parser.add_argument(
+        "--data", default="data/eval_data.jsonl", help="held-out conversations (JSONL)"
+    )
+    parser.add_argument(
+        "--include-base", action="store_true", help="also generate without any adapter"
+    )
+    parser.add_argument("--max-prompts", type=int, default=64)
+    parser.add_argument("--max-prompt-tokens", type=int, default=1024)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--device", default=None)
+    parser.add_argument("--output", default="inference_report.json")
+    args = parser.parse_args()
+
+    from utils.constants import model2template
+
+    assert (
+        args.base_model in model2template
+    ), f"model_id {args.base_model} not supported"
+    harness = AdapterHarness(
+        args.base_model, model2template[args.base_model], device=args.device
+    )
+    for spec in args.adapter:
+        name, _, path = spec.partition("=")
+        harness.add_adapter(name, path or name)
+    prompts = load_prompts(
+        args.data,
+        harness.tokenizer,
+        harness.template,
+        args.max_prompts,
+        args.max_prompt_tokens,
+    )
+    runs = (
+        [None] if args.include_base or not harness.adapters else []
+    ) + harness.adapters
+    reports = [
+        harness.run(
+            adapter,
+            prompts,
+            max_new_tokens=args.max_new_tokens,
+            max_batch_size=args.batch_size,
+        )
+        for adapter in runs
+    ]
+    print(json.dumps(reports, indent=2, ensure_ascii=False))
+    with open(args.output, "w") as f:
+        json.dump(
+            {"base_model": args.base_model, "reports": reports},
+            f,
+            indent=2,
+            ensure_ascii=False,
+        )
+
+
+if __name__ == "__main__":
+    main()
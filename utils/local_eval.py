@@ -0,0 +1,119 @@
+import random
+from typing import Dict, List
+
+import torch
+from loguru import logger
+
+from dataset import SFTDataCollator, SFTDataset
+from utils.chunked_loss import chunked_token_losses
+
+
+def split_holdout(
+    data_file: str, eval_file: str, fraction: float, seed: int = 42
+) -> int:
+    """Move a random `fraction` of the rows in `data_file` to `eval_file`, return the holdout size."""
+    with open(data_file, "r", encoding="utf-8") as f:
+        lines = [line for line in f if line.strip()]
+    indices = list(range(len(lines)))
+    random.Random(seed).shuffle(indices)
+    holdout = set(indices[: int(len(lines) * fraction)])
+
+    with open(data_file, "w", encoding="utf-8") as train, open(
+        eval_file, "w", encoding="utf-8"
+    ) as held:
+        for i, line in enumerate(lines):
+            (held if i in holdout else train).write(
+                line if line.endswith("\n") else line + "\n"
+            )
+    logger.info(f"Held out {len(holdout)} of {len(lines)} rows to {eval_file}")
+    return len(holdout)
+
+
+def length_sorted_batches(
+    lengths: List[int], max_tokens: int, max_batch_size: int
+) -> List[List[int]]:
+    # similar lengths batch together, so almost no compute goes to padding
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    batches, batch = [], []
+    for i in order:
+        # the first (longest) sample sets the padded width of the batch
+        width = lengths[batch[0]] if batch else lengths[i]
+        if batch and (
+            len(batch) >= max_batch_size or width * (len(batch) + 1) > max_tokens
+        ):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def evaluate_model(
+    model,
+    tokenizer,
+    template,
+    eval_file: str,
+    max_seq_length: int,
+    max_tokens: int = 16384,
+    max_batch_size: int = 32,
+    loss_chunk_size: int = 1024,
+) -> Dict[str, float]:
+    """Validation loss of `model` on `eval_file` with the training masking semantics.
+
+    Samples are built by SFTDataset and padded by SFTDataCollator, so only assistant
+    tokens are scored. `loss` is the mean of per-sample mean token losses, which does
+    not depend on how samples are batched; `token_loss` weights every token equally.
+    The `[B, L, V]` logits are never built, the assistant positions are projected
+    `loss_chunk_size` at a time.
+    """
+    dataset = SFTDataset(eval_file, tokenizer, max_seq_length, template)
+    collator = SFTDataCollator(tokenizer, max_seq_length)
+    samples = [dataset[i] for i in range(len(dataset))]
+    lengths = [len(sample["input_ids"]) for sample in samples]
+    device = next(model.parameters()).device
+    # LoRA layers sit inside the decoder modules, so the active adapter is scored
+    causal_lm = model.get_base_model() if hasattr(model, "get_base_model") else model
+    decoder, lm_head = causal_lm.get_decoder(), causal_lm.get_output_embeddings()
+    softcap = getattr(causal_lm.config, "final_logit_softcapping", None)
+
+    was_training = model.training
+    model.eval()
+    sample_losses, total_loss, total_tokens = [], 0.0, 0
+    with torch.inference_mode():
+        for batch_indices in length_sorted_batches(lengths, max_tokens, max_batch_size):
+            batch = collator([samples[i] for i in batch_indices])
+            hidden_states = decoder(
+                input_ids=batch["input_ids"].to(device),
+                attention_mask=batch["attention_mask"].to(device),
+            )[0]
+            labels = batch["labels"].to(device)
+            losses = chunked_token_losses(
+                hidden_states,
+                labels,
+                lm_head,
+                chunk_size=loss_chunk_size,
+                softcap=softcap,
+            )
+            tokens = (labels[:, 1:] != -100).sum(dim=1)
+            sums = losses.sum(dim=1)
+            for loss_sum, count in zip(sums.tolist(), tokens.tolist()):
+                if count:
+                    sample_losses.append(loss_sum / count)
+            total_loss += sums.sum().item()
+            total_tokens += tokens.sum().item()
+    if was_training:
+        model.train()
+
+    metrics = {
+        "loss": sum(sample_losses) / len(sample_losses)
+        if sample_losses
+        else float("nan"),
+        "token_loss": total_loss / total_tokens if total_tokens else float("nan"),
+        "samples": len(sample_losses),
+        "tokens": total_tokens,
+    }
+    logger.info(
+        f"Local eval loss {metrics['loss']:.4f} over {metrics['samples']} samples"
+    )
+    return metrics
@@ -0,0 +1,233 @@
+import atexit
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+
+from loguru import logger
+from transformers import TrainerCallback
+
+from utils.distributed import all_reduce_sum
+
+METRICS = {
+    # name: (type, help)
+    "flock_tasks_fetched_total": ("counter", "Tasks fetched from the ledger."),
+    "flock_tasks_submitted_total": ("counter", "Models submitted to the ledger."),
+    "flock_submit_failures_total": ("counter", "Failed submissions."),
+    "flock_stage_failures_total": ("counter", "Failed pipeline stages."),
+    "flock_stage": ("gauge", "1 for the pipeline stage running now."),
+    "flock_stage_duration_seconds": (
+        "gauge",
+        "Duration of the last run of each stage.",
+    ),
+    "flock_train_samples_total": ("counter", "Training samples processed."),
+    "flock_train_tokens_total": (
+        "counter",
+        "Training tokens processed, padding excluded.",
+    ),
+    "flock_train_tokens_per_second": (
+        "gauge",
+        "Training throughput since the last log step.",
+    ),
+    "flock_download_bytes_per_second": (
+        "gauge",
+        "Throughput of the last task data download.",
+    ),
+    "flock_upload_bytes_per_second": (
+        "gauge",
+        "Throughput of the last adapter upload.",
+    ),
+    "flock_peak_rss_bytes": ("gauge", "Peak resident memory of the last stage."),
+    "flock_peak_gpu_memory_bytes": (
+        "gauge",
+        "Peak allocated GPU memory of the last stage.",
+    ),
+}
+
+
+class Registry:
+    """Counters and gauges kept in memory, rendered in the Prometheus text format on demand.
+
+    Updating a value is a dict write under a lock, nothing touches the disk or the GPU;
+    the exporter reads a snapshot when scraped or on its flush interval.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values: Dict[Tuple[str, Tuple], float] = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def get(self, name: str, **labels) -> Optional[float]:
+        with self.lock:
+            return self.values.get((name, tuple(sorted(labels.items()))))
+
+    def snapshot(self) -> Dict[Tuple[str, Tuple], float]:
+        with self.lock:
+            return dict(self.values)
+
+    def merge(self, values: Dict[Tuple[str, Tuple], float]):
+        """Fold the `snapshot` of another process in: its counters add up, its gauges replace these."""
+        with self.lock:
+            for key, value in values.items():
+                if METRICS.get(key[0], ("untyped",))[0] == "counter":
+                    value += self.values.get(key, 0)
+                self.values[key] = value
+
+    def render(self) -> str:
+        with self.lock:
+            values = sorted(self.values.items())
+        lines, seen = [], set()
+        for (name, labels), value in values:
+            if name not in seen:
+                seen.add(name)
+                kind, help_text = METRICS.get(name, ("untyped", ""))
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+            label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+            lines.append(
+                f"{name}{{{label_text}}} {value:g}" if labels else f"{name} {value:g}"
+            )
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+_current_stage = None
+
+
+def stage_started(stage: str):
+    global _current_stage
+    if _current_stage is not None:
+        REGISTRY.set("flock_stage", 0, stage=_current_stage)
+    _current_stage = stage
+    REGISTRY.set("flock_stage", 1, stage=stage)
+
+
+def stage_finished(record: Dict):
+    """Fold a finished run ledger span into the metrics."""
+    global _current_stage
+    stage, duration = record["stage"], record["duration_s"]
+    REGISTRY.set("flock_stage", 0, stage=stage)
+    _current_stage = None
+    REGISTRY.set("flock_stage_duration_seconds", duration, stage=stage)
+    REGISTRY.set("flock_peak_rss_bytes", record["peak_rss_mb"] * 2**20)
+    if record.get("peak_gpu_mb") is not None:
+        REGISTRY.set("flock_peak_gpu_memory_bytes", record["peak_gpu_mb"] * 2**20)
+
+    ok = record["status"] == "ok"
+    if not ok:
+        REGISTRY.inc("flock_stage_failures_total", stage=stage)
+    if stage == "fetch_task" and ok:
+        REGISTRY.inc("flock_tasks_fetched_total")
+    elif stage == "submit":
+        REGISTRY.inc(
+            "flock_tasks_submitted_total" if ok else "flock_submit_failures_total"
+        )
+    elif (
+        stage in ("download", "upload") and ok and record.get("bytes") and duration > 0
+    ):
+        REGISTRY.set(f"flock_{stage}_bytes_per_second", record["bytes"] / duration)
+
+
+class TrainingMetricsCallback(TrainerCallback):
+    """Training throughput from the collator's shared counters, read only when the trainer logs.
+
+    Under DDP the counters are summed over the ranks, every rank logs at the same steps.
+    """
+
+    def __init__(self, collator, model_id: str):
+        self.collator = collator
+        self.model_id = model_id
+        self.samples = self.tokens = 0
+        self.last_time = None
+
+    def update(self):
+        now = time.perf_counter()
+        samples, tokens = all_reduce_sum(
+            [self.collator.samples_seen.value, self.collator.tokens_seen.value]
+        )
+        REGISTRY.inc(
+            "flock_train_samples_total", samples - self.samples, model=self.model_id
+        )
+        REGISTRY.inc(
+            "flock_train_tokens_total", tokens - self.tokens, model=self.model_id
+        )
+        if now > self.last_time:
+            REGISTRY.set(
+                "flock_train_tokens_per_second",
+                (tokens - self.tokens) / (now - self.last_time),
+                model=self.model_id,
+            )
+        self.samples, self.tokens, self.last_time = samples, tokens, now
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.samples, self.tokens = all_reduce_sum(
+            [self.collator.samples_seen.value, self.collator.tokens_seen.value]
+        )
+        self.last_time = time.perf_counter()
+
+    def on_log(self, args, state, control, **kwargs):
+        self.update()
+
+    def on_train_end(self, args, state, control, **kwargs):
+        self.update()
+
+
+def write_textfile(path: str):
+    # written aside and renamed, the textfile collector never reads a partial file
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        f.write(REGISTRY.render())
+    os.replace(tmp, path)
+
+
+def start_exporter(
+    port: Optional[int] = None, textfile: Optional[str] = None, interval: float = 15.0
+):
+    """Serve /metrics on `port` and/or flush to `textfile` every `interval` seconds.
+
+    Defaults come from METRICS_PORT and METRICS_TEXTFILE, with neither set this does nothing.
+    """
+    port = port if port is not None else int(os.environ.get("METRICS_PORT", 0))
+    textfile = textfile or os.environ.get("METRICS_TEXTFILE")
+    server = None
+    if port:
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip("/") != "/metrics":
+                    self.send_error(404)
+                    return
+                body = REGISTRY.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logger.info(f"Serving metrics on :{server.server_port}/metrics")
+
+    if textfile:
+
+        def flush():
+            while True:
+                time.sleep(interval)
+                write_textfile(textfile)
+
+        threading.Thread(target=flush, daemon=True).start()
+        atexit.register(write_textfile, textfile)
+        logger.info(f"Writing metrics to {textfile} every {interval:g}s")
+    return server
@@ -0,0 +1,260 @@
+import hashlib
+import multiprocessing as mp
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import requests
+from huggingface_hub import snapshot_download
+from loguru import logger
+
+from utils.sample_cache import SampleCache
+
+# enough to build the tokenizer, fetched before the weights so tokenization starts early
+TOKENIZER_PATTERNS = ["*.json", "*.model", "*.txt", "*.tiktoken"]
+WEIGHT_PATTERNS = ["*.safetensors", "*.py"]
+
+_worker_tokenizer = None
+
+
+def line_key(line) -> bytes:
+    # merge_datasets rewrites every line stripped, so the key ignores surrounding whitespace
+    if isinstance(line, str):
+        line = line.encode("utf8")
+    return hashlib.blake2b(line.strip(), digest_size=16).digest()
+
+
+def prefetch_model(model_id: str, allow_patterns: Optional[List[str]] = None) -> str:
+    """Download (or find in the HF cache) the snapshot files of `model_id`, return its folder."""
+    if os.path.isdir(model_id):
+        return model_id
+    return snapshot_download(
+        model_id, token=os.environ.get("HF_TOKEN"), allow_patterns=allow_patterns
+    )
+
+
+def _init_worker(tokenizer_path: str, max_seq_length: int, template: Dict):
+    global _worker_tokenizer
+    from transformers import AutoTokenizer
+
+    from dataset import ConversationTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, use_fast=True)
+    _worker_tokenizer = ConversationTokenizer(tokenizer, max_seq_length, template)
+
+
+def _tokenize_chunk(lines: List[bytes]) -> List[Tuple[bytes, bytes, bytes]]:
+    samples = []
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            sample = _worker_tokenizer.tokenize(line.decode("utf8"))
+        except Exception:
+            # training reports bad rows itself when it reaches them
+            continue
+        samples.append(
+            (
+                line_key(line),
+                np.asarray(sample["input_ids"], dtype=np.int32).tobytes(),
+                np.asarray(sample["target_mask"], dtype=np.uint8).tobytes(),
+            )
+        )
+    return samples
+
+
+class Preparation:
+    """Download the task data while the first model's snapshot is fetched and the data is tokenized.
+
+    The tokenizer files come first, then a spawn process pool tokenizes every completed
+    chunk of lines as it arrives (and the auxiliary data right away) while the weights
+    keep downloading. Samples are keyed by line content, so they survive the holdout
+    split and the merge; `build_cache` lays them out for the final data file.
+    """
+
+    def __init__(
+        self,
+        model_id: str,
+        template: Dict,
+        max_seq_length: int,
+        cache_bytes: int = 0,
+        num_workers: int = 2,
+        chunk_lines: int = 256,
+    ):
+        self.model_id = model_id
+        self.template = template
+        self.max_seq_length = max_seq_length
+        self.cache_bytes = cache_bytes
+        self.num_workers = num_workers
+        self.chunk_lines = chunk_lines
+        self.samples: Dict[bytes, Tuple[bytes, bytes]] = {}
+        self.sample_bytes = 0
+        self.pending: List[List[bytes]] = []
+        self.futures: List[Future] = []
+        self.pool: Optional[ProcessPoolExecutor] = None
+        self.lock = threading.Lock()
+        self.tokenizer_ready = threading.Event()
+        self.model_path: Optional[str] = None
+        self.error: Optional[BaseException] = None
+        self.cancelled = False
+        self.prefetch_thread = threading.Thread(target=self._prefetch, daemon=True)
+
+    @property
+    def tokenizing(self) -> bool:
+        return self.cache_bytes > 0
+
+    def _prefetch(self):
+        try:
+            self.model_path = prefetch_model(self.model_id, TOKENIZER_PATTERNS)
+            if self.tokenizing:
+                self._start_pool()
+            self.tokenizer_ready.set()
+            self.model_path = prefetch_model(
+                self.model_id, TOKENIZER_PATTERNS + WEIGHT_PATTERNS
+            )
+        except BaseException as e:
+            # training loads the model itself, a failed prefetch only loses the overlap
+            logger.warning(f"Prefetching {self.model_id} failed: {e}")
+            self.error = e
+            self.tokenizer_ready.set()
+
+    def _start_pool(self):
+        pool = ProcessPoolExecutor(
+            self.num_workers,
+            mp_context=mp.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.model_path, self.max_seq_length, self.template),
+        )
+        with self.lock:
+            if self.cancelled:
+                pool.shutdown(wait=False)
+                return
+            self.pool = pool
+            pending, self.pending = self.pending, []
+        for chunk in pending:
+            self._submit(pool, chunk)
+
+    def _submit(self, pool: ProcessPoolExecutor, chunk: List[bytes]):
+        try:
+            future = pool.submit(_tokenize_chunk, chunk)
+        except RuntimeError:
+            # cancelled meanwhile
+            return
+        future.add_done_callback(self._collect)
+        self.futures.append(future)
+
+    def _collect(self, future: Future):
+        if future.exception() is not None:
+            logger.warning(
+                f"Tokenizing a chunk ahead of training failed: {future.exception()}"
+            )
+            return
+        with self.lock:
+            for key, ids, mask in future.result():
+                # stop at the cache budget, the rest is tokenized lazily during training
+                if self.sample_bytes >= self.cache_bytes:
+                    return
+                self.samples[key] = (ids, mask)
+                self.sample_bytes += SampleCache.entry_size(len(mask))
+
+    def add_lines(self, lines: List[bytes]):
+        if not self.tokenizing or not lines:
+            return
+        with self.lock:
+            if self.cancelled or self.sample_bytes >= self.cache_bytes:
+                return
+            pool = self.pool
+            if pool is None:
+                self.pending.append(lines)
+                return
+        self._submit(pool, lines)
+
+    def add_file(self, path: str):
+        with open(path, "rb") as f:
+            chunk = []
+            for line in f:
+                chunk.append(line)
+                if len(chunk) >= self.chunk_lines:
+                    self.add_lines(chunk)
+                    chunk = []
+            self.add_lines(chunk)
+
+    def download(self, data_url: str, path: str) -> Tuple[int, int]:
+        """Stream `data_url` to `path`, handing every `chunk_lines` complete lines to the tokenizers."""
+        response = requests.get(data_url, stream=True)
+        response.raise_for_status()
+        size, rows, tail, lines = 0, 0, b"", []
+        with open(path, "wb") as f:
+            for block in response.iter_content(chunk_size=1 << 16):
+                f.write(block)
+                size += len(block)
+                parts = (tail + block).split(b"\n")
+                tail = parts.pop()
+                lines.extend(parts)
+                rows += len(parts)
+                if len(lines) >= self.chunk_lines:
+                    self.add_lines(lines)
+                    lines = []
+        if tail:
+            lines.append(tail)
+            rows += 1
+        self.add_lines(lines)
+        return size, rows
+
+    def start(self, extra_path: Optional[str] = None):
+        self.prefetch_thread.start()
+        if extra_path is not None and os.path.exists(extra_path):
+            self.add_file(extra_path)
+
+    def wait(self):
+        """Block until the tokenizer files are fetched and every submitted chunk is tokenized.
+
+        The weights keep downloading in the background, `load_model` waits for them
+        itself (the hub locks every file, so both downloads never fetch it twice).
+        """
+        self.tokenizer_ready.wait()
+        for future in list(self.futures):
+            future.exception()
+        if self.pool is not None:
+            self.pool.shutdown()
+        logger.info(
+            f"Prepared {self.model_id}: {len(self.samples)} samples tokenized ahead ({self.sample_bytes} bytes)"
+        )
+
+    def cancel(self):
+        """Drop the tokenization still queued, the snapshot download finishes in the background."""
+        with self.lock:
+            self.cancelled = True
+            pool, self.pool = self.pool, None
+            self.pending = []
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+        self.samples.clear()
+
+    def build_cache(
+        self, data_file: str, cache_bytes: Optional[int] = None
+    ) -> Optional[SampleCache]:
+        """A SampleCache for `data_file` holding the samples tokenized so far, by line index."""
+        if not self.samples:
+            return None
+        with open(data_file, "rb") as f:
+            keys = [line_key(line) for line in f]
+        cache = SampleCache(len(keys), cache_bytes or self.cache_bytes)
+        stored = 0
+        for index, key in enumerate(keys):
+            sample = self.samples.get(key)
+            if sample is not None:
+                ids, mask = sample
+                cache.put(
+                    index,
+                    np.frombuffer(ids, dtype=np.int32),
+                    np.frombuffer(mask, dtype=np.uint8),
+                )
+                stored += 1
+        logger.info(
+            f"Sample cache starts with {stored} of {len(keys)} samples tokenized"
+        )
+        self.samples.clear()
+        return cache
@@ -0,0 +1,110 @@
+import cProfile
+import io
+import os
+import pstats
+import time
+
+import torch
+from loguru import logger
+from torch.profiler import ProfilerActivity, profile, schedule
+from transformers import TrainerCallback
+
+
+class ProfilerCallback(TrainerCallback):
+    """Run torch.profiler over a bounded window of training steps.
+
+    The first steps are skipped (`wait`) and warmed up before `active` steps are
+    recorded. The Chrome trace and a top-N operator table are written to
+    `output_dir` once the window closes.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        active: int,
+        wait: int = 1,
+        warmup: int = 1,
+        top_n: int = 30,
+    ):
+        self.output_dir = output_dir
+        self.top_n = top_n
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        self.sort_by = (
+            "cuda_time_total" if torch.cuda.is_available() else "cpu_time_total"
+        )
+        self.profiler = profile(
+            activities=activities,
+            schedule=schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+            on_trace_ready=self._save,
+            record_shapes=True,
+            profile_memory=True,
+            with_stack=False,
+        )
+        self.running = False
+
+    def _save(self, prof):
+        os.makedirs(self.output_dir, exist_ok=True)
+        trace_path = os.path.join(self.output_dir, f"trace_step{prof.step_num}.json")
+        prof.export_chrome_trace(trace_path)
+        table = prof.key_averages().table(sort_by=self.sort_by, row_limit=self.top_n)
+        with open(os.path.join(self.output_dir, "operators.txt"), "w") as f:
+            f.write(table)
+        logger.info(f"Saved profiler trace to {trace_path}")
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.profiler.start()
+        self.running = True
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if self.running:
+            self.profiler.step()
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if self.running:
+            self.profiler.stop()
+            self.running = False
+
+
+def profile_data_pipeline(
+    dataset,
+    collator,
+    output_dir: str,
+    batch_size: int,
+    num_batches: int = 20,
+    top_n: int = 30,
+):
+    """cProfile tokenization and collation in the main process over `num_batches` batches.
+
+    `collator` must not be the trainer's counting one, the profiled batches are not trained on.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    num_samples = min(len(dataset), batch_size * num_batches)
+    # the samples go around the dataset's sample cache, training would count them as its hits
+    cache = getattr(dataset, "cache", None)
+    dataset.cache = None
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+        for begin in range(0, num_samples, batch_size):
+            collator(
+                [dataset[i] for i in range(begin, min(begin + batch_size, num_samples))]
+            )
+    finally:
+        profiler.disable()
+        dataset.cache = cache
+    elapsed = time.perf_counter() - start
+
+    profiler.dump_stats(os.path.join(output_dir, "data_pipeline.prof"))
+    stream = io.StringIO()
+    stream.write(
+        f"{num_samples} samples in {elapsed:.3f}s ({num_samples / elapsed:.1f} samples/s)\n\n"
+    )
+    pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(top_n)
+    with open(os.path.join(output_dir, "data_pipeline.txt"), "w") as f:
+        f.write(stream.getvalue())
+    logger.info(
+        f"Data pipeline: {num_samples / elapsed:.1f} samples/s, profile saved to {output_dir}"
+    )
@@ -0,0 +1,242 @@
+import argparse
+import json
+import math
+import os
+import resource
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+from loguru import logger
+
+from utils import metrics
+
+LEDGER_DIR = "runs"
+# inherited by scheduler workers, so their spans land in the same run
+LEDGER_ENV = "RUN_LEDGER_FILE"
+RUN_ID_ENV = "RUN_ID"
+TASK_ID_ENV = "RUN_TASK_ID"
+
+_local = threading.local()
+_gpu_type = None
+
+
+def start_run(task_id, ledger_dir: str = LEDGER_DIR) -> str:
+    """Open a new run of `task_id`, every later span of this process and its workers is recorded in it."""
+    os.makedirs(ledger_dir, exist_ok=True)
+    run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+    os.environ[LEDGER_ENV] = os.path.abspath(
+        os.path.join(ledger_dir, f"task-{task_id}.jsonl")
+    )
+    os.environ[RUN_ID_ENV] = run_id
+    os.environ[TASK_ID_ENV] = str(task_id)
+    return run_id
+
+
+def end_run():
+    for key in (LEDGER_ENV, RUN_ID_ENV, TASK_ID_ENV):
+        os.environ.pop(key, None)
+
+
+def gpu_type() -> str:
+    global _gpu_type
+    if _gpu_type is None:
+        import torch
+
+        from utils.gpu_utils import get_gpu_type
+
+        _gpu_type = get_gpu_type() if torch.cuda.is_available() else "cpu"
+    return _gpu_type
+
+
+def reset_peak_rss():
+    # writing 5 to clear_refs resets VmHWM (Linux), so every span sees its own peak
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # peak of the whole process lifetime, kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def annotate(**fields):
+    """Add bytes/rows/tokens (or any field) to the innermost open span, no-op outside of one."""
+    stack = getattr(_local, "stack", None)
+    if stack:
+        stack[-1].update(fields)
+
+
+@contextmanager
+def span(stage: str, model_id: Optional[str] = None, **fields) -> Iterator[Dict]:
+    """Time `stage` and append it to the ledger of the current run, a no-op when no run is open.
+
+    Peak RSS is reset when a span opens, so spans are kept flat: a nested span would
+    reset the peak of the one around it.
+    """
+    path = os.environ.get(LEDGER_ENV)
+    if path is None:
+        yield dict(fields)
+        return
+
+    record = {"bytes": None, "rows": None, "tokens": None, **fields}
+    stack = _local.__dict__.setdefault("stack", [])
+    stack.append(record)
+    cuda = "torch" in sys.modules and sys.modules["torch"].cuda.is_available()
+    if cuda:
+        sys.modules["torch"].cuda.reset_peak_memory_stats()
+    reset_peak_rss()
+    metrics.stage_started(stage)
+    start, status, error = time.time(), "ok", None
+    try:
+        yield record
+    except BaseException as e:
+        status, error = "error", f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        stack.pop()
+        end = time.time()
+        record.update(
+            run_id=os.environ.get(RUN_ID_ENV),
+            task_id=os.environ.get(TASK_ID_ENV),
+            stage=stage,
+            model_id=model_id,
+            start=start,
+            end=end,
+            duration_s=end - start,
+            status=status,
+            error=error,
+            peak_rss_mb=peak_rss_mb(),
+            peak_gpu_mb=sys.modules["torch"].cuda.max_memory_allocated() / 2**20
+            if cuda
+            else None,
+            gpu_type=gpu_type(),
+            pid=os.getpid(),
+        )
+        metrics.stage_finished(record)
+        # one short line per write, appends from concurrent workers do not interleave
+        with open(path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+def load_spans(paths: List[str]) -> List[Dict]:
+    spans = []
+    for path in paths:
+        files = (
+            [
+                os.path.join(path, name)
+                for name in sorted(os.listdir(path))
+                if name.endswith(".jsonl")
+            ]
+            if os.path.isdir(path)
+            else [path]
+        )
+        for file in files:
+            with open(file) as f:
+                spans.extend(json.loads(line) for line in f if line.strip())
+    return spans
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    # nearest-rank on the sorted values, fine for the few dozen runs a node keeps
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+def summarize(spans: List[Dict]) -> Dict:
+    """p50/p95 duration per stage, and training tokens/sec per (model, GPU type)."""
+    durations = defaultdict(list)
+    throughput = defaultdict(list)
+    failures = defaultdict(int)
+    for record in spans:
+        if record["status"] != "ok":
+            failures[record["stage"]] += 1
+            continue
+        durations[record["stage"]].append(record["duration_s"])
+        if (
+            record["stage"] == "train"
+            and record.get("tokens")
+            and record["duration_s"] > 0
+        ):
+            throughput[(record["model_id"], record["gpu_type"])].append(
+                record["tokens"] / record["duration_s"]
+            )
+
+    return {
+        "stages": {
+            stage: {
+                "count": len(values),
+                "failures": failures[stage],
+                "p50_s": percentile(values, 50),
+                "p95_s": percentile(values, 95),
+            }
+            for stage, values in (
+                (stage, durations[stage]) for stage in {**durations, **failures}
+            )
+        },
+        "tokens_per_sec": [
+            {
+                "model_id": model_id,
+                "gpu_type": gpu,
+                "runs": len(values),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+            }
+            for (model_id, gpu), values in sorted(throughput.items())
+        ],
+    }
+
+
+def format_summary(summary: Dict) -> str:
+    lines = [f"{'stage':<16}{'count':>7}{'failed':>8}{'p50 s':>10}{'p95 s':>10}"]
+    for stage, row in summary["stages"].items():
+        p50, p95 = (
+            f"{row[key]:.2f}" if row[key] is not None else "-"
+            for key in ("p50_s", "p95_s")
+        )
+        lines.append(
+            f"{stage:<16}{row['count']:>7}{row['failures']:>8}{p50:>10}{p95:>10}"
+        )
+    lines.append("")
+    lines.append(
+        f"{'model':<40}{'gpu':<28}{'runs':>6}{'p50 tok/s':>12}{'p95 tok/s':>12}"
+    )
+    for row in summary["tokens_per_sec"]:
+        lines.append(
+            f"{row['model_id']:<40}{row['gpu_type']:<28}{row['runs']:>6}{row['p50']:>12.1f}{row['p95']:>12.1f}"
+        )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Aggregate stage timings across recorded runs"
+    )
+    parser.add_argument(
+        "paths", nargs="*", default=[LEDGER_DIR], help="ledger files or folders"
+    )
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    summary = summarize(load_spans(args.paths))
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        logger.info(f"Aggregated runs from {args.paths}")
+        print(format_summary(summary))
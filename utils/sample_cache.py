@@ -0,0 +1,158 @@
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+# header slots, stored as int64 at the start of the index segment
+_WRITE_POS, _CLEAR_END, _HITS, _MISSES, _STORED_BYTES, _ENTRIES, _EVICTIONS = range(7)
+_HEADER_SLOTS = 8
+# evict at least this fraction of the arena when wrapping, to amortize the scan
+_MIN_EVICT_FRACTION = 1 / 16
+
+
+class SampleCache(object):
+    """Tokenized-sample cache shared by the training process and DataLoader workers.
+
+    Samples are kept in a fixed-size shared-memory arena as an int32 `input_ids`
+    buffer followed by a uint8 `target_mask` buffer, so a cached sample costs five
+    bytes per token instead of three lists of Python ints. The arena is written as
+    a ring: once it is full the oldest entries are evicted to make room.
+
+    The cache pickles by segment name, so DataLoader workers (fork or spawn)
+    attach to the same memory and see each other's entries across epochs.
+    """
+
+    def __init__(self, num_samples: int, max_bytes: int):
+        assert max_bytes > 0, "max_bytes must be positive"
+        self.num_samples = num_samples
+        self.max_bytes = max_bytes
+        self._owner = True
+        self._lock = mp.Lock()
+        self._arena = shared_memory.SharedMemory(create=True, size=max_bytes)
+        # header + per-sample (offset, length); offset -1 means not cached
+        self._index = shared_memory.SharedMemory(
+            create=True, size=8 * (_HEADER_SLOTS + 2 * num_samples)
+        )
+        self._attach()
+        self._header[:] = 0
+        self._header[_CLEAR_END] = max_bytes
+        self._offsets[:] = -1
+        self._lengths[:] = 0
+
+    def _attach(self):
+        index = np.ndarray(
+            (_HEADER_SLOTS + 2 * self.num_samples,),
+            dtype=np.int64,
+            buffer=self._index.buf,
+        )
+        self._header = index[:_HEADER_SLOTS]
+        self._offsets = index[_HEADER_SLOTS : _HEADER_SLOTS + self.num_samples]
+        self._lengths = index[_HEADER_SLOTS + self.num_samples :]
+        self._buffer = np.ndarray(
+            (self.max_bytes,), dtype=np.uint8, buffer=self._arena.buf
+        )
+
+    def __getstate__(self):
+        return {
+            "num_samples": self.num_samples,
+            "max_bytes": self.max_bytes,
+            "_lock": self._lock,
+            "_arena": self._arena,
+            "_index": self._index,
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._owner = False
+        self._attach()
+
+    @staticmethod
+    def entry_size(length: int) -> int:
+        # int32 ids + uint8 mask, rounded up so the next entry stays 4-byte aligned
+        return (5 * length + 3) & ~3
+
+    def get(self, index: int) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        with self._lock:
+            offset = self._offsets[index]
+            if offset < 0:
+                self._header[_MISSES] += 1
+                return None
+            self._header[_HITS] += 1
+            length = int(self._lengths[index])
+            ids = self._buffer[offset : offset + 4 * length].view(np.int32).copy()
+            mask = self._buffer[offset + 4 * length : offset + 5 * length].copy()
+        return ids, mask
+
+    def put(self, index: int, input_ids, target_mask) -> bool:
+        length = len(input_ids)
+        size = self.entry_size(length)
+        if size > self.max_bytes:
+            return False
+        with self._lock:
+            if self._offsets[index] >= 0:
+                return True
+            offset = int(self._header[_WRITE_POS])
+            if offset + size > self.max_bytes:
+                offset = 0
+                self._header[_CLEAR_END] = 0
+            if offset + size > self._header[_CLEAR_END]:
+                self._evict(offset, size)
+            self._buffer[offset : offset + 4 * length] = np.asarray(
+                input_ids, dtype=np.int32
+            ).view(np.uint8)
+            self._buffer[offset + 4 * length : offset + 5 * length] = np.asarray(
+                target_mask, dtype=np.uint8
+            )
+            self._offsets[index] = offset
+            self._lengths[index] = length
+            self._header[_WRITE_POS] = offset + size
+            self._header[_STORED_BYTES] += size
+            self._header[_ENTRIES] += 1
+        return True
+
+    def _evict(self, offset: int, size: int):
+        # drop every entry overlapping the region about to be overwritten
+        end = min(
+            self.max_bytes,
+            offset + max(size, int(self.max_bytes * _MIN_EVICT_FRACTION)),
+        )
+        self._header[_CLEAR_END] = end
+        cached = self._offsets >= 0
+        starts = self._offsets
+        ends = starts + (5 * self._lengths + 3) // 4 * 4
+        victims = cached & (starts < end) & (ends > offset)
+        count = int(victims.sum())
+        if count:
+            self._header[_STORED_BYTES] -= int((ends[victims] - starts[victims]).sum())
+            self._header[_ENTRIES] -= count
+            self._header[_EVICTIONS] += count
+            self._offsets[victims] = -1
+            self._lengths[victims] = 0
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            hits, misses = int(self._header[_HITS]), int(self._header[_MISSES])
+            entries = int(self._header[_ENTRIES])
+            stored = int(self._header[_STORED_BYTES])
+            evictions = int(self._header[_EVICTIONS])
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "evictions": evictions,
+            "stored_bytes": stored,
+            "bytes_per_sample": stored / entries if entries else 0.0,
+        }
+
+    def close(self):
+        # drop numpy views before closing, SharedMemory refuses to close with exports
+        self._header = self._offsets = self._lengths = self._buffer = None
+        self._arena.close()
+        self._index.close()
+        if self._owner:
+            self._arena.unlink()
+            self._index.unlink()
+            self._owner = False
@@ -0,0 +1,177 @@
+import multiprocessing as mp
+import os
+import queue
+import time
+import traceback
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from loguru import logger
+
+from utils.constants import model2size
+
+
+@dataclass
+class WorkerSpec:
+    """A training slot: one CUDA device, or a set of CPU cores."""
+
+    name: str
+    cuda_device: Optional[str] = None
+    cpus: Optional[List[int]] = None
+
+
+@dataclass
+class Job:
+    model_id: str
+    args: Dict[str, Any]
+    cost: float = 0.0
+
+
+@dataclass
+class JobResult:
+    model_id: str
+    worker: str
+    ok: bool
+    duration_s: float
+    value: Any = None
+    error: Optional[str] = None
+    exitcode: Optional[int] = None
+
+
+def estimate_cost(model_id: str, training_args: Dict[str, Any]) -> float:
+    # every model trains on the same task data, so parameters x epochs orders the jobs
+    return model2size.get(model_id, 0) * training_args.get("num_train_epochs", 1)
+
+
+def detect_workers(cpus_per_worker: Optional[int] = None) -> List[WorkerSpec]:
+    """One worker per visible CUDA device, otherwise split the CPU affinity into core sets."""
+    import torch
+
+    if torch.cuda.is_available():
+        visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+        devices = (
+            visible.split(",")
+            if visible
+            else [str(i) for i in range(torch.cuda.device_count())]
+        )
+        return [WorkerSpec(name=f"cuda:{d}", cuda_device=d) for d in devices]
+
+    cpus = sorted(os.sched_getaffinity(0))
+    cpus_per_worker = cpus_per_worker or len(cpus)
+    chunks = [
+        cpus[i : i + cpus_per_worker] for i in range(0, len(cpus), cpus_per_worker)
+    ]
+    # a short trailing core set would make the slowest worker even slower
+    if len(chunks) > 1 and len(chunks[-1]) < cpus_per_worker:
+        chunks.pop()
+    return [
+        WorkerSpec(name=f"cpu:{chunk[0]}-{chunk[-1]}", cpus=chunk) for chunk in chunks
+    ]
+
+
+def _run_job(target: Callable, spec: WorkerSpec, job: Job, results):
+    # pin the process before the target touches CUDA or builds torch thread pools
+    if spec.cuda_device is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = spec.cuda_device
+        os.environ["TRAIN_DEVICE"] = "cuda"
+    else:
+        os.environ["TRAIN_DEVICE"] = "cpu"
+        if spec.cpus:
+            os.sched_setaffinity(0, spec.cpus)
+    start = time.time()
+    try:
+        value = target(job)
+        results.put(
+            JobResult(job.model_id, spec.name, True, time.time() - start, value=value)
+        )
+    except BaseException as e:
+        logger.error(f"Job {job.model_id} failed on {spec.name}: {e}")
+        results.put(
+            JobResult(
+                job.model_id,
+                spec.name,
+                False,
+                time.time() - start,
+                error=f"{type(e).__name__}: {e}\n{traceback.format_exc()}",
+            )
+        )
+
+
+def run_jobs(
+    jobs: Iterable[Job],
+    workers: List[WorkerSpec],
+    target: Callable[[Job], Any],
+    on_result: Optional[Callable[[JobResult], None]] = None,
+    poll_interval: float = 0.5,
+) -> List[JobResult]:
+    """Run `target(job)` for every job on a pool of pinned worker processes.
+
+    Jobs are dispatched longest-first by `cost` to whichever worker frees up, each
+    in a fresh spawned process so that an OOM or a crash only fails that job.
+    Results are handed to `on_result` in this process as they complete.
+    """
+    assert workers, "at least one worker is required"
+    pending = sorted(jobs, key=lambda job: job.cost, reverse=True)
+    ctx = mp.get_context("spawn")
+    results_queue = ctx.Queue()
+    running: Dict[str, tuple] = {}
+    idle = list(workers)
+    results: List[JobResult] = []
+
+    def finish(result: JobResult):
+        spec, _, process, _ = running.pop(result.worker)
+        process.join()
+        result.exitcode = process.exitcode
+        idle.append(spec)
+        results.append(result)
+        if on_result is not None:
+            on_result(result)
+
+    while pending or running:
+        while pending and idle:
+            spec, job = idle.pop(0), pending.pop(0)
+            process = ctx.Process(
+                target=_run_job,
+                args=(target, spec, job, results_queue),
+                name=f"train-{spec.name}",
+            )
+            process.start()
+            running[spec.name] = (spec, job, process, time.time())
+            logger.info(f"Started {job.model_id} on {spec.name} (cost {job.cost:.3g})")
+
+        try:
+            result = results_queue.get(timeout=poll_interval)
+        except queue.Empty:
+            result = None
+        if result is not None:
+            finish(result)
+            continue
+
+        # a worker killed by the OOM killer or a segfault never reports back
+        dead = [
+            name
+            for name, (_, _, process, _) in running.items()
+            if not process.is_alive()
+        ]
+        if not dead:
+            continue
+        # results queued just before the process exited are still in flight
+        try:
+            while True:
+                finish(results_queue.get(timeout=poll_interval))
+        except queue.Empty:
+            pass
+        for name in dead:
+            if name not in running:
+                continue
+            _, job, process, started = running[name]
+            finish(
+                JobResult(
+                    job.model_id,
+                    name,
+                    False,
+                    time.time() - started,
+                    error=f"worker exited with code {process.exitcode}",
+                )
+            )
+    return results
@@ -0,0 +1,144 @@
+import json
+import os
+import random
+from typing import List
+
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import PreTrainedTokenizerFast, Qwen2Config, Qwen2ForCausalLM
+
+SPECIAL_TOKENS = ["<|endoftext|>", "<|im_start|>", "<|im_end|>"]
+
+WORDS = (
+    "the a of to and in is it that for on with as wallet token swap chain block "
+    "price market risk address protocol amount balance analyze execute report "
+    "user assistant tool please check what how when why can you show me"
+).split()
+
+
+def random_sentence(rng: random.Random, min_words: int = 4, max_words: int = 24) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words)))
+
+
+def build_tokenizer(save_dir: str, vocab_size: int = 512) -> PreTrainedTokenizerFast:
+    """Train a small byte-level BPE tokenizer offline and save it to `save_dir`.
+
+    Special tokens follow the qwen template so `model2template` entries using
+    `qwen_template` render and tokenize the same way as with a real Qwen tokenizer.
+    """
+    rng = random.Random(0)
+    corpus = [random_sentence(rng) for _ in range(2000)]
+
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=SPECIAL_TOKENS,
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    tokenizer.train_from_iterator(corpus, trainer=trainer)
+
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        eos_token="<|im_end|>",
+        pad_token="<|endoftext|>",
+    )
+    os.makedirs(save_dir, exist_ok=True)
+    tokenizer.save_pretrained(save_dir)
+    return tokenizer
+
+
+def build_tiny_model(
+    save_dir: str, tokenizer, hidden_size: int = 64, num_layers: int = 2
+):
+    """Save a randomly initialized Qwen2-architecture causal LM sized for CPU tests."""
+    config = Qwen2Config(
+        vocab_size=len(tokenizer),
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 2,
+        num_hidden_layers=num_layers,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=4096,
+        bos_token_id=tokenizer.pad_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+        tie_word_embeddings=False,
+    )
+    model = Qwen2ForCausalLM(config)
+    model.save_pretrained(save_dir)
+    tokenizer.save_pretrained(save_dir)
+    return model
+
+
+TOOLS = [
+    {
+        "name": "get_balance",
+        "description": "Get the token balance of a wallet",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "address": {"type": "string", "description": "wallet address"},
+                "token": {"type": "string", "description": "token symbol"},
+            },
+            "required": ["address"],
+        },
+    },
+    {
+        "name": "swap",
+        "description": "Swap an amount of one token for another",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "amount": {"type": "number", "description": "amount to sell"},
+                "sell": {"type": "string", "description": "token to sell"},
+                "buy": {"type": "string", "description": "token to buy"},
+            },
+            "required": ["amount", "sell", "buy"],
+        },
+    },
+]
+
+
+def make_tool_turns(rng: random.Random) -> List[dict]:
+    """A function_call turn and the observation it returns, as in function_calling_demo.jsonl."""
+    tool = rng.choice(TOOLS)
+    arguments = {name: rng.choice(WORDS) for name in tool["parameters"]["properties"]}
+    result = {"status": "success", "data": random_sentence(rng)}
+    return [
+        {
+            "role": "function_call",
+            "content": json.dumps({"name": tool["name"], "arguments": arguments}),
+        },
+        {"role": "observation", "content": json.dumps(result)},
+    ]
+
+
+def make_conversation(rng: random.Random, turns: int = 2, tool_turns: int = 0) -> dict:
+    """`turns` user/assistant exchanges, the first `tool_turns` of them answered through a tool call."""
+    conversations: List[dict] = []
+    for turn in range(turns):
+        conversations.append({"role": "user", "content": random_sentence(rng)})
+        if turn < tool_turns:
+            conversations.extend(make_tool_turns(rng))
+        conversations.append({"role": "assistant", "content": random_sentence(rng)})
+    return {
+        "system": "You are a helpful assistant.",
+        "tools": json.dumps(TOOLS),
+        "conversations": conversations,
+    }
+
+
+def write_conversations(
+    path: str, num_samples: int, turns: int = 2, seed: int = 0, tool_turns: int = 0
+):
+    """Write `num_samples` synthetic conversations in the SFTDataset JSONL schema."""
+    rng = random.Random(seed)
+    with open(path, "w", encoding="utf8") as f:
+        for _ in range(num_samples):
+            f.write(
+                json.dumps(
+                    make_conversation(rng, turns, tool_turns), ensure_ascii=False
+                )
+                + "\n"
+            )
@@ -0,0 +1,172 @@
+"""Train for as long as a deadline allows instead of a fixed number of epochs.
+
+`TimeBudgetCallback` times the first optimizer steps, derives how many steps fit
+before the deadline (capped at `time_budget_max_epochs` epochs), refits the LR
+schedule to end on that step and stops training there, so the adapter is saved as
+usual. `split_deadline` shares the time left for a task among its models by their
+estimated cost, and `post_train_reserve` is what a model still needs after
+training (export, eval, upload, submit) going by the run ledger. A run of
+full_automation.py has `TIME_BUDGET_S` seconds from its start when that is set.
+"""
+
+import os
+import time
+from typing import Dict, List, Optional
+
+from loguru import logger
+from torch.optim.lr_scheduler import LambdaLR
+from transformers import TrainerCallback, get_scheduler
+
+from utils.distributed import all_reduce_sum, is_distributed, world_size
+from utils.run_ledger import LEDGER_DIR, load_spans, percentile
+
+BUDGET_ENV = "TIME_BUDGET_S"
+# stages of a model that run after training, their p95 is kept free of the budget
+POST_TRAIN_STAGES = ("export", "eval", "upload", "submit")
+
+
+def deadline_from_env() -> Optional[float]:
+    budget = os.environ.get(BUDGET_ENV)
+    return time.time() + float(budget) if budget else None
+
+
+def split_deadline(
+    deadline: float, costs: Dict[str, float], workers: int = 1
+) -> Dict[str, float]:
+    """Seconds until `deadline` for each model, in proportion to its cost.
+
+    With several workers training side by side a model gets up to the whole window.
+    """
+    window = max(0.0, deadline - time.time())
+    total = sum(costs.values())
+    if total <= 0:
+        return {model_id: window * min(1.0, workers / len(costs)) for model_id in costs}
+    return {
+        model_id: window * min(1.0, workers * cost / total)
+        for model_id, cost in costs.items()
+    }
+
+
+def post_train_reserve(
+    model_id: str, ledger_dir: str = LEDGER_DIR, default: float = 60.0
+) -> float:
+    """p95 seconds of the stages after training in past runs of `model_id`, `default` without any."""
+    try:
+        spans = load_spans([ledger_dir])
+    except FileNotFoundError:
+        spans = []
+    durations: Dict[str, List[float]] = {}
+    for record in spans:
+        if (
+            record["stage"] in POST_TRAIN_STAGES
+            and record.get("model_id") == model_id
+            and record["status"] == "ok"
+        ):
+            durations.setdefault(record["stage"], []).append(record["duration_s"])
+    if not durations:
+        return default
+    return sum(percentile(values, 95) for values in durations.values())
+
+
+def model_budget(model_id: str, share: float, deadline: float) -> float:
+    """Training seconds of `model_id`: its share, no later than `deadline`, less what it needs after training."""
+    return min(share, deadline - time.time()) - post_train_reserve(model_id)
+
+
+def refit_lr_schedule(lr_scheduler, args, num_training_steps: int) -> bool:
+    """Make the LR schedule of `args` end on `num_training_steps`, from the current step on."""
+    # accelerate may wrap the scheduler, the lambdas are on the torch one
+    lr_scheduler = getattr(lr_scheduler, "scheduler", lr_scheduler)
+    if not isinstance(lr_scheduler, LambdaLR):
+        return False
+    optimizer = lr_scheduler.optimizer
+    refitted = get_scheduler(
+        args.lr_scheduler_type,
+        optimizer,
+        num_warmup_steps=args.get_warmup_steps(num_training_steps),
+        num_training_steps=num_training_steps,
+        scheduler_specific_kwargs=args.lr_scheduler_kwargs,
+    )
+    lr_scheduler.lr_lambdas = refitted.lr_lambdas
+    # building the new schedule reset the learning rates to its first step's
+    for group, base_lr, lr_lambda in zip(
+        optimizer.param_groups, lr_scheduler.base_lrs, lr_scheduler.lr_lambdas
+    ):
+        group["lr"] = base_lr * lr_lambda(lr_scheduler.last_epoch)
+    lr_scheduler._last_lr = [group["lr"] for group in optimizer.param_groups]
+    return True
+
+
+class TimeBudgetCallback(TrainerCallback):
+    """Stop training at the last step that fits before `deadline` (a `time.time()` value).
+
+    The step time is measured from the end of the first step, which pays for warm-up,
+    over `calibration_steps` steps; a resumed run counts them from its checkpoint. Under DDP the ranks agree on the mean of their
+    horizons and on whether the deadline passed: a rank stopping alone would hang the others.
+    """
+
+    def __init__(
+        self, deadline: float, max_steps: int, calibration_steps: int = 5, collator=None
+    ):
+        self.deadline = deadline
+        self.max_steps = max_steps
+        self.calibration_steps = calibration_steps
+        self.collator = collator
+        self.horizon: Optional[int] = None
+        self.start = self.start_tokens = None
+        self.first_step = 0
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.first_step = state.global_step
+
+    def on_step_end(self, args, state, control, lr_scheduler=None, **kwargs):
+        step = state.global_step
+        if step == self.first_step + 1:
+            self.start = time.time()
+            self.start_tokens = (
+                self.collator.tokens_seen.value if self.collator is not None else None
+            )
+        elif (
+            self.horizon is None
+            and step == self.first_step + 1 + self.calibration_steps
+        ):
+            self.calibrate(args, state, step, lr_scheduler)
+        if self.horizon is not None and step >= self.horizon:
+            control.should_training_stop = True
+        elif self.deadline_passed():
+            logger.warning(
+                f"Time budget exhausted at step {step}, stopping before the horizon"
+            )
+            control.should_training_stop = True
+        return control
+
+    def deadline_passed(self) -> bool:
+        passed = time.time() >= self.deadline
+        if is_distributed():
+            # any rank past the deadline stops them all, at the same step
+            return all_reduce_sum([int(passed)])[0] > 0
+        return passed
+
+    def calibrate(self, args, state, step, lr_scheduler):
+        now = time.time()
+        step_time = (now - self.start) / self.calibration_steps
+        horizon = (
+            step + int(max(0.0, self.deadline - now) / step_time)
+            if step_time > 0
+            else self.max_steps
+        )
+        horizon = min(max(horizon, step), self.max_steps)
+        if is_distributed():
+            horizon = all_reduce_sum([horizon])[0] // world_size()
+        self.horizon = state.max_steps = horizon
+
+        throughput = ""
+        if self.collator is not None:
+            throughput = f", {(self.collator.tokens_seen.value - self.start_tokens) / (now - self.start):.0f} tokens/s"
+        refitted = lr_scheduler is not None and refit_lr_schedule(
+            lr_scheduler, args, horizon
+        )
+        logger.info(
+            f"Time budget: {step_time:.2f}s/step{throughput}, training {horizon} steps "
+            f"(at most {self.max_steps}){', LR schedule refitted' if refitted else ''}"
+        )
@@ -0,0 +1,168 @@
+"""Tokenized rows kept on disk across runs, keyed by their content.
+
+A data file changed by appending or regenerating some rows is compiled by hashing
+every line, tokenizing only the lines the store has never seen and rebuilding the
+per-line index into the store, so recompiling costs in proportion to the change.
+One store per tokenization (tokenizer, template, max_seq_length), in
+`<workspace root>/shared/tokens-<fingerprint>/`:
+
+    ids.bin    int32 token ids of every row, appended
+    mask.bin   uint8 target mask, aligned with ids.bin
+    keys.bin   line_key of every row, 16 bytes each
+    rows.bin   int64 (start, length) of every row in ids.bin
+    meta.json  committed row and token counts, whatever lies past them is a torn append
+
+Appends happen under `append.lock` and never move existing rows, so runs keep
+reading the store while another one compiles into it.
+"""
+
+import hashlib
+import json
+import os
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+
+from utils.prepare import line_key
+from utils.workspace import file_lock, shared_path
+
+KEY_BYTES = 16
+
+
+def tokenization_fingerprint(tokenizer, template: Dict, max_seq_length: int) -> str:
+    """Stable across processes and runs, changes with anything that changes the tokens."""
+    if getattr(tokenizer, "is_fast", False):
+        vocab = tokenizer.backend_tokenizer.to_str()
+    else:
+        vocab = json.dumps(tokenizer.get_vocab(), sort_keys=True)
+    digest = hashlib.blake2b(digest_size=8)
+    for part in (
+        vocab,
+        json.dumps(template, sort_keys=True),
+        str(max_seq_length),
+        str(tokenizer.eos_token),
+    ):
+        digest.update(part.encode("utf8"))
+    return digest.hexdigest()
+
+
+class TokenStore(object):
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    @classmethod
+    def for_tokenization(
+        cls, tokenizer, template: Dict, max_seq_length: int, root: Optional[str] = None
+    ):
+        fingerprint = tokenization_fingerprint(tokenizer, template, max_seq_length)
+        return cls(shared_path(f"tokens-{fingerprint}", root))
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def meta(self) -> Dict[str, int]:
+        if not os.path.exists(self._file("meta.json")):
+            return {"rows": 0, "tokens": 0}
+        with open(self._file("meta.json")) as f:
+            return json.load(f)
+
+    def _write_meta(self, meta: Dict[str, int]):
+        tmp = self._file(f"meta.json.tmp-{os.getpid()}")
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, self._file("meta.json"))
+
+    def _truncate(self, meta: Dict[str, int]):
+        # drop the tail of an append that died before committing
+        sizes = {
+            "ids.bin": 4 * meta["tokens"],
+            "mask.bin": meta["tokens"],
+            "keys.bin": KEY_BYTES * meta["rows"],
+            "rows.bin": 16 * meta["rows"],
+        }
+        for name, size in sizes.items():
+            with open(self._file(name), "ab") as f:
+                if f.tell() != size:
+                    f.truncate(size)
+
+    def rows(self, count: Optional[int] = None) -> np.ndarray:
+        count = self.meta()["rows"] if count is None else count
+        return np.fromfile(
+            self._file("rows.bin"), dtype=np.int64, count=2 * count
+        ).reshape(-1, 2)
+
+    def compile(
+        self, data_file: str, tokenize: Callable[[str], Dict]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """(start, length) in the store of every non-blank line of `data_file`, tokenizing only new lines."""
+        start_time = time.perf_counter()
+        with file_lock(self._file("append")):
+            meta = self.meta()
+            self._truncate(meta)
+            keys = np.fromfile(
+                self._file("keys.bin"), dtype=f"V{KEY_BYTES}", count=meta["rows"]
+            )
+            known = {key.tobytes(): row for row, key in enumerate(keys)}
+            line_rows, appended = [], 0
+            files = {
+                name: open(self._file(name), "ab")
+                for name in ("ids.bin", "mask.bin", "keys.bin", "rows.bin")
+            }
+            try:
+                with open(data_file, "rb") as f:
+                    for line in f:
+                        if not line.strip():
+                            continue
+                        key = line_key(line)
+                        row = known.get(key)
+                        if row is None:
+                            sample = tokenize(line.decode("utf8"))
+                            length = len(sample["input_ids"])
+                            files["ids.bin"].write(
+                                np.asarray(
+                                    sample["input_ids"], dtype=np.int32
+                                ).tobytes()
+                            )
+                            files["mask.bin"].write(
+                                np.asarray(
+                                    sample["target_mask"], dtype=np.uint8
+                                ).tobytes()
+                            )
+                            files["keys.bin"].write(key)
+                            files["rows.bin"].write(
+                                np.array(
+                                    [meta["tokens"], length], dtype=np.int64
+                                ).tobytes()
+                            )
+                            row = known[key] = meta["rows"]
+                            meta["rows"] += 1
+                            meta["tokens"] += length
+                            appended += 1
+                        line_rows.append(row)
+            finally:
+                for handle in files.values():
+                    handle.close()
+            self._write_meta(meta)
+        index = self.rows(meta["rows"])[np.asarray(line_rows, dtype=np.int64)].reshape(
+            -1, 2
+        )
+        logger.info(
+            f"Compiled {data_file}: {len(line_rows)} rows, {appended} tokenized, "
+            f"{len(line_rows) - appended} reused from {self.path} in {time.perf_counter() - start_time:.2f}s"
+        )
+        return index[:, 0].copy(), index[:, 1].copy()
+
+    def arrays(self, tokens: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Read-only maps of the first `tokens` ids and mask values, appends don't move them."""
+        if tokens == 0:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.uint8)
+        ids = np.memmap(
+            self._file("ids.bin"), dtype=np.int32, mode="r", shape=(tokens,)
+        )
+        mask = np.memmap(
+            self._file("mask.bin"), dtype=np.uint8, mode="r", shape=(tokens,)
+        )
+        return ids, mask
@@ -1,5 +1,8 @@
-from typing import Dict, Any, List, Tuple
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple
+import hashlib
 import json
+import re
 
 DEFAULT_TOOL_PROMPT = (
     "You have access to the following tools:\n{tool_text}"
@@ -67,3 +70,95 @@ def function_formatter(tool_calls, function_slots=DEFAULT_FUNCTION_SLOTS) -> str
         elements.append(text)
 
     return "\n".join(elements) + "\n"
+
+
+# canonical `json.dumps(..., ensure_ascii=False)` output of a flat arguments object: string
+# values without escapes, integers (not -0, which decodes to 0), literals and arrays of those,
+# ", " and ": " separators
+_STRING = r'"[^"\\\x00-\x1f]*"'
+_SCALAR = rf"(?:{_STRING}|0|-?[1-9][0-9]*|true|false|null)"
+_VALUE = rf"(?:{_SCALAR}|\[(?:{_SCALAR}(?:, {_SCALAR})*)?\])"
+_CANONICAL_CALL = re.compile(
+    rf'\{{"name": ({_STRING}), "arguments": (\{{(?:{_STRING}: {_VALUE}(?:, {_STRING}: {_VALUE})*)?\}})\}}'
+)
+# in a flat object only keys are followed by ": "
+_KEY = re.compile(rf"({_STRING}): ")
+
+
+class FormatCache:
+    """LRU of rendered text keyed by a digest of the raw JSON, so large tool lists are not kept as keys."""
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self.entries: "OrderedDict[bytes, str]" = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get_or_render(self, raw: str, render) -> str:
+        key = hashlib.blake2b(raw.encode("utf8"), digest_size=16).digest()
+        text = self.entries.get(key)
+        if text is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return text
+        self.misses += 1
+        text = render(raw)
+        self.entries[key] = text
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return text
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = self.misses = 0
+
+
+# what DEFAULT_FUNCTION_SLOTS renders, the arguments are decoded separately
+_ACTION = re.compile(r"Action:[ \t]*([^\n]+?)[ \t]*\nAction Input:[ \t]*")
+_decoder = json.JSONDecoder()
+
+
+def parse_function_calls(text: str) -> Optional[List[Tuple[str, Any]]]:
+    """Parse the `Action:`/`Action Input:` calls in generated `text` back into (name, arguments).
+
+    Returns None when there is no `Action:` line or any call's input is not a JSON object.
+    """
+    calls = []
+    for match in _ACTION.finditer(text):
+        try:
+            arguments, _ = _decoder.raw_decode(text, match.end())
+        except json.JSONDecodeError:
+            return None
+        if not isinstance(arguments, dict):
+            return None
+        calls.append((match.group(1), arguments))
+    return calls or None
+
+
+_function_cache = FormatCache()
+_tools_cache = FormatCache(maxsize=256)
+
+
+def render_function_call(raw: str) -> str:
+    """`function_formatter(json.loads(raw))`, taken straight from `raw` when it is canonical."""
+    match = _CANONICAL_CALL.fullmatch(raw)
+    if match is not None:
+        keys = _KEY.findall(match.group(2))
+        # duplicate keys would collapse when decoded
+        if len(keys) == len(set(keys)):
+            return (
+                DEFAULT_FUNCTION_SLOTS.format(
+                    name=match.group(1)[1:-1], arguments=match.group(2)
+                )
+                + "\n"
+            )
+    return function_formatter(json.loads(raw))
+
+
+def format_function_call(raw: str) -> str:
+    """Rendered text of a raw `function_call` turn, cached by content."""
+    return _function_cache.get_or_render(raw, render_function_call)
+
+
+def format_tools(raw: str) -> str:
+    """Rendered tool prompt of a raw `tools` JSON list, cached by content."""
+    return _tools_cache.get_or_render(raw, lambda text: tool_formater(json.loads(text)))
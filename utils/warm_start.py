@@ -0,0 +1,254 @@
+"""Continue training from the last adapter of a task and base model instead of a fresh LoRA.
+
+After every upload the adapter is kept in `workspaces/task-<id>/adapters/<model>/`,
+with the commit it was pushed as and the keys of every row its lineage trained on.
+A later run of the task with `warm_start: true` starts from the adapter at the HEAD
+of the task repo: the local copy when it is that commit, a download otherwise,
+copied into the run so nothing evicts or replaces it while training. It
+trains `warm_start_epochs` on the rows the parent never saw plus a
+`warm_start_replay` share of the others (all rows when the parent's are unknown).
+Every adapter carries its lineage (generation, parent commit, ancestors, rows) as
+JSON in the `lineage` entry of its safetensors metadata.
+"""
+
+import json
+import os
+import random
+import shutil
+import time
+from contextlib import nullcontext
+from typing import Dict, Optional
+
+import numpy as np
+from loguru import logger
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+
+from utils.adapter_export import ADAPTER_CONFIG, ADAPTER_WEIGHTS, ADAPTER_WEIGHTS_BIN
+from utils.prepare import line_key
+from utils.workspace import Workspace, file_lock, model_slug
+
+LINEAGE_KEY = "lineage"
+LINEAGE_FILE = "lineage.json"
+# sorted uint64 prefixes of the line_key of every row the adapter's lineage trained on
+ROWS_FILE = "trained_rows.bin"
+ADAPTER_FILES = [ADAPTER_CONFIG, ADAPTER_WEIGHTS, ADAPTER_WEIGHTS_BIN]
+
+
+def repo_name(task_id, model_id: str) -> str:
+    return f"{os.environ['HF_USERNAME']}/task-{task_id}-{model_id.replace('/', '-')}"
+
+
+def row_keys(data_file: str) -> np.ndarray:
+    keys = bytearray()
+    with open(data_file, "rb") as f:
+        for line in f:
+            if line.strip():
+                keys += line_key(line)[:8]
+    return np.unique(np.frombuffer(bytes(keys), dtype="<u8"))
+
+
+def read_lineage(adapter_dir: str) -> Optional[Dict]:
+    path = os.path.join(adapter_dir, ADAPTER_WEIGHTS)
+    if not os.path.exists(path):
+        return None
+    with safe_open(path, framework="pt") as f:
+        metadata = f.metadata() or {}
+    return json.loads(metadata[LINEAGE_KEY]) if LINEAGE_KEY in metadata else None
+
+
+def stamp_lineage(adapter_dir: str, lineage: Dict):
+    """Record `lineage` in the adapter's safetensors metadata, uploaded with the weights."""
+    path = os.path.join(adapter_dir, ADAPTER_WEIGHTS)
+    if not os.path.exists(path):
+        logger.warning(
+            f"No {ADAPTER_WEIGHTS} in {adapter_dir}, the lineage is not recorded"
+        )
+        return
+    with safe_open(path, framework="pt") as f:
+        metadata = dict(f.metadata() or {"format": "pt"})
+    metadata[LINEAGE_KEY] = json.dumps(lineage, sort_keys=True)
+    save_file(load_file(path), path, metadata=metadata)
+
+
+def find_parent(workspace: Workspace, model_id: str, api=None) -> Optional[Dict]:
+    """The most recent adapter of (task, model): the repo HEAD, from the local copy when it is the same commit."""
+    local = os.path.join(workspace.adapter_dir(model_id), LINEAGE_FILE)
+    known = None
+    if os.path.exists(local):
+        with open(local) as f:
+            known = json.load(f)
+    repo = repo_name(workspace.task_id, model_id)
+    head = None
+    if api is not None:
+        try:
+            head = api.repo_info(repo, repo_type="model").sha
+        except Exception as e:
+            logger.info(f"No adapter of {repo} on the hub: {e}")
+    if known is not None and head in (None, known["commit"]):
+        return {
+            "path": workspace.adapter_dir(model_id),
+            "repo": repo,
+            "commit": known["commit"],
+            "source": "local",
+        }
+    if head is None:
+        return None
+    try:
+        path = api.snapshot_download(
+            repo, revision=head, allow_patterns=ADAPTER_FILES, repo_type="model"
+        )
+    except Exception as e:
+        logger.warning(
+            f"Downloading the adapter of {repo} failed, training from scratch: {e}"
+        )
+        return None
+    return {"path": path, "repo": repo, "commit": head, "source": "hub"}
+
+
+def copy_parent(parent: Dict, target: str) -> bool:
+    """Copy the parent adapter into the run, False when it is gone meanwhile.
+
+    The kept local adapter is read under a shared lock: eviction and `remember_adapter`
+    take it exclusively, so neither removes the adapter while it is copied.
+    """
+    shutil.rmtree(target, ignore_errors=True)
+    os.makedirs(target)
+    with file_lock(parent["path"], shared=True) if parent[
+        "source"
+    ] == "local" else nullcontext():
+        for name in ADAPTER_FILES + [ROWS_FILE, LINEAGE_FILE]:
+            if os.path.exists(os.path.join(parent["path"], name)):
+                shutil.copy(os.path.join(parent["path"], name), target)
+    if os.path.exists(os.path.join(target, LINEAGE_FILE)):
+        # another run of the task may have uploaded a newer adapter since find_parent
+        with open(os.path.join(target, LINEAGE_FILE)) as f:
+            parent["commit"] = json.load(f)["commit"]
+    return os.path.exists(os.path.join(target, ADAPTER_CONFIG))
+
+
+def write_delta(
+    data_file: str, parent_rows: np.ndarray, out_file: str, replay: float, seed: int = 0
+) -> Dict:
+    """Write the rows of `data_file` the parent never saw plus `replay` of the others to `out_file`."""
+    rng = random.Random(seed)
+    new = replayed = 0
+    with open(data_file, "rb") as src, open(out_file, "wb") as dst:
+        for line in src:
+            if not line.strip():
+                continue
+            key = np.frombuffer(line_key(line)[:8], dtype="<u8")[0]
+            index = np.searchsorted(parent_rows, key)
+            seen = bool(index < len(parent_rows) and parent_rows[index] == key)
+            if seen and rng.random() >= replay:
+                continue
+            dst.write(line if line.endswith(b"\n") else line + b"\n")
+            replayed += seen
+            new += not seen
+    return {"new_rows": new, "replayed_rows": replayed}
+
+
+def from_scratch(task_id, model_id: str, data_file: str) -> Dict:
+    lineage = {
+        "task_id": task_id,
+        "model_id": model_id,
+        "generation": 0,
+        "parent": None,
+        "ancestors": [],
+    }
+    return {
+        "adapter": None,
+        "data_file": data_file,
+        "parent_rows": None,
+        "lineage": lineage,
+    }
+
+
+def plan_warm_start(
+    workspace: Workspace, model_id: str, args: Dict, data_file: str, api=None
+) -> Dict:
+    """What `model_id` trains from: its parent adapter and delta data under `warm_start`, and its lineage."""
+    result = from_scratch(workspace.task_id, model_id, data_file)
+    lineage = result["lineage"]
+    if not args.get("warm_start"):
+        return result
+    parent = find_parent(workspace, model_id, api)
+    # trained from a copy in the run, the kept adapter may be evicted or replaced meanwhile
+    parent_dir = os.path.join(workspace.model_dir(model_id), "parent")
+    if parent is None or not copy_parent(parent, parent_dir):
+        logger.info(
+            f"No previous adapter of {model_id} for task {workspace.task_id}, training from scratch"
+        )
+        return result
+
+    parent_lineage = read_lineage(parent_dir) or {}
+    lineage.update(
+        generation=parent_lineage.get("generation", 0) + 1,
+        parent={key: parent[key] for key in ("repo", "commit", "source")},
+        ancestors=parent_lineage.get("ancestors", []) + [parent["commit"]],
+        epochs=args.get("warm_start_epochs", 1),
+    )
+    result["adapter"] = parent_dir
+    rows_file = os.path.join(parent_dir, ROWS_FILE)
+    source = f"{parent['source']} commit {parent['commit']}"
+    if not os.path.exists(rows_file):
+        logger.info(f"Warm-starting {model_id} from {source} on all rows")
+        return result
+
+    result["parent_rows"] = rows_file
+    delta_file = os.path.join(
+        os.path.dirname(data_file), f"warm-{model_slug(model_id)}.jsonl"
+    )
+    parent_rows = np.fromfile(rows_file, dtype="<u8")
+    counts = write_delta(
+        data_file, parent_rows, delta_file, args.get("warm_start_replay", 0.25)
+    )
+    lineage.update(counts)
+    if counts["new_rows"] + counts["replayed_rows"] == 0:
+        # the parent saw every row and none is replayed, an empty file would fail the trainer
+        logger.info(
+            f"Warm-starting {model_id} from {source}: no new rows, training on all rows"
+        )
+        return result
+    result["data_file"] = delta_file
+    logger.info(
+        f"Warm-starting {model_id} from {source}: "
+        f"{counts['new_rows']} new rows, {counts['replayed_rows']} replayed"
+    )
+    return result
+
+
+def record_lineage(output_dir: str, warm: Dict, data_file: str):
+    """Stamp the lineage into the trained adapter and record every row its lineage has seen."""
+    rows = row_keys(data_file)
+    if warm["parent_rows"] is not None:
+        rows = np.union1d(rows, np.fromfile(warm["parent_rows"], dtype="<u8"))
+    rows.astype("<u8").tofile(os.path.join(output_dir, ROWS_FILE))
+    stamp_lineage(
+        output_dir,
+        dict(
+            warm["lineage"],
+            rows=int(len(rows)),
+            trained_at=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        ),
+    )
+
+
+def remember_adapter(workspace: Workspace, model_id: str, output_dir: str, commit: str):
+    """Keep the uploaded adapter as the local parent of the next run of the task."""
+    target = workspace.adapter_dir(model_id)
+    with file_lock(target):
+        tmp = f"{target}.tmp-{os.getpid()}"
+        os.makedirs(tmp, exist_ok=True)
+        for name in ADAPTER_FILES + [ROWS_FILE]:
+            if os.path.exists(os.path.join(output_dir, name)):
+                shutil.copy(os.path.join(output_dir, name), tmp)
+        with open(os.path.join(tmp, LINEAGE_FILE), "w") as f:
+            json.dump(
+                dict(read_lineage(tmp) or {}, commit=commit),
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+        shutil.rmtree(target, ignore_errors=True)
+        os.replace(tmp, target)
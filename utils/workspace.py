@@ -0,0 +1,109 @@
+import fcntl
+import os
+import shutil
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from loguru import logger
+
+WORKSPACE_ROOT = "workspaces"
+WORKSPACE_ENV = "WORKSPACE_ROOT"
+
+
+def model_slug(model_id: str) -> str:
+    return model_id.replace("/", "-")
+
+
+def workspace_root(root: Optional[str] = None) -> str:
+    return os.path.abspath(root or os.environ.get(WORKSPACE_ENV, WORKSPACE_ROOT))
+
+
+@contextmanager
+def file_lock(path: str, shared: bool = False) -> Iterator[None]:
+    """flock on `<path>.lock`: exclusive to write `path`, shared to read it meanwhile.
+
+    The lock is tied to the open file, so it is released if the holder dies.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(f"{path}.lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@contextmanager
+def try_lock(path: str) -> Iterator[bool]:
+    """Exclusive flock on `<path>.lock` without waiting, yields whether it was taken."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(f"{path}.lock", "a") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def shared_path(name: str, root: Optional[str] = None) -> str:
+    """`<root>/shared/<name>`, a cache kept across runs and tasks (e.g. a token store)."""
+    path = os.path.join(workspace_root(root), "shared", name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+class Workspace(object):
+    """Directory tree of one run of a task, so several runs can share a host.
+
+    <root>/shared/                      caches shared by every run (shared_path), e.g. token stores
+    <root>/task-<id>/sweeps/<model>/    sweep trials by data fingerprint, resumed by runs on the same data
+    <root>/task-<id>/adapters/<model>/  last uploaded adapter, warm-starts later runs
+    <root>/task-<id>/<run>/data/        task data: train.jsonl (merged), eval.jsonl
+    <root>/task-<id>/<run>/<model>/     outputs (with trainer checkpoints) of one model
+    """
+
+    def __init__(self, task_id, run_id: str, root: Optional[str] = None):
+        self.root = workspace_root(root)
+        self.task_id = task_id
+        self.run_id = run_id
+        self.task_dir = os.path.join(self.root, f"task-{task_id}")
+        self.run_dir = os.path.join(self.task_dir, run_id)
+        os.makedirs(os.path.join(self.run_dir, "data"), exist_ok=True)
+
+    @property
+    def data_file(self) -> str:
+        return os.path.join(self.run_dir, "data", "train.jsonl")
+
+    @property
+    def eval_file(self) -> str:
+        return os.path.join(self.run_dir, "data", "eval.jsonl")
+
+    def model_dir(self, model_id: str) -> str:
+        path = os.path.join(self.run_dir, model_slug(model_id))
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def output_dir(self, model_id: str) -> str:
+        return os.path.join(self.model_dir(model_id), "outputs")
+
+    def sweep_dir(self, model_id: str) -> str:
+        return os.path.join(self.task_dir, "sweeps", model_slug(model_id))
+
+    def adapter_dir(self, model_id: str) -> str:
+        return os.path.join(self.task_dir, "adapters", model_slug(model_id))
+
+    def cleanup_model(self, model_id: str):
+        shutil.rmtree(
+            os.path.join(self.run_dir, model_slug(model_id)), ignore_errors=True
+        )
+
+    def cleanup(self):
+        """Remove this run's tree, the sweeps of the task and the shared caches stay."""
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+        if os.path.exists(f"{self.run_dir}.lock"):
+            os.remove(f"{self.run_dir}.lock")
+        logger.info(f"Removed workspace {self.run_dir}")